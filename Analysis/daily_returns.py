@@ -1,38 +1,92 @@
+import os
 import pandas as pd
 import matplotlib.pyplot as plt
 import pandas_datareader as pdr
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from pathlib import Path
+
+PRICE_STORE = os.path.join(os.path.dirname(Path(__file__).absolute()),
+                           '..', 'backtesting', 'price_data', 'daily')
+# The store is downloaded from this date on (or the start of the range, if earlier)
+STORE_START = pd.Timestamp('2015-01-01')
+# The most weekdays in a row the market closes for holidays, which a store can miss
+# at either end of a range and still cover it
+MAX_CLOSED_DAYS = 2
+
+
+def _missing_weekdays(first, last):
+  """
+  Returns: the number of weekdays from first up to and including last, which a store
+  whose bars end before first (or start after last) doesn't have
+  """
+  return len(pd.bdate_range(first, last))
+
+
+def covers_range(index, starttime, endtime, today=None):
+  """
+  Returns: True if a store with the bars on index (sorted dates) has every trading day
+  from starttime to endtime. Weekends and holidays at either end aren't trading days,
+  a symbol listed after STORE_START has no bars before its listing, and today's bar is
+  only expected once the day is over.
+  """
+  if len(index) == 0:
+    return False
+  day = pd.Timedelta(days=1)
+  today = pd.Timestamp(today or datetime.today().date())
+  end = min(pd.Timestamp(endtime), today - day)
+  listed_later = _missing_weekdays(STORE_START, index[0] - day) > MAX_CLOSED_DAYS
+  start_covered = listed_later or _missing_weekdays(pd.Timestamp(starttime), index[0] - day) <= MAX_CLOSED_DAYS
+  end_covered = _missing_weekdays(index[-1] + day, end) <= MAX_CLOSED_DAYS
+  return start_covered and end_covered
+
+
+def read_price_store(stock, starttime, endtime):
+  """
+  Returns: the daily prices of stock between starttime and endtime from the local price
+  store shared with the backtester, or None if the store doesn't cover that range
+  """
+  try:
+    df = pd.read_csv(os.path.join(PRICE_STORE, f"{stock}.csv"),
+                     index_col="Date", parse_dates=True)
+  except (OSError, ValueError):
+    return None
+  if not covers_range(df.index, starttime, endtime):
+    return None
+  return df
 
 
 def load_data(stock, starttime, endtime):
-  data = pdr.get_data_yahoo(symbols=stock, start=starttime, end=endtime)
-  data = data["Adj Close"].to_frame()
+  df = read_price_store(stock, starttime, endtime)
+  if df is None:
+    # Download the same range the backtester keeps so the store is reused by both
+    df = pdr.get_data_yahoo(symbols=stock, start=min(pd.Timestamp(starttime), pd.Timestamp('2015-01-01')),
+                            end=max(pd.Timestamp(endtime), pd.Timestamp(datetime.today().date())))
+    os.makedirs(PRICE_STORE, exist_ok=True)
+    df.to_csv(os.path.join(PRICE_STORE, f"{stock}.csv"))
+  data = df.loc[pd.Timestamp(starttime):pd.Timestamp(endtime), "Adj Close"].to_frame()
   data = data.rename(columns={"Adj Close": stock})
   return data
 
+
+def load_symbols(symbols, starttime, endtime, max_workers=8):
+  """
+  Returns: the adjusted closes of symbols, one column per symbol, on the dates every
+  symbol traded. Symbols missing from the price store are downloaded concurrently.
+  """
+  symbols = list(dict.fromkeys(symbols))
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    frames = list(executor.map(lambda stock: load_data(stock, starttime, endtime), symbols))
+  return pd.concat(frames, axis=1, join="inner")
+
+
 def get_data(symbols, starttime, endtime):
-    # Create an empty dataframe
-    SPY = load_data('SPY', starttime, endtime)
-    df1 = pd.DataFrame(index = SPY.index)
-    df1 = df1.join(SPY, how = "inner")
-
-    for symbol in symbols:
-        stock = pdr.get_data_yahoo(symbols=symbol, start=starttime, end=endtime)
-        stock = stock["Adj Close"].to_frame()
-        stock = stock.rename(columns={"Adj Close": symbol})
-        df1 = df1.join(stock, how="inner")
-    return df1
+    # SPY first, then every symbol, aligned on the dates they all traded
+    return load_symbols(['SPY'] + [symbol for symbol in symbols if symbol != 'SPY'], starttime, endtime)
 
 def get_data_no_spy(symbols, starttime, endtime):
-        SPY = load_data('SPY', starttime, endtime)
-        df1 = pd.DataFrame(index = SPY.index)
-        for symbol in symbols:
-            stock = pdr.get_data_yahoo(symbols=symbol, start=starttime, end=endtime)
-            stock = stock["Adj Close"].to_frame()
-            stock = stock.rename(columns={"Adj Close": symbol})
-            df1 = df1.join(stock, how="inner")
-        return df1
-        
+    return load_symbols(symbols, starttime, endtime)
+
 
 def normalize_data(df):
     return df / df.iloc[0, :]
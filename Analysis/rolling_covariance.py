@@ -0,0 +1,190 @@
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+
+class RollingCovariance(object):
+    """
+    A class that keeps the covariance matrix of the last window observations of a vector
+    of returns.
+
+    The running sum and sum of outer products are updated with rank-1 updates as the
+    window slides (add the new observation, remove the oldest), so each step costs
+    O(symbols^2) instead of O(window * symbols^2). The sums are recomputed from the
+    window every resync steps to stop floating-point drift from accumulating.
+    """
+
+    def __init__(self, num_symbols, window, resync=None):
+        self._window = window
+        self._resync = resync or window
+        self._buffer = np.zeros((window, num_symbols))
+        self._position = 0
+        self._count = 0
+        self._steps = 0
+        self._sum = np.zeros(num_symbols)
+        self._outer = np.zeros((num_symbols, num_symbols))
+
+    def is_full(self):
+        """
+        Returns: True if the window holds window observations. False otherwise
+        """
+        return self._count == self._window
+
+    def add(self, returns):
+        """
+        Adds an observation (a vector of returns, one per symbol), dropping the oldest one
+        if the window is full
+        """
+        returns = np.asarray(returns, dtype=float)
+        if self._count == self._window:
+            oldest = self._buffer[self._position]
+            self._sum -= oldest
+            self._outer -= np.outer(oldest, oldest)
+        else:
+            self._count += 1
+        self._buffer[self._position] = returns
+        self._position = (self._position + 1) % self._window
+        self._sum += returns
+        self._outer += np.outer(returns, returns)
+        self._steps += 1
+        if self._steps % self._resync == 0:
+            values = self._buffer[:self._count]
+            self._sum = values.sum(axis=0)
+            self._outer = values.T @ values
+
+    def get_window(self):
+        """
+        Returns: the (observation x symbol) array of the observations in the window,
+        oldest first
+        """
+        if self._count < self._window:
+            return self._buffer[:self._count]
+        return np.roll(self._buffer, -self._position, axis=0)
+
+    def covariance(self, ddof=1):
+        """
+        Returns: the sample covariance matrix of the window
+        """
+        n = self._count
+        return (self._outer - np.outer(self._sum, self._sum) / n) / (n - ddof)
+
+    def correlation(self, ddof=1):
+        """
+        Returns: the correlation matrix of the window
+        """
+        return covariance_to_correlation(self.covariance(ddof))
+
+
+def covariance_to_correlation(cov):
+    """
+    Returns: the correlation matrix of the covariance matrix cov. Symbols with no variance
+    get a correlation of nan
+    """
+    std = np.sqrt(np.diag(cov))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = cov / np.outer(std, std)
+    np.fill_diagonal(corr, np.where(std > 0, 1.0, np.nan))
+    return corr
+
+
+def ledoit_wolf_shrinkage(window_returns, cov=None):
+    """
+    Returns: the Ledoit-Wolf estimate of the shrinkage intensity (between 0 and 1) of the
+    covariance of window_returns, an (observation x symbol) array, toward a scaled identity
+    """
+    x = window_returns - window_returns.mean(axis=0)
+    n = len(x)
+    if cov is None:
+        cov = x.T @ x / n
+    target = np.trace(cov) / len(cov)
+    d2 = ((cov - target * np.eye(len(cov))) ** 2).sum()
+    if d2 == 0:
+        return 0.0
+    # Average squared distance between each observation's outer product and cov
+    x2 = x ** 2
+    b2 = ((x2.T @ x2).sum() - 2 * np.einsum('ti,ij,tj->', x, cov, x) + n * (cov ** 2).sum()) / n ** 2
+    return float(min(b2, d2) / d2)
+
+
+def shrink(cov, shrinkage):
+    """
+    Returns: cov shrunk toward the identity scaled by the average variance.
+    shrinkage is the weight of the target, between 0 and 1
+    """
+    target = np.trace(cov) / len(cov)
+    shrunk = (1 - shrinkage) * cov
+    shrunk[np.diag_indices_from(shrunk)] += shrinkage * target
+    return shrunk
+
+
+def _as_array(returns):
+    if isinstance(returns, pd.DataFrame):
+        returns = returns.dropna()
+        return returns.to_numpy(dtype=float), returns.index, list(returns.columns)
+    return np.asarray(returns, dtype=float), None, None
+
+
+def iter_rolling_covariance(returns, window, shrinkage=0, correlation=False, ddof=1):
+    """
+    Yields: (label, matrix) for every full window of returns, a (date x symbol) array or
+    DataFrame; rows of a DataFrame with a missing value are dropped. label is the date of
+    the last observation of the window (its position if returns is an array).
+
+    shrinkage is a weight between 0 and 1, or 'ledoit-wolf' to estimate it for every
+    window. Only one matrix is held in memory at a time.
+    """
+    values, index, _ = _as_array(returns)
+    rolling = RollingCovariance(values.shape[1], window)
+    for i, row in enumerate(values):
+        rolling.add(row)
+        if not rolling.is_full():
+            continue
+        matrix = rolling.covariance(ddof)
+        if shrinkage == 'ledoit-wolf':
+            matrix = shrink(matrix, ledoit_wolf_shrinkage(rolling.get_window()))
+        elif shrinkage:
+            matrix = shrink(matrix, shrinkage)
+        if correlation:
+            matrix = covariance_to_correlation(matrix)
+        yield (index[i] if index is not None else i), matrix
+
+
+def rolling_covariance(returns, window, shrinkage=0, correlation=False, ddof=1, dtype=np.float32,
+                       path=None):
+    """
+    Returns: (labels, matrices, symbols) where matrices is a (window end x symbol x symbol)
+    array of the rolling covariance (or correlation) matrices of returns, see
+    iter_rolling_covariance.
+
+    The matrices are stored as dtype (float32 by default, half the memory of float64).
+    If path is given they are written to a memory-mapped .npy file instead of being held
+    in memory, which can be reopened with np.load(path, mmap_mode='r').
+    """
+    values, index, symbols = _as_array(returns)
+    shape = (max(len(values) - window + 1, 0), values.shape[1], values.shape[1])
+    if path is not None:
+        matrices = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+    else:
+        matrices = np.empty(shape, dtype=dtype)
+    labels = []
+    for i, (label, matrix) in enumerate(iter_rolling_covariance(values, window, shrinkage, correlation, ddof)):
+        matrices[i] = matrix
+        labels.append(index[label] if index is not None else label)
+    if path is not None:
+        matrices.flush()
+    return labels, matrices, symbols
+
+
+def test_run():
+    import daily_returns
+    df = daily_returns.get_data_no_spy(["FSLY", "TTD", "NET", "QQQ", "SQ", "DOCU", "TWLO", "SE", "WIX"],
+                                       datetime(2020, 1, 1), datetime(2020, 6, 18))
+    returns = daily_returns.compute_daily_returns(df)
+
+    # 20 day rolling correlation matrices of all of your positions
+    labels, matrices, symbols = rolling_covariance(returns, 20, correlation=True)
+    print(pd.DataFrame(matrices[-1], index=symbols, columns=symbols))
+
+
+if __name__ == "__main__":
+    test_run()
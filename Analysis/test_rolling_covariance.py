@@ -0,0 +1,118 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+import rolling_covariance
+
+
+def make_returns(num_days=300, num_symbols=6, seed=0):
+    """
+    Returns: a (date x symbol) dataframe of correlated random daily returns
+    """
+    rng = np.random.default_rng(seed)
+    mixing = rng.normal(0, 1, (num_symbols, num_symbols))
+    values = rng.normal(0, 0.01, (num_days, num_symbols)) @ mixing
+    return pd.DataFrame(values, index=pd.bdate_range("2019-01-01", periods=num_days),
+                        columns=[f"S{i}" for i in range(num_symbols)])
+
+
+def pandas_matrices(returns, window, correlation=False):
+    """
+    Returns: the list of (date, matrix) of the rolling covariance (or correlation) of
+    returns computed by pandas, for every full window
+    """
+    rolling = returns.rolling(window)
+    frame = rolling.corr() if correlation else rolling.cov()
+    return [(date, frame.loc[date].to_numpy()) for date in returns.index[window - 1:]]
+
+
+def ledoit_wolf_reference(window_returns):
+    """
+    Returns: the Ledoit-Wolf shrinkage intensity of window_returns (a dataframe) toward the
+    scaled identity, straight from its definition
+    """
+    x = (window_returns - window_returns.mean()).to_numpy()
+    n = len(x)
+    cov = window_returns.cov(ddof=0).to_numpy()
+    target = np.trace(cov) / len(cov) * np.eye(len(cov))
+    d2 = ((cov - target) ** 2).sum()
+    b2 = sum(((np.outer(row, row) - cov) ** 2).sum() for row in x) / n ** 2
+    return min(b2, d2) / d2
+
+
+class TestRollingCovariance(unittest.TestCase):
+    """
+    The rolling matrices match the ones pandas computes window by window
+    """
+
+    WINDOW = 20
+
+    def setUp(self):
+        self.returns = make_returns()
+
+    def assert_matches(self, labels, matrices, expected):
+        self.assertEqual(list(labels), [date for date, _ in expected])
+        for matrix, (date, expected_matrix) in zip(matrices, expected):
+            np.testing.assert_allclose(matrix, expected_matrix, rtol=1e-9, atol=1e-12, err_msg=str(date))
+
+    def test_covariance(self):
+        labels, matrices, symbols = rolling_covariance.rolling_covariance(
+            self.returns, self.WINDOW, dtype=np.float64)
+        self.assertEqual(symbols, list(self.returns.columns))
+        self.assert_matches(labels, matrices, pandas_matrices(self.returns, self.WINDOW))
+
+    def test_correlation(self):
+        labels, matrices, _ = rolling_covariance.rolling_covariance(
+            self.returns, self.WINDOW, correlation=True, dtype=np.float64)
+        self.assert_matches(labels, matrices, pandas_matrices(self.returns, self.WINDOW, correlation=True))
+
+    def test_resync(self):
+        # sums recomputed from the window at steps that don't line up with its start
+        returns = make_returns(num_days=1000)
+        rolling = rolling_covariance.RollingCovariance(returns.shape[1], self.WINDOW, resync=7)
+        expected = pandas_matrices(returns, self.WINDOW)
+        for i, row in enumerate(returns.to_numpy()):
+            rolling.add(row)
+            if rolling.is_full():
+                np.testing.assert_allclose(rolling.covariance(), expected[i - self.WINDOW + 1][1],
+                                           rtol=1e-9, atol=1e-12)
+
+    def test_rows_with_missing_values_are_dropped(self):
+        returns = self.returns.copy()
+        returns.iloc[[5, 40, 41], [0, 2]] = np.nan
+        labels, matrices, _ = rolling_covariance.rolling_covariance(
+            returns, self.WINDOW, dtype=np.float64)
+        self.assert_matches(labels, matrices, pandas_matrices(returns.dropna(), self.WINDOW))
+
+    def test_fixed_shrinkage(self):
+        shrinkage = 0.3
+        labels, matrices, _ = rolling_covariance.rolling_covariance(
+            self.returns, self.WINDOW, shrinkage=shrinkage, dtype=np.float64)
+        expected = [(date, (1 - shrinkage) * cov + shrinkage * np.trace(cov) / len(cov) * np.eye(len(cov)))
+                    for date, cov in pandas_matrices(self.returns, self.WINDOW)]
+        self.assert_matches(labels, matrices, expected)
+
+    def test_ledoit_wolf_shrinkage(self):
+        labels, matrices, _ = rolling_covariance.rolling_covariance(
+            self.returns, self.WINDOW, shrinkage='ledoit-wolf', dtype=np.float64)
+        expected = []
+        for i, (date, cov) in enumerate(pandas_matrices(self.returns, self.WINDOW)):
+            shrinkage = ledoit_wolf_reference(self.returns.iloc[i:i + self.WINDOW])
+            self.assertTrue(0 <= shrinkage <= 1)
+            expected.append((date, (1 - shrinkage) * cov +
+                             shrinkage * np.trace(cov) / len(cov) * np.eye(len(cov))))
+        self.assert_matches(labels, matrices, expected)
+
+    def test_memory_mapped(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "matrices.npy")
+            _, matrices, _ = rolling_covariance.rolling_covariance(self.returns, self.WINDOW, path=path)
+            expected = np.array([matrix for _, matrix in pandas_matrices(self.returns, self.WINDOW)])
+            stored = np.load(path, mmap_mode='r')
+            np.testing.assert_allclose(stored, expected.astype(np.float32), rtol=1e-5, atol=1e-9)
+            del matrices, stored
+
+
+if __name__ == "__main__":
+    unittest.main()
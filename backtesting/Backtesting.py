@@ -2,6 +2,7 @@ import datetime
 import matplotlib.pyplot as plt
 import re
 import pandas as pd
+import numpy as np
 import math
 import time
 import logging
@@ -13,12 +14,17 @@ import sys
 import pytz
 import holidays
 import Conditions
+import Checkpoint
+import Fills
+import Profiling
 from pathlib import Path
 
 
+US_HOLIDAYS = holidays.US()
+
+
 def market_is_open(now):
-    us_holidays = holidays.US()
-    abool = now.strftime('%Y-%m-%d') in us_holidays or now.weekday() > 4
+    abool = now in US_HOLIDAYS or now.weekday() > 4
     return not abool
 
 
@@ -67,12 +73,17 @@ def backtest_buy(state, current_date, current_time, portfolio):
     strategies = state.get_strategies()
     for strategy in strategies:
         if state.buying_conditions_are_met(strategy, current_date, current_time):
-            stocks_to_buy = state.get_stocks_to_buy(strategy)
+            stocks_to_buy = list(state.get_stocks_to_buy(strategy))
             abool = False
             # print(stocks_to_buy)
-            for stock in stocks_to_buy:
-                abool = abool or portfolio.buy(stock, strategy,
-                                               current_date, current_time)
+            below_max = portfolio.check_max_allocations(
+                stocks_to_buy, strategy, current_date, current_time) & \
+                portfolio.check_max_net_deltas(
+                    stocks_to_buy, strategy, current_date, current_time)
+            for stock, is_below_max in zip(stocks_to_buy, below_max):
+                if is_below_max:
+                    abool = portfolio.buy(stock, strategy,
+                                          current_date, current_time) or abool
                 # print(abool)
             if abool:
                 # print('bought')
@@ -83,34 +94,76 @@ def backtest_sell(state, current_date, current_time, portfolio):
     strategies = state.get_strategies()
     for strategy in strategies:
         if state.selling_conditions_are_met(strategy, current_date, current_time):
-            stocks_to_sell = state.get_stocks_to_sell(strategy)
+            stocks_to_sell = sorted(state.get_stocks_to_sell(strategy))
             abool = False
             for stock in stocks_to_sell:
-                abool = abool or portfolio.sell(stock, strategy,
-                                                current_date, current_time)
+                abool = portfolio.sell(stock, strategy,
+                                       current_date, current_time) or abool
             if abool:
                 state.acknowledge_sell(strategy, current_date, current_time)
 
 
 def backtest_loop_helper(asset_list, current_date, current_time, state):
     portfolio = state.get_portfolio()
-    backtest_buy(state, current_date, current_time, portfolio)
-    backtest_sell(state, current_date, current_time, portfolio)
-
-
-def backtest_loop(asset_list, state, resolution, date1_obj, epochs, current_time, current_epoch):
+    if portfolio.get_pending_orders():
+        with Profiling.phase("pending fills"):
+            portfolio.fill_pending_orders(current_date, current_time)
+    if portfolio.get_risk_manager() is not None:
+        with Profiling.phase("risk exits"):
+            portfolio.apply_risk_exits(current_date, current_time)
+    with Profiling.phase("buy"):
+        backtest_buy(state, current_date, current_time, portfolio)
+    with Profiling.phase("sell"):
+        backtest_sell(state, current_date, current_time, portfolio)
+
+
+def backtest_loop(asset_list, state, resolution, date1_obj, epochs, current_time, current_epoch, checkpointer=None,
+                  pruner=None, profiler=None):
+    with Profiling.running(profiler):
+        return _backtest_loop(asset_list, state, resolution, date1_obj, epochs, current_time, current_epoch,
+                              checkpointer, pruner)
+
+
+def _backtest_loop(asset_list, state, resolution, date1_obj, epochs, current_time, current_epoch, checkpointer,
+                   pruner):
+    day_delta = max(current_epoch - 1, 0) // resolution
     while current_epoch <= epochs:
+        if checkpointer is not None and checkpointer.is_due(current_epoch):
+            with Profiling.phase("checkpoint"):
+                checkpointer.save(state, resolution, date1_obj, epochs,
+                                  current_time, current_epoch, asset_list)
+        if pruner is not None and pruner.is_due(current_epoch) and pruner.should_prune(state):
+            Helper.log_info(f"Pruned backtest at epoch {current_epoch} of {epochs}")
+            return day_delta
         day_delta = current_epoch // resolution
         current_date = date1_obj + datetime.timedelta(days=day_delta)
-        if market_is_open(current_date):
+        if market_is_open(current_date) or state.trades_around_the_clock():
             state.update_portfolio_value(current_date, current_time)
             backtest_loop_helper(asset_list, current_date, current_time, state)
         current_time.forward_time(resolution)
         current_epoch += 1
+    if checkpointer is not None:
+        checkpointer.save(state, resolution, date1_obj, epochs,
+                          current_time, current_epoch, asset_list)
     return day_delta
 
 
-def backtest(asset_list, start_date, end_date, resolution, days, state):
+def finish_backtest(state, date1_obj, days_passed, current_time, plot=True, profiler=None):
+    if profiler is not None:
+        profiler.stop()
+        Helper.log_info(profiler.format_report())
+    if plot:
+        portfolio_history = state.get_portfolio_history()[0]
+        portfolio_history.plot()
+        plt.show()
+    Helper.log_info("Backtest complete")
+    Helper.log_info(state.get_portfolio_snapshot(
+        date1_obj + datetime.timedelta(days=days_passed), current_time))
+    return state
+
+
+def backtest(asset_list, start_date, end_date, resolution, days, state, plot=True, checkpointer=None, pruner=None,
+             profiler=None):
     Helper.log_info("Starting Backtest")
     check_backtest_preconditions(start_date, end_date, resolution, days)
     if days == 'All' or days == 'all':
@@ -124,14 +177,62 @@ def backtest(asset_list, start_date, end_date, resolution, days, state):
     epochs, current_epoch = epochs * resolution, 0
     current_time = State.Time(resolution)
     days_passed = backtest_loop(asset_list, state, resolution,
-                                date1_obj, epochs, current_time, current_epoch)
+                                date1_obj, epochs, current_time, current_epoch, checkpointer, pruner, profiler)
+    return finish_backtest(state, date1_obj, days_passed, current_time, plot, profiler)
 
+
+def resume_backtest(checkpoint, end_date=None, plot=True, checkpointer=None, profiler=None):
+    """
+    Resumes a backtest from checkpoint (a path, or a checkpoint returned by
+    Checkpoint.load_checkpoint) and runs it to end_date, or to its original end date.
+
+    To fork a what-if run, load a checkpoint, change checkpoint["state"] (e.g. its
+    strategies) and resume it with a checkpointer writing to a different directory.
+
+    Returns: the state at the end of the backtest
+    """
+    with Profiling.running(profiler):
+        if not isinstance(checkpoint, dict):
+            checkpoint = Checkpoint.load_checkpoint(checkpoint)
+        return _resume_backtest(checkpoint, end_date, plot, checkpointer, profiler)
+
+
+def _resume_backtest(checkpoint, end_date, plot, checkpointer, profiler):
+    state = checkpoint["state"]
+    resolution = checkpoint["resolution"]
+    date1_obj = checkpoint["date1_obj"]
+    epochs = checkpoint["epochs"]
+    if end_date is not None:
+        date2 = [int(x) for x in re.split(r'[\-]', end_date)]
+        epochs = (datetime.date(date2[0], date2[1], date2[2]) -
+                  date1_obj).days * resolution
+    State.HoldingsStrategy.load_assets(checkpoint["asset_list"])
+    State.HoldingsStrategy.load_assets(state.get_assets())
+    Helper.log_info(
+        f"Resuming backtest at epoch {checkpoint['current_epoch']} of {epochs}")
+    days_passed = backtest_loop(checkpoint["asset_list"], state, resolution, date1_obj, epochs,
+                                checkpoint["current_time"], checkpoint["current_epoch"], checkpointer,
+                                profiler=profiler)
+    return finish_backtest(state, date1_obj, days_passed, checkpoint["current_time"], plot, profiler)
+
+
+def summarize_backtest(state):
+    """
+    Returns: a dict summarizing the equity curve of a finished backtest
+    """
     portfolio_history = state.get_portfolio_history()[0]
-    portfolio_history.plot()
-    plt.show()
-    Helper.log_info("Backtest complete")
-    Helper.log_info(state.get_portfolio_snapshot(
-        date1_obj + datetime.timedelta(days=days_passed), current_time))
+    strategy_values = portfolio_history["Strategy Value"].to_numpy(dtype=float)
+    hodl_values = portfolio_history["HODL Value"].to_numpy(dtype=float)
+    if len(strategy_values) == 0:
+        return {"initial_value": None, "final_value": None, "return": None,
+                "hodl_return": None, "max_drawdown": None, "num_bars": 0}
+    drawdown = 1 - strategy_values / np.maximum.accumulate(strategy_values)
+    return {"initial_value": float(strategy_values[0]),
+            "final_value": float(strategy_values[-1]),
+            "return": float(strategy_values[-1] / strategy_values[0] - 1),
+            "hodl_return": float(hodl_values[-1] / hodl_values[0] - 1),
+            "max_drawdown": float(drawdown.max()),
+            "num_bars": len(strategy_values)}
 
 
 def sell_booming_nega_end(asset_list, portfolio, selling_allocation, selling_delay, target_percent_gain=0.5):
@@ -147,47 +248,138 @@ def sell_booming_nega_end(asset_list, portfolio, selling_allocation, selling_del
 
 
 def construct_long_strategy(asset_list, portfolio, buying_allocation, buying_delay, selling_delay,
-                            option_type='C', spread_type='debit', strikes_above=0):
+                            option_type='C', spread_type='debit', strikes_above=0, sd=0, week_length=5):
     strategy = State.HoldingsStrategy(
         "Going long at lows", asset_list, assets=State.Assets.Options, buying_allocation=buying_allocation, selling_allocation=1,
-        maximum_allocation_per_stock=0.25, start_with_spreads=True, buying_delay=5, selling_delay=selling_delay, strikes_above=0,
-        expiration_length=State.OptionLength.Monthly)
+        maximum_allocation_per_stock=0.25, start_with_spreads=True, buying_delay=buying_delay, selling_delay=selling_delay, strikes_above=strikes_above,
+        expiration_length=State.OptionLength.Monthly, option_type=option_type, spread_type=spread_type)
     strategy.set_buying_conditions(
-        Conditions.IsLowForPeriod(portfolio, sd=0, week_length=5))
+        Conditions.IsLowForPeriod(portfolio, sd=sd, week_length=week_length))
     return strategy
 
 
 def construct_short_strategy(asset_list, portfolio, buying_allocation, buying_delay, selling_delay, spread_width=1,
-                             option_type='P', spread_type='debit', strikes_above=0, expiration_length=State.OptionLength.Monthly):
+                             option_type='P', spread_type='debit', strikes_above=0, expiration_length=State.OptionLength.Monthly,
+                             sd=0, week_length=7):
     strategy = State.HoldingsStrategy(
         "Going short at highs", asset_list, assets=State.Assets.Options, buying_allocation=buying_allocation, selling_allocation=1,
         maximum_allocation_per_stock=0.15, start_with_spreads=True, buying_delay=buying_delay, selling_delay=selling_delay, strikes_above=strikes_above,
-        expiration_length=State.OptionLength.Monthly, option_type=option_type, spread_type=spread_type, spread_width=spread_width)
+        expiration_length=expiration_length, option_type=option_type, spread_type=spread_type, spread_width=spread_width)
     strategy.set_buying_conditions(
-        Conditions.IsHighForPeriod(portfolio, sd=0, week_length=7))
+        Conditions.IsHighForPeriod(portfolio, sd=sd, week_length=week_length))
     return strategy
 
 
-def backtest_strategy(asset_list, start_date, end_date):
-    portfolio = State.Portfolio(initial_cash=10000, trading_fees=5.00)
+STRATEGY_PARAMETERS = {
+    "initial_cash": 10000,
+    "trading_fees": 5.00,
+    "fill_model": "perfect",
+    "long_buying_allocation": 3,
+    "long_buying_delay": 4,
+    "long_selling_delay": 2,
+    "long_strikes_above": 1,
+    "long_sd": 0,
+    "long_week_length": 5,
+    "short_buying_allocation": 2,
+    "short_buying_delay": 6,
+    "short_selling_delay": 1,
+    "short_strikes_above": -1,
+    "short_spread_width": 2,
+    "short_sd": 0,
+    "short_week_length": 7,
+    "nega_end_selling_delay": 3,
+    "target_percent_gain": 0.5,
+}
+
+
+def extend_backtest(checkpoint_directory, end_date=None, plot=False, interval=100, keep_last=None, profiler=None):
+    """
+    Extends a finished backtest to end_date (default: today) without replaying its history.
+
+    The run must have been made with a Checkpointer writing to checkpoint_directory. Its
+    last checkpoint (the end-of-run state) is loaded, the price data is reloaded to pick
+    up the new bars, and only the bars after it are simulated. The new end-of-run state
+    is checkpointed to the same directory, ready for the next extension. If profiler (a
+    Profiling.Profiler) is given, the extension, reload included, is instrumented.
+
+    Returns: the state at the end of the backtest
+    """
+    if end_date is None:
+        end_date = str(datetime.date.today())
+    with Profiling.running(profiler):
+        checkpoint = Checkpoint.load_checkpoint(checkpoint_directory)
+        State.HoldingsStrategy.load_assets(
+            checkpoint["state"].get_assets(), reload=True)
+        checkpointer = Checkpoint.Checkpointer(
+            checkpoint_directory, interval, keep_last)
+        return resume_backtest(checkpoint, end_date, plot, checkpointer, profiler)
+
+
+def backtest_strategy(asset_list, start_date, end_date, plot=True, cache=None, checkpointer=None, pruner=None,
+                      profiler=None, **params):
+    """
+    Backtests the long/short options strategy on asset_list from start_date to end_date.
+
+    Any keyword in STRATEGY_PARAMETERS can be passed to override its default, e.g.
+    fill_model="simulated" to fill with Fills.SimulatedFill instead of at the quoted
+    price for trading_fees per fill. If cache
+    (a ResultCache) is given, an identical earlier run is returned from it instead of
+    being replayed. If pruner (a Pruning.EquityPruner) is given, the run stops early once
+    its equity falls below the pruner's thresholds, and is not cached. If profiler (a
+    Profiling.Profiler) is given, the run is instrumented from the loading of its price
+    data on, and its report is logged at the end.
+
+    Returns: the state at the end of the backtest
+    """
+    unknown_params = set(params) - set(STRATEGY_PARAMETERS)
+    if unknown_params:
+        Helper.log_error(f"Unknown strategy parameters: {sorted(unknown_params)}")
+    with Profiling.running(profiler):
+        return _backtest_strategy(asset_list, start_date, end_date, plot, cache, checkpointer, pruner,
+                                  profiler, params)
+
+
+def _backtest_strategy(asset_list, start_date, end_date, plot, cache, checkpointer, pruner, profiler, params):
+    params = {**STRATEGY_PARAMETERS, **params}
+    fill_model = Fills.FILL_MODELS[params["fill_model"]]() \
+        if params["fill_model"] != "perfect" else None
+    portfolio = State.Portfolio(
+        initial_cash=params["initial_cash"], trading_fees=params["trading_fees"], fill_model=fill_model)
     date1 = [int(x) for x in re.split(r'[\-]', start_date)]
     date1_obj = datetime.date(date1[0], date1[1], date1[2])
     state = State.BacktestingState(
         asset_list, portfolio, date1_obj, State.Resolution.Daily)
     call_strategy = construct_long_strategy(
-        asset_list, portfolio, buying_allocation=3, buying_delay=4, selling_delay=2, strikes_above=1)
+        asset_list, portfolio, buying_allocation=params["long_buying_allocation"], buying_delay=params["long_buying_delay"],
+        selling_delay=params["long_selling_delay"], strikes_above=params["long_strikes_above"],
+        sd=params["long_sd"], week_length=params["long_week_length"])
     state.add_strategy(call_strategy)
     put_strategy = construct_short_strategy(
-        asset_list, portfolio, buying_allocation=2, buying_delay=6, selling_delay=1, strikes_above=-1,
-        expiration_length=State.OptionLength.TwoMonthly, spread_width=2)
+        asset_list, portfolio, buying_allocation=params["short_buying_allocation"], buying_delay=params["short_buying_delay"],
+        selling_delay=params["short_selling_delay"], strikes_above=params["short_strikes_above"],
+        expiration_length=State.OptionLength.TwoMonthly, spread_width=params["short_spread_width"],
+        sd=params["short_sd"], week_length=params["short_week_length"])
     state.add_strategy(put_strategy)
     buy_nega_end_strategy = sell_booming_nega_end(
-        asset_list, portfolio, selling_allocation=1, selling_delay=3, target_percent_gain=0.5)
+        asset_list, portfolio, selling_allocation=1, selling_delay=params["nega_end_selling_delay"],
+        target_percent_gain=params["target_percent_gain"])
     state.add_strategy(buy_nega_end_strategy)
 
     resolution = State.Resolution.Daily
-    backtest(asset_list, start_date, end_date,
-             resolution, 'all', state)
+    if cache is not None:
+        key = cache.make_key(state, start_date, end_date, resolution)
+        cached_state = cache.get(key)
+        if cached_state is not None:
+            Helper.log_info(f"Loaded backtest {key} from the result cache")
+            if profiler is not None:
+                profiler.stop()
+            return cached_state
+    state = backtest(asset_list, start_date, end_date,
+                     resolution, 'all', state, plot=plot, checkpointer=checkpointer, pruner=pruner,
+                     profiler=profiler)
+    if cache is not None and not (pruner is not None and pruner.is_pruned()):
+        cache.put(key, state)
+    return state
 
 
 if __name__ == "__main__":
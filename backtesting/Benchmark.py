@@ -0,0 +1,325 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import Backtesting
+import Conditions
+import Fills
+import State
+import Synthetic
+import tradier
+
+# Benchmarks of the backtest engine on synthetic data. Every universe is generated from
+# a fixed seed and put straight into the price matrix, and option prices are modelled
+# (OptionPricing.Model), so a run needs neither the network nor the price_data
+# directory and prices the same on every machine. Results are written as JSON, one
+# record per benchmark, and two result files can be compared with compare. The fetch
+# benchmarks time the Tradier client against a local Synthetic.FakeTradierServer.
+
+START_DATE = '2020-01-01'
+END_DATE = '2020-07-01'
+DAILY_SIZES = (1, 4, 16)
+HOURLY_SIZES = (1, 4)
+QUICK_DAILY_SIZES = (1, 4)
+QUICK_HOURLY_SIZES = (1,)
+
+
+def install_universe(frames):
+    """
+    Replaces the price matrix with frames and empties the option price caches
+    """
+    State.HoldingsStrategy.price_matrix = State.PriceMatrix()
+    State.HoldingsStrategy.price_matrix.add_symbols(frames)
+    clear_option_caches()
+
+
+def clear_option_caches():
+    """
+    Empties the option price caches, so the next run models its options from scratch
+    """
+    State.Holdings.options_prices.clear()
+    State.Holdings.failed_options_prices.clear()
+
+
+def get_option_symbol(underlying, cur_date, option_type='C'):
+    """
+    Returns: the OCC symbol of the option on underlying that expires on the third Friday
+    of the month after cur_date, struck at the multiple of 5 nearest to its close
+    """
+    spot = State.HoldingsStrategy.price_matrix.get_price(underlying, cur_date, "Close")
+    first = (cur_date.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+    expiration = first + datetime.timedelta(days=(4 - first.weekday()) % 7 + 14)
+    strike = max(5 * round(spot / 5), 5)
+    return f"{underlying}{expiration:%y%m%d}{option_type}{int(strike * 1000):08d}"
+
+
+def measure(function, repeat=5, number=1, setup=None):
+    """
+    Returns: the list of the seconds per call of function, averaged over number calls,
+    for each of repeat rounds. setup is called (untimed) before every round
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        times.append((time.perf_counter() - start) / number)
+    return times
+
+
+def make_result(name, group, params, times, number):
+    """
+    Returns: the record of a benchmark that took times (seconds per call) in each round
+    """
+    return {"name": name, "group": group, "params": params, "repeat": len(times), "number": number,
+            "times": times, "min": min(times), "median": statistics.median(times),
+            "mean": statistics.fmean(times)}
+
+
+def bench_backtest_daily(num_symbols, repeat):
+    """
+    Returns: the record of a full backtest_strategy run on num_symbols daily underlyings
+    """
+    symbols = Synthetic.make_symbols(num_symbols)
+    install_universe(Synthetic.make_daily_frames(symbols))
+    times = measure(lambda: Backtesting.backtest_strategy(symbols, START_DATE, END_DATE, plot=False),
+                    repeat=repeat, setup=clear_option_caches)
+    return make_result(f"backtest_strategy[daily-{num_symbols}]", "backtest",
+                       {"resolution": "daily", "num_symbols": num_symbols,
+                        "start_date": START_DATE, "end_date": END_DATE}, times, 1)
+
+
+def bench_backtest_hourly(num_symbols, repeat, days=30):
+    """
+    Returns: the record of a full hourly backtest of a crypto strategy that buys lows and
+    sells highs on num_symbols underlyings
+    """
+    symbols = Synthetic.make_symbols(num_symbols, "USD")
+    install_universe(Synthetic.make_hourly_frames(symbols))
+    start = datetime.date.fromisoformat(START_DATE)
+    end_date = str(start + datetime.timedelta(days=days))
+
+    def run():
+        portfolio = State.Portfolio(initial_cash=10000)
+        state = State.BacktestingState(symbols, portfolio, start, State.Resolution.Hourly)
+        strategy = State.HoldingsStrategy("Benchmark crypto", symbols, assets=State.Assets.Crypto,
+                                          buying_allocation=0.1, selling_allocation=0.5, buying_delay=1,
+                                          maximum_allocation_per_stock=0.5)
+        strategy.set_buying_conditions(Conditions.IsLowForPeriod(portfolio, week_length=5))
+        strategy.set_selling_conditions(Conditions.IsHighForPeriod(portfolio, week_length=5))
+        state.add_strategy(strategy)
+        Backtesting.backtest(symbols, START_DATE, end_date, State.Resolution.Hourly, 'all', state, plot=False)
+
+    times = measure(run, repeat=repeat)
+    return make_result(f"backtest[hourly-{num_symbols}]", "backtest",
+                       {"resolution": "hourly", "num_symbols": num_symbols,
+                        "start_date": START_DATE, "end_date": end_date}, times, 1)
+
+
+def bench_micro(repeat, num_symbols=16, number=1000):
+    """
+    Returns: the records of the micro-benchmarks of price lookup, condition evaluation,
+    valuation and fills on num_symbols daily underlyings
+    """
+    symbols = Synthetic.make_symbols(num_symbols)
+    install_universe(Synthetic.make_daily_frames(symbols))
+    matrix = State.HoldingsStrategy.price_matrix
+    dates = [datetime.date.fromisoformat(d) for d in matrix.get_dates() if START_DATE <= d <= END_DATE]
+    cur_date = dates[len(dates) // 2]
+    option = get_option_symbol(symbols[0], cur_date)
+    State.Holdings.get_options_data(option)
+    results = []
+    params = {"num_symbols": num_symbols}
+    results.append(make_result("get_stock_prices", "price_lookup", params, measure(
+        lambda: State.HoldingsStrategy.get_stock_prices(symbols, cur_date, "Close"),
+        repeat=repeat, number=number), number))
+    results.append(make_result("get_options_price", "price_lookup", {"symbol": option}, measure(
+        lambda: State.Holdings.get_options_price(option, cur_date, "Close"),
+        repeat=repeat, number=number), number))
+
+    condition = None
+
+    def new_condition():
+        nonlocal condition
+        condition = Conditions.IsLowForPeriod(State.Portfolio(), week_length=5)
+
+    def evaluate():
+        for d in dates:
+            condition.is_true(d, "Close")
+
+    results.append(make_result("IsLowForPeriod.is_true", "conditions", {**params, "num_bars": len(dates)},
+                               [t / len(dates) for t in measure(evaluate, repeat=repeat, setup=new_condition)],
+                               len(dates)))
+
+    portfolio = State.Portfolio(initial_cash=1e7)
+    strategy = State.HoldingsStrategy("Benchmark", symbols, assets=State.Assets.Stocks)
+    for i, symbol in enumerate(symbols):
+        if i % 2:
+            portfolio.open_shares(symbol, 10, strategy, cur_date, "Open")
+        else:
+            for option_type in ('C', 'P'):
+                portfolio.open_option(get_option_symbol(symbol, cur_date, option_type), 1, strategy,
+                                      cur_date, "Open")
+    results.append(make_result("get_portfolio_value", "valuation", params, measure(
+        lambda: portfolio.get_portfolio_value(cur_date, "Close"), repeat=repeat, number=number // 10),
+        number // 10))
+
+    for name, fill_model in (("perfect", None), ("simulated", Fills.SimulatedFill())):
+        portfolio = State.Portfolio(initial_cash=1e7, fill_model=fill_model)
+
+        def round_trip():
+            portfolio.open_shares(symbols[1], 10, strategy, cur_date, "Open")
+            portfolio.close_shares(symbols[1], 10, strategy, cur_date, "Close")
+
+        results.append(make_result(f"share_round_trip[{name}]", "fills", {"fill_model": name}, measure(
+            round_trip, repeat=repeat, number=number // 10), number // 10))
+    rng = np.random.default_rng(0)
+    prices = rng.uniform(1, 100, number)
+    quantities = rng.integers(-50, 50, number)
+    volumes = rng.uniform(100, 1000, number)
+    multipliers = np.where(rng.random(number) < 0.5, 100, 1)
+    fill_model = Fills.SimulatedFill()
+    results.append(make_result("SimulatedFill.fill", "fills", {"num_orders": number}, measure(
+        lambda: fill_model.fill(prices, quantities, volumes, multipliers), repeat=repeat, number=100), 100))
+    return results
+
+
+def bench_fetch(repeat, num_options=20):
+    """
+    Returns: the records of fetching the histories of num_options options one request at
+    a time, and their quotes in one request, from a local FakeTradierServer. This times
+    the client and its session (connection reuse and JSON decoding), not the network
+    """
+    market = Synthetic.SyntheticMarket(num_symbols=1)
+    options = market.get_option_symbols(market.get_symbols()[0])[:num_options]
+    # the bars are generated once, so only the requests are timed
+    for option in options:
+        market.get_history(option)
+    api_key = os.environ.get("TRADIER_API_KEY")
+    os.environ["TRADIER_API_KEY"] = "Bearer benchmark"
+    params = {"num_options": len(options)}
+    try:
+        with Synthetic.FakeTradierServer(market) as server:
+            base_url = tradier.set_base_url(server.get_url())
+            try:
+                results = [make_result("tradier.get_history", "fetch", params, [t / len(options) for t in measure(
+                    lambda: [tradier.get_history(option) for option in options], repeat=repeat)], len(options)),
+                    make_result("tradier.get_quotes", "fetch", params, measure(
+                        lambda: tradier.get_quotes(options), repeat=repeat), 1)]
+            finally:
+                tradier.set_base_url(base_url)
+    finally:
+        if api_key is None:
+            del os.environ["TRADIER_API_KEY"]
+        else:
+            os.environ["TRADIER_API_KEY"] = api_key
+    return results
+
+
+def get_environment():
+    """
+    Returns: the commit, interpreter and library versions the benchmarks ran on
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(Path(__file__).absolute()),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "numpy": np.__version__,
+            "pandas": pd.__version__, "platform": platform.platform(),
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds")}
+
+
+def run_benchmarks(quick=False, name_filter=None, repeat=None):
+    """
+    Runs every benchmark whose name contains name_filter (default: all), where the
+    micro-benchmarks are named micro and the
+    client benchmarks fetch. quick runs fewer universe sizes and rounds.
+
+    Returns: the results, a dict of the environment and the list of benchmark records
+    """
+    repeat = repeat or (1 if quick else 3)
+    daily_sizes = QUICK_DAILY_SIZES if quick else DAILY_SIZES
+    hourly_sizes = QUICK_HOURLY_SIZES if quick else HOURLY_SIZES
+    benchmarks = [(f"backtest_strategy[daily-{n}]", lambda n=n: [bench_backtest_daily(n, repeat)])
+                  for n in daily_sizes]
+    benchmarks += [(f"backtest[hourly-{n}]", lambda n=n: [bench_backtest_hourly(n, repeat)])
+                   for n in hourly_sizes]
+    benchmarks.append(("micro", lambda: bench_micro(max(repeat, 3))))
+    benchmarks.append(("fetch", lambda: bench_fetch(max(repeat, 3))))
+    matrix = State.HoldingsStrategy.price_matrix
+    option_pricing = State.Holdings.option_pricing
+    State.Holdings.option_pricing = State.OptionPricing.Model
+    records = []
+    try:
+        for name, benchmark in benchmarks:
+            if name_filter is not None and name_filter not in name:
+                continue
+            # the engine prints every fill, which would be timed too
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                results = benchmark()
+            for result in results:
+                print(f"{result['name']:45s} median {result['median'] * 1e3:12.4f} ms", file=sys.stderr)
+            records.extend(results)
+    finally:
+        State.HoldingsStrategy.price_matrix = matrix
+        State.Holdings.option_pricing = option_pricing
+        clear_option_caches()
+    return {"environment": get_environment(), "benchmarks": records}
+
+
+def compare(old_results, new_results, threshold=0.1):
+    """
+    Returns: a dataframe of the median time of every benchmark in both results (dicts as
+    returned by run_benchmarks), their ratio new / old, and whether it is a regression
+    (slower by more than threshold) or an improvement (faster by more than threshold)
+    """
+    old = {record["name"]: record["median"] for record in old_results["benchmarks"]}
+    new = {record["name"]: record["median"] for record in new_results["benchmarks"]}
+    rows = [{"name": name, "old": old[name], "new": new[name], "ratio": new[name] / old[name]}
+            for name in new if name in old]
+    table = pd.DataFrame(rows, columns=["name", "old", "new", "ratio"])
+    table["change"] = np.select([table["ratio"] > 1 + threshold, table["ratio"] < 1 - threshold],
+                                ["regression", "improvement"], "")
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the backtest engine on synthetic data")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--output", help="the JSON file to write the results to")
+    run_parser.add_argument("--quick", action="store_true", help="run fewer sizes and rounds")
+    run_parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    run_parser.add_argument("--repeat", type=int, help="the number of rounds of every benchmark")
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+    if args.command == "run":
+        results = run_benchmarks(quick=args.quick, name_filter=args.filter, repeat=args.repeat)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        else:
+            json.dump(results, sys.stdout, indent=2)
+    else:
+        with open(args.old) as f:
+            old_results = json.load(f)
+        with open(args.new) as f:
+            new_results = json.load(f)
+        table = compare(old_results, new_results, args.threshold)
+        print(table.to_string(index=False))
+        sys.exit(1 if (table["change"] == "regression").any() else 0)
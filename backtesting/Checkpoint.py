@@ -0,0 +1,88 @@
+import datetime
+import os
+import pickle
+import re
+import zlib
+import Helper
+
+CHECKPOINT_FORMAT = 1
+
+
+class Checkpointer(object):
+    """
+    A class that periodically snapshots a running backtest to disk.
+
+    A checkpoint holds the whole engine state: the BacktestingState (portfolio holdings and
+    cash, strategy bookkeeping, conditions and equity history) and the clock. It is
+    pickled and zlib-compressed into one file per checkpoint, named after the date it was
+    taken on, so that a run can be resumed from the last one or forked from any of them.
+    """
+
+    def __init__(self, directory, interval=100, keep_last=None):
+        self._directory = directory
+        self._interval = interval
+        self._keep_last = keep_last
+        os.makedirs(directory, exist_ok=True)
+
+    def get_directory(self):
+        """
+        Returns: the directory the checkpoints are written to
+        """
+        return self._directory
+
+    def is_due(self, current_epoch):
+        """
+        Returns: True if a checkpoint should be taken before running current_epoch
+        """
+        return current_epoch % self._interval == 0
+
+    def save(self, state, resolution, date1_obj, epochs, current_time, current_epoch, asset_list):
+        """
+        Saves a checkpoint of the backtest as it is before running current_epoch.
+
+        Returns: the path of the checkpoint
+        """
+        current_date = date1_obj + \
+            datetime.timedelta(days=current_epoch // resolution)
+        checkpoint = {"format": CHECKPOINT_FORMAT, "state": state, "resolution": resolution,
+                      "date1_obj": date1_obj, "epochs": epochs, "current_time": current_time,
+                      "current_epoch": current_epoch, "asset_list": asset_list}
+        path = os.path.join(self._directory,
+                            f"{current_date}-{current_epoch:08d}.ckpt")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(pickle.dumps(
+                checkpoint, protocol=pickle.HIGHEST_PROTOCOL)))
+        os.replace(tmp_path, path)
+        if self._keep_last is not None:
+            for old_path in list_checkpoints(self._directory)[:-self._keep_last]:
+                os.remove(old_path)
+        return path
+
+
+def list_checkpoints(directory):
+    """
+    Returns: the paths of the checkpoints in directory, oldest first
+    """
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if re.match(r"\d{4}-\d{2}-\d{2}-\d{8}\.ckpt$", name))
+
+
+def load_checkpoint(path, before_date=None):
+    """
+    Returns: the checkpoint at path. If path is a directory, the latest checkpoint in it,
+    or the latest one taken on or before before_date if it is given.
+    """
+    if os.path.isdir(path):
+        paths = list_checkpoints(path)
+        if before_date is not None:
+            paths = [p for p in paths if os.path.basename(p)[:10] <= str(before_date)]
+        if not paths:
+            Helper.log_error(f"No checkpoint found in {path}")
+        path = paths[-1]
+    with open(path, 'rb') as f:
+        checkpoint = pickle.loads(zlib.decompress(f.read()))
+    if checkpoint.get("format") != CHECKPOINT_FORMAT:
+        Helper.log_error(f"Unsupported checkpoint format in {path}")
+    Helper.log_info(f"Loaded checkpoint {path}")
+    return checkpoint
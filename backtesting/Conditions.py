@@ -1,10 +1,7 @@
 from abc import ABC, abstractmethod
-import pandas as pd
-from datetime import date, datetime, timedelta
-import re
-import sys
+import numpy as np
 import State
-import Helper
+import Signals
 
 
 class Condition(ABC):
@@ -13,10 +10,10 @@ class Condition(ABC):
 
     This class is the parent class of all conditions. A condition is simply a predicate. The predicate determines whether a holding
     """
+    config_exclude = ("_portfolio",)
 
     def __init__(self, portfolio):
         self._portfolio = portfolio
-        self._asset_info = State.HoldingsStrategy.stock_info
 
     @abstractmethod
     def is_true(self):
@@ -25,19 +22,41 @@ class Condition(ABC):
         """
         return False
 
+    def get_asset_info(self):
+        """
+        Returns: the price matrix of the universe this condition is evaluated on
+        """
+        return State.HoldingsStrategy.price_matrix
+
+    def get_config(self):
+        """
+        Returns: the name and parameters of this condition
+        """
+        config = {key: value for key, value in vars(self).items()
+                  if key not in self.config_exclude}
+        config["condition"] = type(self).__name__
+        return config
+
 
 class TimePeriodCondition(Condition):
     """
     Condition parent class for conditions that has to deal with a stock's price
     within a time period.
+
+    The condition is evaluated for every symbol of the universe at once with the
+    incremental signal shared with forwardtesting (see Signals). The signal is fed the
+    bars of the price matrix it has not seen yet before each evaluation.
     """
+    config_exclude = Condition.config_exclude + ("_signal", "_last_row")
+    signal_class = None
 
-    def __init__(self, portfolio, sd=0, week_length=5):
+    def __init__(self, portfolio, sd=0, week_length=5, asset_list=None):
         super().__init__(portfolio)
         self._standard_deviation = sd
         self._week_length = week_length
-        self._changing_week_data = dict()
-        self._changing_day_data = pd.DataFrame()
+        self._asset_list = asset_list
+        self._signal = None
+        self._last_row = None
 
     def get_week_length(self):
         """
@@ -45,137 +64,111 @@ class TimePeriodCondition(Condition):
         """
         return self._week_length
 
-    def warm_up_data(self, stock_name, datapoint):
-        """
-        Warms-p changing_data to be prefilled with values.
-        """
-        if not stock_name in self._changing_week_data:
-            dataframe = self._asset_info[stock_name]
-            today = datapoint.name
-            if type(today) == pd._libs.tslibs.timestamps.Timestamp:
-                today = today.strftime("%Y/%m/%d")
-            date_arr = [int(x) for x in re.split(r'[\-/]', today)]
-            date_obj = date(date_arr[0], date_arr[1], date_arr[2])
-            tmp_dict = {}
-            i = 0
-            while len(tmp_dict) < self._week_length:
-                i -= 1
-                delta = timedelta(days=i)
-                tmp_date = (date_obj + delta).strftime("%Y-%m-%d")
-                try:
-                    tmp_dict[tmp_date] = dataframe.loc[tmp_date]
-                except KeyError:
-                    pass
-            # print(tmp_dict)
-            # print('index', tmp_dict.values())
-            df = pd.DataFrame(tmp_dict.values(), index=tmp_dict.keys(),
-                              columns=("Low", "Open", "Close", "High", "Volume", "Adj Close"))
-            df.sort_index(inplace=True)
-            self._changing_week_data[stock_name] = df
-            # print(self._changing_week_data[stock_name])
-
-    def add_datapoint(self, stock_name, datapoint):
-        """
-        Adds a datapoint to the changing data.
-        """
-        # print("before", self._changing_week_data)
-        self._changing_week_data[stock_name] = self._changing_week_data[stock_name][1:]
-        # print('during', self._changing_week_data)
-        self._changing_week_data[stock_name] = self._changing_week_data[stock_name].append(
-            datapoint)
-        # print('after', self._changing_week_data)
-        # print(datapoint)
-        if len(self._changing_week_data[stock_name]) < self._week_length:
-            assert False
+    def get_symbols(self):
+        """
+        Returns: the symbols this condition is evaluated on. Default: the whole universe
+        """
+        if self._asset_list is None:
+            return self.get_asset_info().get_symbols()
+        return self._asset_list
 
+    def get_closes(self, start_row, end_row):
+        """
+        Returns: the (row x symbol) array of closing prices from start_row to end_row
+        """
+        closes = self.get_asset_info().get_field("Close")[start_row:end_row]
+        if self._asset_list is not None:
+            closes = closes[:, self.get_asset_info().get_symbol_indices(
+                self._asset_list)]
+        return closes
 
-class IsHighForPeriod(TimePeriodCondition):
-    """
-    Condition: Is True if the stock is low for the week (+/- n standard
-    deviations). False otherwise
-    """
+    def sync_signal(self, row):
+        """
+        Feeds the signal every bar before row that it has not seen yet
+        """
+        symbols = self.get_symbols()
+        if self._signal is None or self._signal.get_symbols() != list(symbols):
+            self._signal = self.signal_class(
+                symbols, self._standard_deviation, self._week_length)
+            self._last_row = None
+        if self._last_row is None or row <= self._last_row or row - self._last_row > self._week_length:
+            self._signal.warm_up(self.get_closes(
+                max(row - self._week_length, 0), row))
+        else:
+            for closes in self.get_closes(self._last_row + 1, row):
+                self._signal.add_bar(closes)
+        self._last_row = row - 1
 
-    def __init__(self, portfolio, sd=0, week_length=5):
-        super().__init__(portfolio, sd, week_length)
+    def get_current_prices(self, current_date, current_time):
+        """
+        Returns: (row, prices) for today's bar, or (None, None) if there is no bar today
+        """
+        row = self.get_asset_info().get_row(current_date, exact=True)
+        if row is None:
+            return None, None
+        prices = self.get_asset_info().get_field(str(current_time))[row]
+        if self._asset_list is not None:
+            prices = prices[self.get_asset_info().get_symbol_indices(
+                self._asset_list)]
+        return row, np.round(prices, 2)
 
-    def is_true(self, current_date, current_time):
+    def signals_to_dict(self, mask, prices, current_date, current_time):
         """
-        Helper function for is_true for handling stock data
+        Returns: (abool, dict) where dict maps each symbol in mask to its signal
         """
+        symbols = self.get_symbols()
         stocks_to_buy = dict()
-        for key in self._asset_info:
-            dataframe = self._asset_info[key]
-            abool = False
-            try:
-                today = dataframe.loc[str(current_date)]
-                self.warm_up_data(key, today)
-                current_price = round(
-                    today.loc[str(current_time)], 2)
-                highest_price = self._changing_week_data[key]["Close"].max()
-
-                # print(current_date, current_price, key, highest_price,
-                #       (self._standard_deviation * self._changing_week_data[key]["Close"].std()))
-                if current_price > highest_price + (self._standard_deviation * self._changing_week_data[key]["Close"].std()):
-                    abool = True
-                    stocks_to_buy[key] = (
-                        current_date, current_time, current_price)
-                if current_time.is_eod():
-                    # print("Is eod")
-                    self.add_datapoint(key, today)
-            except KeyError as e:
-                print("Exception", e)
-        if abool:
-            return abool, stocks_to_buy
+        for i in np.flatnonzero(mask):
+            stocks_to_buy[symbols[i]] = (
+                current_date, current_time, prices[i])
+        if stocks_to_buy:
+            return True, stocks_to_buy
         else:
-            return abool, None
+            return False, None
+
+    def is_true(self, current_date, current_time):
+        """
+        Returns: (True, dict of stocks) if the signal is true for any stock. (False, None) otherwise
+        """
+        row, current_prices = self.get_current_prices(
+            current_date, current_time)
+        if row is None:
+            return False, None
+        self.sync_signal(row)
+        mask = self._signal.is_true(current_prices)
+        return self.signals_to_dict(mask, current_prices, current_date, current_time)
 
 
-class IsLowForPeriod(TimePeriodCondition):
+class IsHighForPeriod(TimePeriodCondition):
     """
-    Condition: Is True if the stock is low for the week (+/- n standard
+    Condition: Is True if the stock is high for the week (+/- n standard
     deviations). False otherwise
     """
+    signal_class = Signals.HighForPeriod
 
-    def __init__(self, portfolio, sd=0, week_length=5):
-        super().__init__(portfolio, sd, week_length)
-
-    def is_true(self, current_date, current_time):
-        """
-        Helper function for is_true for handling stock data
-        """
-        stocks_to_buy = dict()
-        for key in self._asset_info:
-            dataframe = self._asset_info[key]
-            abool = False
-            try:
-                today = dataframe.loc[str(current_date)]
-                self.warm_up_data(key, today)
-                current_price = round(
-                    today.loc[str(current_time)], 2)
-                lowest_price = self._changing_week_data[key]["Close"].min()
-
-                # print(current_date, current_price, key, lowest_price,
-                #       (self._standard_deviation * self._changing_week_data[key]["Close"].std()))
-                if current_price < lowest_price + (self._standard_deviation * self._changing_week_data[key]["Close"].std()):
-                    abool = True
-                    stocks_to_buy[key] = (
-                        current_date, current_time, current_price)
-                if current_time.is_eod():
-                    # print("Is eod")
-                    self.add_datapoint(key, today)
-            except KeyError as e:
-                print("Exception", e)
-        if abool:
-            return abool, stocks_to_buy
-        else:
-            return abool, None
+    def __init__(self, portfolio, sd=0, week_length=5, asset_list=None):
+        super().__init__(portfolio, sd, week_length, asset_list)
 
 
-class NegaEndIsUpNPercent(Condition):
+class IsLowForPeriod(TimePeriodCondition):
     """
     Condition: Is True if the stock is low for the week (+/- n standard
     deviations). False otherwise
     """
+    signal_class = Signals.LowForPeriod
+
+    def __init__(self, portfolio, sd=0, week_length=5, asset_list=None):
+        super().__init__(portfolio, sd, week_length, asset_list)
+
+
+class OptionGainCondition(Condition):
+    """
+    Condition parent class for conditions on the gain of the option positions on one side
+    (long for side 1, short for side -1) of the portfolio since they were opened.
+
+    Every position on the side is priced and compared at once.
+    """
+    side = 1
 
     def __init__(self, portfolio, target_percent_gain=0.6):
         super().__init__(portfolio)
@@ -183,49 +176,42 @@ class NegaEndIsUpNPercent(Condition):
 
     def is_true(self, current_date, current_time):
         """
-        Helper function for is_true for handling stock data
-        """
-        holdings = self._portfolio.get_holdings()
-        abool = False
-        # print("HERE", holdings)
-        stocks_to_sell = dict()
-        for holding_key in holdings:
-            positions = holdings[holding_key].get_positions()
-            for position_key in positions:
-                position_info = positions[position_key]
-                # if it is a nega-end
-                if position_info[0] < 0:
-                    current_price = State.Holdings.get_options_price(position_key,
-                                                                     current_date, current_time)
-                    original_price = position_info[1]
-
-                    if (original_price - current_price) / original_price > self._percent_gain:
-                        abool = True
-                        stocks_to_sell[position_key] = (
-                            current_date, current_time, current_price)
-
-        if abool:
-            return abool, stocks_to_sell
+        Returns: (True, dict of options) if any option position on the side has gained
+        more than the target percent of its entry price. (False, None) otherwise
+        """
+        symbols, quantities, entry_prices = self._portfolio.get_option_positions()
+        on_side = np.flatnonzero(np.sign(quantities) == self.side)
+        if not len(on_side):
+            return False, None
+        symbols = [symbols[i] for i in on_side]
+        current_prices = self._portfolio.get_position_prices(
+            symbols, np.ones(len(symbols), dtype=bool), current_date, current_time)
+        gains = self.side * (current_prices - entry_prices[on_side]) / entry_prices[on_side]
+        stocks_to_sell = {symbols[i]: (current_date, current_time, current_prices[i])
+                          for i in np.flatnonzero(gains > self._percent_gain)}
+        if stocks_to_sell:
+            return True, stocks_to_sell
         else:
-            return abool, None
+            return False, None
 
 
-class HasPosaEndThatsBooming(Condition):
+class NegaEndIsUpNPercent(OptionGainCondition):
     """
-    Condition: Is True if the stock is low for the week (+/- n standard
-    deviations). False otherwise
+    Condition: Is True if a short option position (nega-end) has gained more than the
+    target percent of its premium, i.e. its price has dropped by that much. False otherwise
     """
+    side = -1
 
     def __init__(self, portfolio, target_percent_gain=0.6):
-        super().__init__(portfolio)
-        self._percent_gain = target_percent_gain
+        super().__init__(portfolio, target_percent_gain)
 
-    def is_true(self, current_date, current_time):
-        """
-        Helper function for is_true for handling stock data
-        """
-        holdings = self._portfolio.get_holdings()
-        # print("HERE", holdings)
-        abool = False
-        stocks_to_sell = dict()
-        Helper.log_error("Unimplemented")
+
+class HasPosaEndThatsBooming(OptionGainCondition):
+    """
+    Condition: Is True if a long option position (posa-end) has gained more than the
+    target percent of its premium. False otherwise
+    """
+    side = 1
+
+    def __init__(self, portfolio, target_percent_gain=0.6):
+        super().__init__(portfolio, target_percent_gain)
@@ -0,0 +1,129 @@
+from abc import ABC, abstractmethod
+import numpy as np
+
+# A fill model takes the orders (or the legs of one order) to fill on a bar as vectors:
+# the quoted price of each one (its label price on the bar), its signed quantity
+# (positive to buy, negative to sell), the volume of the bar (nan if unknown) and its
+# contract multiplier (100 for options, 1 for shares). Everything is computed for all
+# orders at once, so a model costs a few array operations per fill.
+
+
+class FillModel(ABC):
+    """
+    Abstract class representing how a broker fills orders.
+    """
+
+    # Whether fill needs the volume of the bar. Models that don't use it spare the
+    # portfolio from looking it up
+    uses_volume = True
+
+    def get_config(self):
+        """
+        Returns: the parameters that determine the fills of this model
+        """
+        return {"model": type(self).__name__,
+                **{name.lstrip('_'): value for name, value in vars(self).items()}}
+
+    def get_max_carry_bars(self):
+        """
+        Returns: the number of later bars the unfilled part of an order is carried over to
+        before it is cancelled
+        """
+        return 0
+
+    @abstractmethod
+    def fill(self, prices, quantities, volumes, multipliers, fractional=False):
+        """
+        Returns: (fill_prices, filled_quantities, commission), the vector of prices per
+        share each order fills at, the vector of signed quantities filled and the total
+        commission of the fill. If fractional is False only whole quantities are filled.
+        """
+        pass
+
+
+class PerfectFill(FillModel):
+    """
+    Fills every order in full at its quoted price, for a flat fee per fill whatever its
+    size. This is the default.
+    """
+
+    uses_volume = False
+
+    def __init__(self, fee_per_fill=0.75):
+        self._fee_per_fill = fee_per_fill
+
+    def fill(self, prices, quantities, volumes, multipliers, fractional=False):
+        quantities = np.asarray(quantities, dtype=float)
+        commission = self._fee_per_fill if np.any(quantities != 0) else 0.0
+        return np.asarray(prices, dtype=float), quantities, commission
+
+
+class SimulatedFill(FillModel):
+    """
+    Fills orders the way a market would.
+
+    Buys pay half the estimated bid/ask spread above the quoted price and sells receive
+    half of it below. An order fills at most participation of the volume of the bar, and
+    the rest is carried over to the next max_carry_bars bars. The part that fills moves
+    the price against it along a power-law impact curve (square root by default):
+    impact x price x (filled / volume) ^ impact_exponent, where impact is about the daily
+    volatility of the asset. Commissions are charged per
+    share and per contract, with a minimum per fill.
+
+    Bars without a volume (no data, or no trades reported) don't cap the order or add
+    impact, so model-priced options fill in full at the spread.
+    """
+
+    def __init__(self, stock_spread=0.0005, option_spread=0.05, minimum_option_spread=0.05,
+                 commission_per_share=0.0, commission_per_contract=0.65, minimum_commission=0.0,
+                 participation=0.1, impact=0.02, impact_exponent=0.5, max_carry_bars=5, tick=0.01):
+        self._stock_spread = stock_spread
+        self._option_spread = option_spread
+        self._minimum_option_spread = minimum_option_spread
+        self._commission_per_share = commission_per_share
+        self._commission_per_contract = commission_per_contract
+        self._minimum_commission = minimum_commission
+        self._participation = participation
+        self._impact = impact
+        self._impact_exponent = impact_exponent
+        self._max_carry_bars = max_carry_bars
+        self._tick = tick
+
+    def get_max_carry_bars(self):
+        return self._max_carry_bars
+
+    def get_spreads(self, prices, multipliers):
+        """
+        Returns: the vector of estimated bid/ask spreads (per share) of the quoted prices.
+        Stocks and crypto are quoted at a fraction of their price, options at a fraction of
+        their premium but no tighter than the minimum option spread
+        """
+        prices = np.asarray(prices, dtype=float)
+        return np.where(np.asarray(multipliers) > 1,
+                        np.maximum(prices * self._option_spread, self._minimum_option_spread),
+                        prices * self._stock_spread)
+
+    def fill(self, prices, quantities, volumes, multipliers, fractional=False):
+        prices = np.asarray(prices, dtype=float)
+        quantities = np.asarray(quantities, dtype=float)
+        volumes = np.broadcast_to(np.asarray(volumes, dtype=float), prices.shape)
+        multipliers = np.broadcast_to(np.asarray(multipliers), prices.shape)
+        sides = np.sign(quantities)
+        has_volume = np.isfinite(volumes) & (volumes > 0)
+        caps = np.where(has_volume, self._participation * volumes, np.inf)
+        if not fractional:
+            caps = np.floor(caps)
+        filled = np.minimum(np.abs(quantities), caps)
+        participation = np.where(has_volume, filled / np.where(has_volume, volumes, 1), 0)
+        slippage = self.get_spreads(prices, multipliers) / 2 + \
+            self._impact * prices * participation ** self._impact_exponent
+        fill_prices = np.maximum(
+            np.round((prices + sides * slippage) / self._tick) * self._tick, self._tick)
+        commission = float(np.dot(np.where(multipliers > 1, self._commission_per_contract,
+                                           self._commission_per_share), filled))
+        if np.any(filled > 0):
+            commission = max(commission, self._minimum_commission)
+        return fill_prices, sides * filled, commission
+
+
+FILL_MODELS = {"perfect": PerfectFill, "simulated": SimulatedFill}
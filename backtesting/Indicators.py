@@ -0,0 +1,391 @@
+from abc import ABC, abstractmethod
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from Signals import RollingWindow
+
+# Batch indicators take a (bar x symbol) array ordered oldest first and return arrays of
+# the same shape, nan until enough bars have been seen. Streaming indicators take one bar
+# (a vector with one value per symbol) at a time and return the indicator for that bar,
+# so feeding a streaming indicator every row of a matrix reproduces the batch form.
+
+
+def _windows(values, length):
+    """
+    Returns: values as an array and a (bar - length + 1 x symbol x length) view of its
+    rolling windows
+    """
+    values = np.asarray(values, dtype=float)
+    return values, sliding_window_view(values, length, axis=0)
+
+
+def _pad(values, result, length):
+    """
+    Returns: result preceded by length - 1 rows of nan, in the shape of values
+    """
+    out = np.full(values.shape, np.nan)
+    out[length - 1:] = result
+    return out
+
+
+def sma(values, length):
+    """
+    Returns: the simple moving average of values over length bars
+    """
+    values, windows = _windows(values, length)
+    return _pad(values, windows.mean(axis=-1), length)
+
+
+def rolling_std(values, length, ddof=1):
+    """
+    Returns: the standard deviation of values over length bars
+    """
+    values, windows = _windows(values, length)
+    return _pad(values, windows.std(axis=-1, ddof=ddof), length)
+
+
+def ema(values, length, alpha=None):
+    """
+    Returns: the exponential moving average of values, seeded with the simple moving
+    average of the first length bars. alpha defaults to 2 / (length + 1)
+    """
+    values = np.asarray(values, dtype=float)
+    alpha = 2 / (length + 1) if alpha is None else alpha
+    out = np.full(values.shape, np.nan)
+    if len(values) < length:
+        return out
+    out[length - 1] = values[:length].mean(axis=0)
+    for i in range(length, len(values)):
+        out[i] = out[i - 1] + alpha * (values[i] - out[i - 1])
+    return out
+
+
+def bollinger_bands(values, length=20, num_std=2):
+    """
+    Returns: (middle, upper, lower), the simple moving average of values over length bars
+    and the bands num_std standard deviations above and below it
+    """
+    middle = sma(values, length)
+    std = rolling_std(values, length)
+    return middle, middle + num_std * std, middle - num_std * std
+
+
+def _wilder(values, length, start):
+    """
+    Returns: Wilder's smoothing of values over length bars, seeded with the mean of the
+    length rows of values ending at row start
+    """
+    out = np.full(values.shape, np.nan)
+    if len(values) <= start:
+        return out
+    out[start] = values[start - length + 1:start + 1].mean(axis=0)
+    for i in range(start + 1, len(values)):
+        out[i] = (out[i - 1] * (length - 1) + values[i]) / length
+    return out
+
+
+def rsi(values, length=14):
+    """
+    Returns: Wilder's relative strength index of values over length bars, between 0 and 100
+    """
+    values = np.asarray(values, dtype=float)
+    changes = np.zeros(values.shape)
+    changes[1:] = np.diff(values, axis=0)
+    average_gain = _wilder(np.maximum(changes, 0), length, length)
+    average_loss = _wilder(np.maximum(-changes, 0), length, length)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 100 - 100 / (1 + average_gain / average_loss)
+
+
+def true_range(high, low, close):
+    """
+    Returns: the true range of every bar. The first bar has no previous close, so its true
+    range is its high minus its low
+    """
+    high, low, close = (np.asarray(x, dtype=float) for x in (high, low, close))
+    ranges = high - low
+    previous_close = close[:-1]
+    ranges[1:] = np.maximum.reduce([ranges[1:], np.abs(high[1:] - previous_close),
+                                    np.abs(low[1:] - previous_close)])
+    return ranges
+
+
+def atr(high, low, close, length=14):
+    """
+    Returns: Wilder's average true range over length bars
+    """
+    return _wilder(true_range(high, low, close), length, length - 1)
+
+
+def zscore(values, length):
+    """
+    Returns: the number of standard deviations each value is from the simple moving
+    average of the last length bars (including itself)
+    """
+    values, windows = _windows(values, length)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = (values[length - 1:] - windows.mean(axis=-1)) / windows.std(axis=-1, ddof=1)
+    return _pad(values, result, length)
+
+
+def rolling_percentile(values, length):
+    """
+    Returns: the percentile rank (0 to 100) of each value among the last length bars
+    (including itself), the percentage of them that are less than or equal to it
+    """
+    values, windows = _windows(values, length)
+    current = values[length - 1:, ..., None]
+    return _pad(values, (windows <= current).mean(axis=-1) * 100, length)
+
+
+class StreamingIndicator(ABC):
+    """
+    Abstract class representing an indicator that is updated one bar at a time.
+
+    Each update costs O(symbols) (O(symbols x length) for the rolling percentile), so the
+    same indicators used to precompute a backtest can run on a live feed.
+    """
+
+    def __init__(self, num_symbols):
+        self._num_symbols = num_symbols
+        self._value = np.full(num_symbols, np.nan)
+
+    def get_value(self):
+        """
+        Returns: the indicator for the last bar, nan until enough bars have been seen
+        """
+        return self._value
+
+    @abstractmethod
+    def update(self, *values):
+        """
+        Adds a bar and returns: the indicator for it
+        """
+        pass
+
+
+class _RollingSums(object):
+    """
+    The running sum and sum of squares of the last length bars, recomputed from the window
+    every length bars so that rounding error doesn't accumulate. Nans are left out of the
+    sums and counted instead, so the statistics are nan exactly while a nan is in the
+    window, like the batch forms
+    """
+
+    def __init__(self, num_symbols, length):
+        self._window = RollingWindow(num_symbols, length)
+        self._length = length
+        self._sum = np.zeros(num_symbols)
+        self._squares = np.zeros(num_symbols)
+        self._nans = np.zeros(num_symbols, dtype=int)
+        self._steps = 0
+
+    def is_full(self):
+        return self._window.is_full()
+
+    def get_window(self):
+        return self._window
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        if self._window.is_full():
+            oldest = self._window.get_oldest()
+            missing = np.isnan(oldest)
+            oldest = np.where(missing, 0, oldest)
+            self._sum -= oldest
+            self._squares -= oldest ** 2
+            self._nans -= missing
+        self._window.add(values)
+        missing = np.isnan(values)
+        values = np.where(missing, 0, values)
+        self._sum += values
+        self._squares += values ** 2
+        self._nans += missing
+        self._steps += 1
+        if self._steps % self._length == 0:
+            window = self._window.get_values()
+            self._sum = np.nansum(window, axis=0)
+            self._squares = np.nansum(window ** 2, axis=0)
+            self._nans = np.isnan(window).sum(axis=0)
+
+    def mean(self):
+        return np.where(self._nans > 0, np.nan, self._sum / self._length)
+
+    def std(self, ddof=1):
+        variance = (self._squares - self._sum ** 2 / self._length) / (self._length - ddof)
+        return np.where(self._nans > 0, np.nan, np.sqrt(np.maximum(variance, 0)))
+
+
+class SMA(StreamingIndicator):
+    """
+    Streaming simple moving average, see sma
+    """
+
+    def __init__(self, num_symbols, length):
+        super().__init__(num_symbols)
+        self._sums = _RollingSums(num_symbols, length)
+
+    def update(self, values):
+        self._sums.add(values)
+        if self._sums.is_full():
+            self._value = self._sums.mean()
+        return self._value
+
+
+class EMA(StreamingIndicator):
+    """
+    Streaming exponential moving average, see ema
+    """
+
+    def __init__(self, num_symbols, length, alpha=None):
+        super().__init__(num_symbols)
+        self._alpha = 2 / (length + 1) if alpha is None else alpha
+        self._length = length
+        self._count = 0
+        self._seed = SMA(num_symbols, length)
+
+    def update(self, values):
+        self._count += 1
+        if self._count <= self._length:
+            self._value = self._seed.update(values)
+        else:
+            self._value = self._value + self._alpha * \
+                (np.asarray(values, dtype=float) - self._value)
+        return self._value
+
+
+class BollingerBands(StreamingIndicator):
+    """
+    Streaming Bollinger bands, see bollinger_bands. The value is (middle, upper, lower)
+    """
+
+    def __init__(self, num_symbols, length=20, num_std=2):
+        super().__init__(num_symbols)
+        self._sums = _RollingSums(num_symbols, length)
+        self._num_std = num_std
+        self._value = (self._value,) * 3
+
+    def update(self, values):
+        self._sums.add(values)
+        if self._sums.is_full():
+            middle = self._sums.mean()
+            std = self._sums.std()
+            self._value = (middle, middle + self._num_std * std,
+                           middle - self._num_std * std)
+        return self._value
+
+
+class _Wilder(object):
+    """
+    Streaming Wilder's smoothing, seeded with the mean of the first length values
+    """
+
+    def __init__(self, num_symbols, length):
+        self._length = length
+        self._count = 0
+        self._value = np.zeros(num_symbols)
+
+    def update(self, values):
+        self._count += 1
+        if self._count <= self._length:
+            self._value = self._value + values / self._length
+            if self._count < self._length:
+                return None
+        else:
+            self._value = (self._value * (self._length - 1) +
+                           values) / self._length
+        return self._value
+
+
+class RSI(StreamingIndicator):
+    """
+    Streaming relative strength index, see rsi
+    """
+
+    def __init__(self, num_symbols, length=14):
+        super().__init__(num_symbols)
+        self._gain = _Wilder(num_symbols, length)
+        self._loss = _Wilder(num_symbols, length)
+        self._last = None
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        if self._last is not None:
+            change = values - self._last
+            average_gain = self._gain.update(np.maximum(change, 0))
+            average_loss = self._loss.update(np.maximum(-change, 0))
+            if average_gain is not None:
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    self._value = 100 - 100 / (1 + average_gain / average_loss)
+        self._last = values
+        return self._value
+
+
+class ATR(StreamingIndicator):
+    """
+    Streaming average true range, see atr. update takes the high, low and close of a bar
+    """
+
+    def __init__(self, num_symbols, length=14):
+        super().__init__(num_symbols)
+        self._range = _Wilder(num_symbols, length)
+        self._last_close = None
+
+    def update(self, high, low, close):
+        high, low, close = (np.asarray(x, dtype=float)
+                            for x in (high, low, close))
+        ranges = high - low
+        if self._last_close is not None:
+            ranges = np.maximum.reduce([ranges, np.abs(high - self._last_close),
+                                        np.abs(low - self._last_close)])
+        self._last_close = close
+        average = self._range.update(ranges)
+        if average is not None:
+            self._value = average
+        return self._value
+
+
+class ZScore(StreamingIndicator):
+    """
+    Streaming z-score, see zscore
+    """
+
+    def __init__(self, num_symbols, length):
+        super().__init__(num_symbols)
+        self._sums = _RollingSums(num_symbols, length)
+
+    def update(self, values):
+        self._sums.add(values)
+        if self._sums.is_full():
+            with np.errstate(invalid='ignore', divide='ignore'):
+                self._value = (np.asarray(values, dtype=float) -
+                               self._sums.mean()) / self._sums.std()
+        return self._value
+
+
+class RollingPercentile(StreamingIndicator):
+    """
+    Streaming rolling percentile rank, see rolling_percentile
+    """
+
+    def __init__(self, num_symbols, length):
+        super().__init__(num_symbols)
+        self._window = RollingWindow(num_symbols, length)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        self._window.add(values)
+        if self._window.is_full():
+            self._value = (self._window.get_values() <= values).mean(axis=0) * 100
+        return self._value
+
+
+def stream(indicator, *matrices):
+    """
+    Returns: the values of indicator after feeding it every row of matrices, stacked into
+    arrays in the shape of the batch form
+    """
+    rows = [indicator.update(*bar) for bar in zip(*matrices)]
+    if isinstance(rows[0], tuple):
+        return tuple(np.array([row[i] for row in rows]) for i in range(len(rows[0])))
+    return np.array(rows)
+
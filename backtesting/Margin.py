@@ -0,0 +1,191 @@
+from enum import Enum
+import numpy as np
+import Pricing
+
+# Requirements are in dollars and cover the option positions on one underlying at a time.
+# Long options are paid for in full, so only positions with short legs need margin. The
+# premium received for a short option is already in the buying power, so a requirement is
+# the collateral held against it on top of the cash.
+
+# Reg-T naked short options: the option's value plus 20% of the underlying less the
+# amount it is out of the money, but at least 10% of the underlying (calls) or of the
+# strike (puts)
+NAKED_RATE = 0.20
+MINIMUM_NAKED_RATE = 0.10
+# Portfolio margin: the worst loss when the underlying moves by up to 15% either way,
+# with at least $37.50 per short contract
+STRESS_MOVES = np.linspace(-0.15, 0.15, 11)
+MINIMUM_PER_CONTRACT = 37.5
+
+
+class MarginMethod(Enum):
+    """
+    How margin requirements are computed: strategy-based Reg-T rules, or risk-based
+    portfolio margin
+    """
+    RegT = 'reg_t'
+    Portfolio = 'portfolio'
+
+
+def reg_t_requirement(spot, prices, strikes, is_call, expirations, quantities):
+    """
+    Returns: the Reg-T requirement of the option positions on one underlying. The legs of
+    each expiration are margined together, at the lower of
+
+    - the naked requirement of their short legs, and
+    - their largest loss at expiration (the spread requirement), if it is bounded
+
+    so long legs only cover short legs of the same expiration
+    """
+    quantities = np.asarray(quantities, dtype=float)
+    short = quantities < 0
+    if not short.any():
+        return 0.0
+    strikes = np.asarray(strikes, dtype=float)
+    is_call = np.asarray(is_call, dtype=bool)
+    expirations = np.asarray(expirations)
+    out_of_the_money = np.maximum(np.where(is_call, strikes - spot, spot - strikes), 0)
+    naked = 100 * -quantities * (np.asarray(prices, dtype=float) + np.maximum(
+        NAKED_RATE * spot - out_of_the_money,
+        MINIMUM_NAKED_RATE * np.where(is_call, spot, strikes)))
+    requirement = 0.0
+    for expiration in np.unique(expirations[short]):
+        legs = expirations == expiration
+        naked_requirement = float(naked[legs & short].sum())
+        payoff = Pricing.minimum_expiration_payoff(
+            strikes[legs], is_call[legs], quantities[legs])
+        if payoff is not None:
+            naked_requirement = min(naked_requirement, max(-100 * payoff, 0.0))
+        requirement += naked_requirement
+    return requirement
+
+
+def portfolio_margin_requirement(spot, prices, strikes, is_call, years, quantities,
+                                 moves=STRESS_MOVES, minimum_per_contract=MINIMUM_PER_CONTRACT):
+    """
+    Returns: the portfolio margin requirement of the option positions on one underlying,
+    the largest loss of the position when the underlying moves by each of moves (a
+    fraction of spot) and every leg is repriced with Black-Scholes at its implied
+    volatility, all in one (moves x legs) pass
+    """
+    quantities = np.asarray(quantities, dtype=float)
+    short = quantities < 0
+    if not short.any():
+        return 0.0
+    prices = np.asarray(prices, dtype=float)
+    volatility = Pricing.implied_volatility(prices, spot, strikes, years, is_call)
+    stressed = Pricing.black_scholes(spot * (1 + np.asarray(moves))[:, None], strikes, years,
+                                     volatility, is_call)
+    profits = 100 * (stressed - prices) @ quantities
+    return max(-float(profits.min()), minimum_per_contract * -quantities[short].sum(), 0.0)
+
+
+class MarginAccount(object):
+    """
+    A class representing the margin requirement of the option positions of a portfolio.
+
+    The requirement is kept per underlying along with the total. Fills change the
+    positions of one underlying, and price moves make every requirement stale; only stale
+    underlyings are recomputed the next time the requirement is asked for, so an order
+    can be checked without revaluing the rest of the book.
+
+    Prices come from a quote function passed in by the caller:
+    quote(underlying, symbols) returns the underlying's price and the vector of prices of
+    the option symbols.
+    """
+
+    def __init__(self, method=MarginMethod.RegT):
+        self._method = method
+        self._positions = {}
+        self._requirements = {}
+        self._stale = set()
+        self._total = 0.0
+
+    def get_config(self):
+        """
+        Returns: the parameters that determine the requirements of this account
+        """
+        return {"method": self._method.value}
+
+    def get_method(self):
+        """
+        Returns: the MarginMethod of this account
+        """
+        return self._method
+
+    def update_position(self, symbol, quantity):
+        """
+        Sets the position in the option symbol to quantity contracts (0 when it is closed)
+        """
+        underlying = Pricing.parse_option_symbol(symbol)[0]
+        positions = self._positions.setdefault(underlying, {})
+        if quantity == 0:
+            positions.pop(symbol, None)
+        else:
+            positions[symbol] = quantity
+        if not positions:
+            del self._positions[underlying]
+        self._stale.add(underlying)
+
+    def update_prices(self):
+        """
+        Marks every requirement stale, after prices move
+        """
+        self._stale.update(self._positions)
+
+    def _compute(self, underlying, positions, quote, cur_date, cur_time):
+        """
+        Returns: the requirement of positions, a dict of option symbol to contracts on
+        underlying
+        """
+        symbols = list(positions)
+        quantities = np.array([positions[symbol] for symbol in symbols], dtype=float)
+        if not (quantities < 0).any():
+            return 0.0
+        spot, prices = quote(underlying, symbols)
+        _, expirations, is_call, strikes = Pricing.parse_option_symbols(symbols)
+        if self._method == MarginMethod.Portfolio:
+            return portfolio_margin_requirement(
+                spot, prices, strikes, is_call,
+                Pricing.years_to_expiration(cur_date, expirations, cur_time), quantities)
+        return reg_t_requirement(spot, prices, strikes, is_call, expirations, quantities)
+
+    def get_requirement(self, quote, cur_date, cur_time):
+        """
+        Returns: the total margin requirement, recomputing the stale underlyings
+        """
+        for underlying in self._stale:
+            requirement = self._compute(underlying, self._positions[underlying], quote,
+                                        cur_date, cur_time) if underlying in self._positions else 0.0
+            self._total += requirement - self._requirements.pop(underlying, 0.0)
+            if requirement:
+                self._requirements[underlying] = requirement
+        self._stale.clear()
+        return self._total
+
+    def get_requirements(self, quote, cur_date, cur_time):
+        """
+        Returns: a dict of underlying to its margin requirement
+        """
+        self.get_requirement(quote, cur_date, cur_time)
+        return dict(self._requirements)
+
+    def get_requirement_change(self, symbols, quantities, quote, cur_date, cur_time):
+        """
+        Returns: how much the total requirement would change if quantities (signed
+        contracts) of the option symbols were added to the positions. Only the
+        underlyings of symbols are revalued
+        """
+        self.get_requirement(quote, cur_date, cur_time)
+        changes = {}
+        for symbol, quantity in zip(symbols, quantities):
+            underlying = Pricing.parse_option_symbol(symbol)[0]
+            positions = changes.setdefault(
+                underlying, dict(self._positions.get(underlying, {})))
+            positions[symbol] = positions.get(symbol, 0) + int(quantity)
+        change = 0.0
+        for underlying, positions in changes.items():
+            positions = {symbol: quantity for symbol, quantity in positions.items() if quantity}
+            change += self._compute(underlying, positions, quote, cur_date, cur_time) - \
+                self._requirements.get(underlying, 0.0)
+        return change
@@ -0,0 +1,250 @@
+import bisect
+import tempfile
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import Backtesting
+import Helper
+import State
+
+# Robustness runs: the bars of the backtest window are replaced by synthetic paths and
+# the strategy is run once per path. Paths are generated for every underlying at once as
+# (path x bar x symbol) arrays, and the history before the window is kept so conditions
+# that look back still see real data. Each path starts from the last real close before
+# the window.
+#
+# - bootstrap: a moving block bootstrap of the bars before the window. Blocks of
+#   block_size consecutive bars are drawn with the same dates for every underlying, which
+#   keeps their correlation and short-range autocorrelation (volatility clustering).
+# - gbm: geometric Brownian motion with the mean and covariance of the log returns
+#   before the window. The bars open at the previous close, and their high and low are
+#   resampled from real bars.
+#
+# Option prices are always modelled from the synthetic underlying (OptionPricing.Model):
+# market option data only exists for the real path.
+
+METHODS = ("bootstrap", "gbm")
+
+
+def get_history(matrix, symbols, end_row):
+    """
+    Returns: a dict of the per-bar log returns of symbols on the rows before end_row
+    where every symbol has a bar: "Close" (close to close), "Gap" (close to open), "High"
+    (above the higher of open and close), "Low" (below the lower of open and close, so
+    negative) and the "Volume" of the bar (nan if unknown)
+    """
+    columns = matrix.get_symbol_indices(symbols)
+    fields = {label: matrix.get_field(label)[:end_row, columns] for label in ("Open", "High", "Low", "Close")}
+    closes = fields["Close"]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        history = {"Close": np.log(closes[1:] / closes[:-1]),
+                   "Gap": np.log(fields["Open"][1:] / closes[:-1]),
+                   "High": np.log(fields["High"][1:] / np.maximum(fields["Open"][1:], closes[1:])),
+                   "Low": np.log(fields["Low"][1:] / np.minimum(fields["Open"][1:], closes[1:]))}
+    valid = np.all([np.isfinite(returns).all(axis=1) for returns in history.values()], axis=0)
+    history = {label: returns[valid] for label, returns in history.items()}
+    history["Volume"] = matrix.get_field("Volume")[1:end_row, columns][valid] \
+        if matrix.has_field("Volume") else np.full(history["Close"].shape, np.nan)
+    return history
+
+
+def make_bars(spot, close_returns, gaps, highs, lows, volumes):
+    """
+    Returns: a dict of price label -> (path x bar x symbol) array of the bars whose log
+    returns are given, each path starting from spot (the vector of last closes)
+    """
+    closes = spot * np.exp(np.cumsum(close_returns, axis=1))
+    previous_closes = np.concatenate(
+        [np.broadcast_to(spot, (len(closes), 1, len(spot))), closes[:, :-1]], axis=1)
+    opens = previous_closes * np.exp(gaps)
+    return {"Open": opens, "High": np.maximum(opens, closes) * np.exp(highs),
+            "Low": np.minimum(opens, closes) * np.exp(lows), "Close": closes, "Volume": volumes}
+
+
+def block_bootstrap_paths(history, spot, num_paths, num_bars, block_size=20, rng=None):
+    """
+    Returns: num_paths paths of num_bars bars (see make_bars) made of blocks of block_size
+    consecutive bars of history (as returned by get_history), drawn with replacement
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    num_history = len(history["Close"])
+    block_size = min(block_size, num_history)
+    num_blocks = -(-num_bars // block_size)
+    starts = rng.integers(num_history - block_size + 1, size=(num_paths, num_blocks))
+    rows = (starts[:, :, None] + np.arange(block_size)).reshape(num_paths, -1)[:, :num_bars]
+    return make_bars(spot, history["Close"][rows], history["Gap"][rows], history["High"][rows],
+                     history["Low"][rows], history["Volume"][rows])
+
+
+def gbm_paths(history, spot, num_paths, num_bars, drift=None, rng=None):
+    """
+    Returns: num_paths paths of num_bars bars (see make_bars) of correlated geometric
+    Brownian motion fitted to history (as returned by get_history). drift is the mean
+    log return per bar (default: the mean of history)
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    returns = history["Close"]
+    mean = returns.mean(axis=0) if drift is None else np.full(returns.shape[1], drift)
+    covariance = np.atleast_2d(np.cov(returns, rowvar=False))
+    # a small ridge keeps the factorization stable for perfectly correlated symbols
+    factor = np.linalg.cholesky(covariance + 1e-12 * np.eye(len(covariance)))
+    shocks = rng.standard_normal((num_paths, num_bars, len(covariance))) @ factor.T
+    rows = rng.integers(len(returns), size=(num_paths, num_bars))
+    return make_bars(spot, mean + shocks, np.zeros(shocks.shape), history["High"][rows],
+                     history["Low"][rows], history["Volume"][rows])
+
+
+def run_paths(asset_list, start_date, end_date, rows, paths, params):
+    """
+    Runs backtest_strategy with params once per path, with the bars of asset_list on rows
+    of the price matrix replaced by the path (a dict of price label -> (path x bar x
+    symbol) array).
+
+    Returns: the list of summaries (see Backtesting.summarize_backtest) of each path, with
+    an error instead if its run failed
+    """
+    matrix = State.HoldingsStrategy.price_matrix
+    num_paths = len(paths["Close"])
+    results = []
+    for i in range(num_paths):
+        bars = {label: paths[label][i] for label in paths if matrix.has_field(label)}
+        if matrix.has_field("Adj Close"):
+            bars["Adj Close"] = bars["Close"]
+        matrix.set_rows(rows, asset_list, bars)
+        # option prices were modelled from the previous path
+        State.Holdings.options_prices.clear()
+        State.Holdings.failed_options_prices.clear()
+        try:
+            state = Backtesting.backtest_strategy(
+                asset_list, start_date, end_date, plot=False, **params)
+            results.append({**Backtesting.summarize_backtest(state), "error": None})
+        except (Exception, SystemExit) as e:
+            results.append({"error": repr(e)})
+    return results
+
+
+def _init_worker(price_dir):
+    """
+    Loads the saved price matrix into a worker process and models its option prices
+    """
+    State.HoldingsStrategy.price_matrix.load(price_dir)
+    State.Holdings.option_pricing = State.OptionPricing.Model
+
+
+class MonteCarlo(object):
+    """
+    A class that runs backtest_strategy over many synthetic price paths of the backtest
+    window and reports the distribution of its results.
+    """
+
+    def __init__(self, asset_list, start_date, end_date, method="bootstrap", num_paths=100,
+                 block_size=20, drift=None, seed=0):
+        if method not in METHODS:
+            Helper.log_error(f"Unknown path method: {method}. Expected one of {METHODS}")
+        self._asset_list = list(asset_list)
+        self._start_date = start_date
+        self._end_date = end_date
+        self._method = method
+        self._num_paths = num_paths
+        self._block_size = block_size
+        self._drift = drift
+        self._seed = seed
+
+    def get_rows(self):
+        """
+        Returns: the slice of price matrix rows in the backtest window
+        """
+        State.HoldingsStrategy.load_assets(self._asset_list)
+        dates = State.HoldingsStrategy.price_matrix.get_dates()
+        first = bisect.bisect_left(dates, self._start_date)
+        if first == 0:
+            Helper.log_error(f"No price data before {self._start_date} to start the paths from")
+        last = bisect.bisect_right(dates, self._end_date)
+        if last <= first:
+            Helper.log_error(f"No price data from {self._start_date} to {self._end_date} to run the paths on")
+        return slice(first, last)
+
+    def generate_paths(self):
+        """
+        Returns: (rows, paths), the slice of price matrix rows in the backtest window and a
+        dict of price label -> (path x bar x symbol) array of the synthetic bars on them
+        """
+        rows = self.get_rows()
+        matrix = State.HoldingsStrategy.price_matrix
+        history = get_history(matrix, self._asset_list, rows.start)
+        if len(history["Close"]) < 2 * self._block_size:
+            Helper.log_error(
+                f"Only {len(history['Close'])} bars before {self._start_date} to fit the paths to")
+        spot = matrix.get_field("Close")[rows.start - 1,
+                                         matrix.get_symbol_indices(self._asset_list)]
+        rng = np.random.default_rng(self._seed)
+        num_bars = rows.stop - rows.start
+        if self._method == "gbm":
+            paths = gbm_paths(history, spot, self._num_paths, num_bars, drift=self._drift, rng=rng)
+        else:
+            paths = block_bootstrap_paths(history, spot, self._num_paths, num_bars,
+                                          block_size=self._block_size, rng=rng)
+        return rows, paths
+
+    def run(self, num_workers=4, paths_per_task=4, **params):
+        """
+        Runs backtest_strategy with params (see Backtesting.STRATEGY_PARAMETERS) over every
+        path, paths_per_task at a time in a pool of num_workers processes (in this process
+        if num_workers is 0).
+
+        Returns: a dataframe with one row per path and its summary
+        """
+        rows, paths = self.generate_paths()
+        tasks = [{label: paths[label][i:i + paths_per_task] for label in paths}
+                 for i in range(0, self._num_paths, paths_per_task)]
+        Helper.log_info(f"Running {self._num_paths} {self._method} paths of {rows.stop - rows.start} bars")
+        if num_workers:
+            with tempfile.TemporaryDirectory() as price_dir:
+                State.HoldingsStrategy.price_matrix.save(price_dir)
+                with ProcessPoolExecutor(num_workers, initializer=_init_worker,
+                                         initargs=(price_dir,)) as pool:
+                    futures = [pool.submit(run_paths, self._asset_list, self._start_date,
+                                           self._end_date, rows, task, params) for task in tasks]
+                    results = [result for future in futures for result in future.result()]
+        else:
+            results = self._run_here(rows, tasks, params)
+        return pd.DataFrame(results).rename_axis("path")
+
+    def _run_here(self, rows, tasks, params):
+        """
+        Returns: the results of running every task in this process, restoring the real
+        prices and the option pricing mode afterwards
+        """
+        matrix = State.HoldingsStrategy.price_matrix
+        columns = matrix.get_symbol_indices(self._asset_list)
+        real = {label: matrix.get_field(label)[rows, columns].copy() for label in
+                list(tasks[0]) + ["Adj Close"] if matrix.has_field(label)}
+        option_pricing = State.Holdings.option_pricing
+        State.Holdings.option_pricing = State.OptionPricing.Model
+        try:
+            return [result for task in tasks for result in run_paths(
+                self._asset_list, self._start_date, self._end_date, rows, task, params)]
+        finally:
+            matrix.set_rows(rows, self._asset_list, real)
+            State.Holdings.option_pricing = option_pricing
+            State.Holdings.options_prices.clear()
+            State.Holdings.failed_options_prices.clear()
+
+    @staticmethod
+    def get_distribution(results, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        """
+        Returns: a dataframe of the quantiles, mean and standard deviation of the return,
+        HODL return and maximum drawdown over the paths of results (as returned by run),
+        and the fraction of paths that lost money or failed
+        """
+        finished = results[results["error"].isna()] if "error" in results else results
+        columns = [column for column in ("return", "hodl_return", "max_drawdown") if column in finished]
+        values = finished[columns].astype(float)
+        distribution = values.quantile(list(quantiles))
+        distribution.index = [f"q{round(100 * q)}" for q in quantiles]
+        distribution.loc["mean"] = values.mean()
+        distribution.loc["std"] = values.std()
+        distribution.loc["probability_of_loss"] = (values < 0).mean().where(
+            values.columns != "max_drawdown")
+        distribution.loc["failed_paths"] = len(results) - len(finished)
+        return distribution
@@ -0,0 +1,218 @@
+import math
+import numpy as np
+import pandas as pd
+import Helper
+import Pruning
+import Sweep
+
+# A tree-structured Parzen estimator (TPE) search over the same parameter grid a sweep
+# takes: a dict of parameter -> list of values, each list in a meaningful order (e.g.
+# increasing delays). Instead of running every combination, parameter sets are proposed
+# in batches from the results so far. The finished trials are split into the best gamma
+# fraction and the rest, the values of each parameter in both groups are smoothed over
+# the value index into two densities l and g, and the candidate drawn from l with the
+# largest l / g is proposed next. Until num_startup trials have finished, parameter
+# sets are drawn at random.
+#
+# Every batch goes through a Sweep queue, so it runs on local or remote workers like a
+# grid. Runs whose equity falls below a quantile of the finished runs at the same bar
+# are stopped early (see Pruning) and count as the worst trials.
+
+
+class TPEOptimizer(object):
+    """
+    A class that searches a backtest_strategy parameter grid adaptively.
+
+    objective is the column of Backtesting.summarize_backtest that is maximized (e.g.
+    return), or a function of a summary row to maximize. prune_quantile is the quantile
+    of the finished runs a run must stay above to keep running (None never prunes).
+    """
+
+    def __init__(self, queue_dir, asset_list, start_date, end_date, space, objective="return",
+                 num_startup=8, gamma=0.25, num_candidates=24, bandwidth=1.0, prune_quantile=0.25,
+                 prune_interval=10, prune_min_bars=40, min_completed=4, seed=0):
+        self._sweep = Sweep.SweepCoordinator(
+            queue_dir, asset_list, start_date, end_date, unit_size=1)
+        self._names = sorted(space.keys())
+        self._values = [list(space[name]) for name in self._names]
+        self._objective = objective
+        self._num_startup = num_startup
+        self._gamma = gamma
+        self._num_candidates = num_candidates
+        self._bandwidth = bandwidth
+        self._prune_quantile = prune_quantile
+        self._prune_interval = prune_interval
+        self._prune_min_bars = prune_min_bars
+        self._min_completed = min_completed
+        self._rng = np.random.default_rng(seed)
+        self._trials = []
+
+    def get_sweep(self):
+        """
+        Returns: the SweepCoordinator that runs the backtests
+        """
+        return self._sweep
+
+    def get_grid_size(self):
+        """
+        Returns: the number of parameter sets in the grid
+        """
+        return math.prod(len(values) for values in self._values)
+
+    def get_trials(self):
+        """
+        Returns: a dataframe with one row per finished trial, its parameters, score,
+        whether it was pruned and its summary, best first
+        """
+        rows = [{"trial": trial["trial"], **trial["params"], "score": trial["score"],
+                 "pruned": trial["pruned"], **(trial["summary"] or {}), "error": trial["error"]}
+                for trial in self._trials]
+        table = pd.DataFrame(rows)
+        if table.empty:
+            return table
+        return table.sort_values("score", ascending=False, na_position="last").reset_index(drop=True)
+
+    def get_best(self):
+        """
+        Returns: (params, score) of the best trial that ran to the end, or None if none did
+        """
+        finished = [trial for trial in self._trials if np.isfinite(trial["score"])]
+        if not finished:
+            return None
+        best = max(finished, key=lambda trial: trial["score"])
+        return best["params"], best["score"]
+
+    def _to_params(self, indices):
+        """
+        Returns: the parameter dict of the vector of value indices
+        """
+        return {name: values[i] for name, values, i in zip(self._names, self._values, indices)}
+
+    def _density(self, num_values, observed):
+        """
+        Returns: the density over the value indices of one parameter, a Gaussian kernel
+        around each observed index plus a uniform prior of one observation
+        """
+        grid = np.arange(num_values)
+        weights = np.ones(num_values) / num_values
+        if len(observed):
+            kernels = np.exp(-0.5 * ((grid[None, :] - np.asarray(observed)[:, None]) /
+                                     self._bandwidth) ** 2)
+            weights = weights + (kernels / kernels.sum(axis=1, keepdims=True)).sum(axis=0)
+        return weights / weights.sum()
+
+    def _score(self, summary):
+        """
+        Returns: the objective of a run summary
+        """
+        if callable(self._objective):
+            return float(self._objective(pd.Series(summary)))
+        value = summary.get(self._objective)
+        return float(value) if value is not None else -np.inf
+
+    def propose(self, num_sets, tried):
+        """
+        Returns: up to num_sets vectors of value indices that are not in tried (a set of
+        tuples, which the proposals are added to)
+        """
+        proposals = []
+        scored = [trial for trial in self._trials if trial["indices"] is not None]
+        for _ in range(num_sets):
+            if len(tried) >= self.get_grid_size():
+                break
+            if len(scored) < self._num_startup:
+                candidates = np.column_stack([self._rng.integers(len(values), size=self._num_candidates)
+                                              for values in self._values])
+                ratios = np.zeros(len(candidates))
+            else:
+                scores = np.array([trial["score"] for trial in scored])
+                order = np.argsort(-scores, kind="stable")
+                num_good = max(1, int(math.ceil(self._gamma * len(scored))))
+                observed = np.array([trial["indices"] for trial in scored])
+                good, bad = observed[order[:num_good]], observed[order[num_good:]]
+                candidates = []
+                ratios = np.zeros(self._num_candidates)
+                for j, values in enumerate(self._values):
+                    l = self._density(len(values), good[:, j])
+                    g = self._density(len(values), bad[:, j])
+                    draws = self._rng.choice(len(values), size=self._num_candidates, p=l)
+                    candidates.append(draws)
+                    ratios += np.log(l[draws]) - np.log(g[draws])
+                candidates = np.column_stack(candidates)
+            proposal = None
+            for i in np.argsort(-ratios, kind="stable"):
+                if tuple(candidates[i]) not in tried:
+                    proposal = tuple(int(index) for index in candidates[i])
+                    break
+            while proposal is None:
+                # every candidate was already tried: fall back to a random untried set
+                candidate = tuple(int(self._rng.integers(len(values))) for values in self._values)
+                proposal = candidate if candidate not in tried else None
+            tried.add(proposal)
+            proposals.append(proposal)
+        return proposals
+
+    def _get_pruning(self):
+        """
+        Returns: the keyword arguments of the Pruning.EquityPruner of the next batch, or
+        None if runs should not be pruned yet
+        """
+        if self._prune_quantile is None:
+            return None
+        # pruned runs keep their bars so the thresholds don't drift up to the survivors
+        curves = [trial["equity"] for trial in self._trials if trial["equity"]]
+        thresholds = Pruning.make_thresholds(curves, self._prune_quantile, self._min_completed)
+        if not thresholds:
+            return None
+        return {"thresholds": thresholds, "interval": self._prune_interval,
+                "min_bars": self._prune_min_bars}
+
+    def _collect(self, trial_indices):
+        """
+        Adds the finished trials of the queue that are not yet recorded
+        """
+        recorded = {trial["trial"] for trial in self._trials}
+        for record in self._sweep.get_results():
+            trial = record.get("tags", {}).get("trial")
+            if trial is None or trial in recorded or trial not in trial_indices:
+                continue
+            recorded.add(trial)
+            failed = record["error"] is not None or record["summary"] is None
+            score = -np.inf if failed or record.get("pruned") else self._score(record["summary"])
+            self._trials.append({"trial": trial, "indices": trial_indices[trial],
+                                 "params": record["params"], "score": score,
+                                 "pruned": record.get("pruned", False), "summary": record["summary"],
+                                 "equity": record["equity"], "error": record["error"]})
+
+    def run(self, num_trials, num_workers=4, batch_size=None, stale_timeout=None):
+        """
+        Runs num_trials backtests (at most the size of the grid), batch_size (default:
+        num_workers) at a time. num_workers local workers are started for each batch; with
+        0 the queue is left to remote workers.
+
+        Returns: (params, score) of the best trial, as get_best
+        """
+        batch_size = batch_size or max(num_workers, 1)
+        num_trials = min(num_trials, self.get_grid_size())
+        self._sweep.prepare_price_cache()
+        trial_indices = {}
+        tried = set()
+        while len(trial_indices) < num_trials:
+            proposals = self.propose(min(batch_size, num_trials - len(trial_indices)), tried)
+            if not proposals:
+                break
+            pruning = self._get_pruning()
+            for indices in proposals:
+                trial = len(trial_indices)
+                trial_indices[trial] = indices
+                self._sweep.submit([self._to_params(indices)], tags={"trial": trial},
+                                   pruning=pruning)
+            if num_workers:
+                self._sweep.run_local_workers(num_workers, stale_timeout=stale_timeout)
+            else:
+                self._sweep.wait(stale_timeout=stale_timeout)
+            self._collect(trial_indices)
+            best = self.get_best()
+            Helper.log_info(f"Finished {len(self._trials)} of {num_trials} trials, "
+                            f"{sum(trial['pruned'] for trial in self._trials)} pruned, best: {best}")
+        return self.get_best()
@@ -0,0 +1,204 @@
+import bisect
+import hashlib
+import json
+import os
+import numpy as np
+from datetime import date, timedelta
+from pathlib import Path
+import Helper
+import Pricing
+import tradier
+
+# The listings store: the listed expirations and strikes of each underlying, one JSON
+# file per underlying. Tradier only lists the current expirations, so every fetch is
+# merged into the store, which builds up the listings of past expirations as it is
+# refreshed over time.
+LISTINGS_DIRECTORY = os.path.dirname(
+    Path(__file__).absolute()) + '/price_data/options/listings'
+
+
+def make_symbol(underlying, expiration, option_type, strike):
+    """
+    Returns: the OCC symbol of the option, e.g. AAPL200717C00350000
+    """
+    return f"{underlying}{expiration.strftime('%y%m%d')}{option_type}{int(round(strike * 1000)):08d}"
+
+
+def standard_strike_step(last_price):
+    """
+    Returns: the usual distance between listed strikes for an underlying at last_price
+    """
+    if last_price < 20:
+        return 1
+    elif last_price < 100:
+        return 5
+    return 10
+
+
+class OptionChain(object):
+    """
+    A class representing the listed option contracts of an underlying.
+
+    Strikes are kept sorted per expiration and option type, so the nearest listed strike,
+    the strike n listings away and the expiration nearest a target date are bisect
+    lookups instead of guesses that the rounded contract exists.
+    """
+
+    def __init__(self, underlying):
+        self._underlying = underlying
+        self._strikes = {}
+        self._expirations = []
+
+    def __len__(self):
+        return sum(len(strikes) for by_type in self._strikes.values() for strikes in by_type.values())
+
+    def get_fingerprint(self):
+        """
+        Returns: a hash of the listed contracts, which changes whenever the listing does
+        """
+        contracts = [(str(expiration), option_type, strikes) for expiration in self._expirations
+                     for option_type, strikes in sorted(self._strikes[expiration].items())]
+        return hashlib.sha256(repr(contracts).encode()).hexdigest()
+
+    def get_underlying(self):
+        """
+        Returns: the underlying of this chain
+        """
+        return self._underlying
+
+    def add_contract(self, expiration, option_type, strike):
+        """
+        Adds a listed contract to the chain
+        """
+        if expiration not in self._strikes:
+            self._strikes[expiration] = {}
+            bisect.insort(self._expirations, expiration)
+        strikes = self._strikes[expiration].setdefault(option_type, [])
+        i = bisect.bisect_left(strikes, strike)
+        if i == len(strikes) or strikes[i] != strike:
+            strikes.insert(i, strike)
+
+    def add_symbol(self, symbol):
+        """
+        Adds the contract with OCC symbol symbol to the chain
+        """
+        _, expiration, option_type, strike = Pricing.parse_option_symbol(symbol)
+        self.add_contract(expiration, option_type, strike)
+
+    def add_standard_strikes(self, expiration, option_type, last_price, width=0.5):
+        """
+        Adds the strikes an exchange usually lists within width (a fraction of last_price)
+        of last_price, for when the listed contracts are unknown
+        """
+        step = standard_strike_step(last_price)
+        low = max(step, step * np.floor(last_price * (1 - width) / step))
+        for strike in np.arange(low, last_price * (1 + width) + step, step):
+            self.add_contract(expiration, option_type, float(strike))
+
+    def get_expirations(self):
+        """
+        Returns: the sorted expirations in the chain
+        """
+        return self._expirations
+
+    def get_expiration(self, target, max_days=7):
+        """
+        Returns: the first listed expiration on or after target, if it is at most max_days
+        after it. None otherwise
+        """
+        i = bisect.bisect_left(self._expirations, target)
+        if i < len(self._expirations) and self._expirations[i] - target <= timedelta(max_days):
+            return self._expirations[i]
+        return None
+
+    def get_strikes(self, expiration, option_type):
+        """
+        Returns: the sorted listed strikes of expiration and option_type
+        """
+        return self._strikes.get(expiration, {}).get(option_type, [])
+
+    def nearest_strike(self, expiration, option_type, price):
+        """
+        Returns: the listed strike closest to price (the lower one on a tie). None if
+        nothing is listed
+        """
+        strikes = self.get_strikes(expiration, option_type)
+        if not strikes:
+            return None
+        i = bisect.bisect_left(strikes, price)
+        if i == len(strikes) or (i > 0 and price - strikes[i - 1] <= strikes[i] - price):
+            return strikes[i - 1]
+        return strikes[i]
+
+    def offset_strike(self, expiration, option_type, strike, num_strikes):
+        """
+        Returns: the listed strike num_strikes listings above strike (below if negative),
+        clamped to the listed range
+        """
+        strikes = self.get_strikes(expiration, option_type)
+        i = bisect.bisect_left(strikes, strike) + num_strikes
+        return strikes[min(max(i, 0), len(strikes) - 1)]
+
+    def select_by_delta(self, expiration, option_type, target_delta, last_price, current_date,
+                        volatility, time='Open'):
+        """
+        Returns: the listed strike whose Black-Scholes delta is closest to target_delta
+        (negative for puts), with every listed strike evaluated in one vectorized pass
+        """
+        strikes = np.asarray(self.get_strikes(expiration, option_type), dtype=float)
+        if not len(strikes):
+            return None
+        delta = Pricing.black_scholes_greeks(
+            last_price, strikes, Pricing.years_to_expiration(
+                current_date, expiration, time),
+            volatility, option_type == 'C')["delta"]
+        return float(strikes[np.argmin(np.abs(delta - target_delta))])
+
+
+def make_chains(symbols):
+    """
+    Returns: a dict of underlying to the OptionChain of the OCC option symbols, which
+    must be the exchange's listing (e.g. from a chains or quotes source, see
+    load_listing). The contracts that happen to be downloaded are not a listing.
+    """
+    chains = {}
+    for symbol in symbols:
+        underlying = Pricing.parse_option_symbol(symbol)[0]
+        chains.setdefault(underlying, OptionChain(underlying)).add_symbol(symbol)
+    return chains
+
+
+def load_listing(underlying, directory=None, refresh=True):
+    """
+    Returns: the OptionChain of the contracts of underlying listed in the listings store,
+    or None if none are. If refresh is True, the store is first updated from Tradier's
+    listing, at most once a day; if that fails, the stored listing is used as is.
+    directory defaults to LISTINGS_DIRECTORY.
+    """
+    directory = directory or LISTINGS_DIRECTORY
+    filename = f"{directory}/{underlying}.json"
+    listing = {"fetched": None, "expirations": {}}
+    if os.path.isfile(filename):
+        with open(filename) as f:
+            listing = json.load(f)
+    if refresh and listing["fetched"] != str(date.today()):
+        try:
+            fetched = tradier.get_option_expirations(underlying)
+        except Exception as e:
+            Helper.log_warn(f"Could not fetch the option listing of {underlying}: {e}")
+        else:
+            for expiration, strikes in fetched.items():
+                listing["expirations"][expiration] = sorted(
+                    set(listing["expirations"].get(expiration, [])) | set(strikes))
+            listing["fetched"] = str(date.today())
+            os.makedirs(directory, exist_ok=True)
+            with open(filename, 'w') as f:
+                json.dump(listing, f)
+    if not any(listing["expirations"].values()):
+        return None
+    chain = OptionChain(underlying)
+    for expiration, strikes in listing["expirations"].items():
+        for strike in strikes:
+            for option_type in ('C', 'P'):
+                chain.add_contract(date.fromisoformat(expiration), option_type, float(strike))
+    return chain
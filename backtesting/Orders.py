@@ -0,0 +1,102 @@
+import numpy as np
+import Pricing
+
+
+class MultiLegOrder(object):
+    """
+    A class representing an order for several option contracts that fill together.
+
+    Each leg is an OCC option symbol and a signed number of contracts per unit of the order
+    (positive to buy, negative to sell). The order is priced, checked against buying power
+    and filled as a whole: either every leg fills or none does. Once filled, its legs are
+    held as one position group, so the whole spread can be closed in one operation.
+    """
+
+    def __init__(self, name, symbols, quantities):
+        self._name = name
+        self._symbols = list(symbols)
+        self._quantities = np.asarray(quantities, dtype=int)
+
+    def __str__(self):
+        legs = ", ".join(f"{quantity:+d} {symbol}" for symbol,
+                         quantity in zip(self._symbols, self._quantities))
+        return f"{self._name} ({legs})"
+
+    def __repr__(self):
+        return self.__str__()
+
+    @staticmethod
+    def vertical(long_symbol, short_symbol, quantity=1):
+        """
+        Returns: a vertical spread, long quantity long_symbol and short quantity short_symbol
+        """
+        return MultiLegOrder("vertical", [long_symbol, short_symbol], [quantity, -quantity])
+
+    @staticmethod
+    def iron_condor(long_put, short_put, short_call, long_call, quantity=1):
+        """
+        Returns: an iron condor, a short put spread and a short call spread
+        """
+        return MultiLegOrder("iron condor", [long_put, short_put, short_call, long_call],
+                             [quantity, -quantity, -quantity, quantity])
+
+    @staticmethod
+    def straddle(call, put, quantity=1):
+        """
+        Returns: a straddle (or strangle, if the strikes differ), quantity of both call and
+        put. A negative quantity sells them
+        """
+        return MultiLegOrder("straddle", [call, put], [quantity, quantity])
+
+    @staticmethod
+    def calendar(near_symbol, far_symbol, quantity=1):
+        """
+        Returns: a calendar spread, short quantity near_symbol and long quantity far_symbol
+        """
+        return MultiLegOrder("calendar", [near_symbol, far_symbol], [-quantity, quantity])
+
+    def get_name(self):
+        """
+        Returns: the kind of order, e.g. vertical
+        """
+        return self._name
+
+    def get_symbols(self):
+        """
+        Returns: the symbols of the legs
+        """
+        return self._symbols
+
+    def get_quantities(self):
+        """
+        Returns: the vector of signed contracts of each leg
+        """
+        return self._quantities
+
+    def get_underlyings(self):
+        """
+        Returns: the set of underlyings of the legs
+        """
+        return set(Pricing.parse_option_symbols(self._symbols)[0])
+
+    def get_cost(self, prices):
+        """
+        Returns: the net debit (negative for a net credit) of filling the order when the
+        legs are priced at prices, a vector of per-share option prices
+        """
+        return 100 * float(np.dot(prices, self._quantities))
+
+    def get_max_loss(self, prices):
+        """
+        Returns: the largest possible loss of the order at expiration when it is filled at
+        prices, or None if the loss is unbounded or the legs expire on different dates (in
+        which case only a net debit is a bounded loss)
+        """
+        _, expirations, is_call, strikes = Pricing.parse_option_symbols(self._symbols)
+        cost = self.get_cost(prices)
+        if len(set(expirations.tolist())) > 1:
+            return cost if cost > 0 else None
+        payoff = Pricing.minimum_expiration_payoff(strikes, is_call, self._quantities)
+        if payoff is None:
+            return None
+        return max(cost - 100 * payoff, 0.0)
@@ -0,0 +1,232 @@
+import re
+import numpy as np
+from datetime import date
+from functools import lru_cache
+import Indicators
+
+# Every pricing function broadcasts over numpy arrays, so a whole chain of strikes and
+# expirations (or every date of a contract's history) is priced in one pass.
+# Times are in years and rates and volatilities are annualized.
+
+RISK_FREE_RATE = 0.01
+TRADING_DAYS_PER_YEAR = 252
+# Fraction of a calendar day between the open and the close
+SESSION_FRACTION = 6.5 / 24
+# Options usually trade above the realized volatility of their underlying
+VOLATILITY_PREMIUM = 1.1
+MINIMUM_VOLATILITY = 0.05
+MINIMUM_TIME = 1e-6
+
+
+def norm_pdf(x):
+    """
+    Returns: the standard normal probability density at x
+    """
+    return np.exp(-0.5 * x * x) / np.sqrt(2 * np.pi)
+
+
+def norm_cdf(x):
+    """
+    Returns: the standard normal cumulative distribution at x, using the Abramowitz and
+    Stegun 26.2.17 approximation (absolute error below 7.5e-8)
+    """
+    x = np.asarray(x, dtype=float)
+    t = 1 / (1 + 0.2316419 * np.abs(x))
+    poly = t * (0.319381530 + t * (-0.356563782 + t *
+                (1.781477937 + t * (-1.821255978 + t * 1.330274429))))
+    tail = norm_pdf(x) * poly
+    return np.where(x >= 0, 1 - tail, tail)
+
+
+@lru_cache(maxsize=None)
+def parse_option_symbol(symbol):
+    """
+    Returns: (underlying, expiration, option_type, strike) of an OCC option symbol such as
+    AAPL200717C00350000
+    """
+    match = re.match(r"(\D+)(\d{2})(\d{2})(\d{2})([CP])(\d{8})$", symbol)
+    return (match.group(1), date(2000 + int(match.group(2)), int(match.group(3)), int(match.group(4))),
+            match.group(5), int(match.group(6)) / 1000)
+
+
+def parse_option_symbols(symbols):
+    """
+    Returns: (underlyings, expirations, is_call, strikes) of a list of OCC option symbols,
+    a list and three arrays
+    """
+    contracts = [parse_option_symbol(symbol) for symbol in symbols]
+    return ([contract[0] for contract in contracts],
+            np.array([contract[1] for contract in contracts], dtype='datetime64[D]'),
+            np.array([contract[2] == 'C' for contract in contracts], dtype=bool),
+            np.array([contract[3] for contract in contracts], dtype=float))
+
+
+def years_to_expiration(current_date, expiration, label='Close'):
+    """
+    Returns: the time from the label bar of current_date to the close of expiration, in years
+    """
+    days = (np.asarray(expiration, dtype='datetime64[D]') -
+            np.asarray(current_date, dtype='datetime64[D]')).astype(float)
+    if str(label) == 'Open':
+        days = days + SESSION_FRACTION
+    return np.maximum(days / 365, 0)
+
+
+def _d1_d2(spot, strike, years, volatility, rate, dividend):
+    years = np.maximum(years, MINIMUM_TIME)
+    vol_sqrt_t = volatility * np.sqrt(years)
+    d1 = (np.log(spot / strike) + (rate - dividend +
+          0.5 * volatility ** 2) * years) / vol_sqrt_t
+    return d1, d1 - vol_sqrt_t, years
+
+
+def black_scholes(spot, strike, years, volatility, is_call, rate=RISK_FREE_RATE, dividend=0.0):
+    """
+    Returns: the Black-Scholes price of European options. is_call is a boolean (array)
+    """
+    spot, strike, volatility = (np.asarray(x, dtype=float)
+                                for x in (spot, strike, volatility))
+    d1, d2, t = _d1_d2(spot, strike, years, volatility, rate, dividend)
+    carry = np.exp(-dividend * t)
+    discount = np.exp(-rate * t)
+    call = spot * carry * norm_cdf(d1) - strike * discount * norm_cdf(d2)
+    put = strike * discount * norm_cdf(-d2) - spot * carry * norm_cdf(-d1)
+    return np.where(is_call, call, put)
+
+
+def black_scholes_greeks(spot, strike, years, volatility, is_call, rate=RISK_FREE_RATE, dividend=0.0):
+    """
+    Returns: a dict of the Black-Scholes price, delta, gamma, vega (per 1 point of
+    volatility), theta (per calendar day) and rho (per 1 point of rate) of European
+    options, computed in one pass
+    """
+    spot, strike, volatility = (np.asarray(x, dtype=float)
+                                for x in (spot, strike, volatility))
+    d1, d2, t = _d1_d2(spot, strike, years, volatility, rate, dividend)
+    carry = np.exp(-dividend * t)
+    discount = np.exp(-rate * t)
+    sign = np.where(is_call, 1.0, -1.0)
+    n1 = norm_cdf(sign * d1)
+    n2 = norm_cdf(sign * d2)
+    pdf1 = norm_pdf(d1)
+    sqrt_t = np.sqrt(t)
+    price = sign * (spot * carry * n1 - strike * discount * n2)
+    theta = (-spot * carry * pdf1 * volatility / (2 * sqrt_t)
+             - sign * rate * strike * discount * n2 + sign * dividend * spot * carry * n1)
+    return {"price": price,
+            "delta": sign * carry * n1,
+            "gamma": carry * pdf1 / (spot * volatility * sqrt_t),
+            "vega": spot * carry * pdf1 * sqrt_t / 100,
+            "theta": theta / 365,
+            "rho": sign * strike * t * discount * n2 / 100}
+
+
+def _bjerksund_stensland_call(spot, strike, t, rate, carry, volatility):
+    """
+    Returns: the Bjerksund-Stensland (1993) price of American calls with cost of carry
+    carry, for the options where carry < rate
+    """
+    variance = volatility ** 2
+    beta = (0.5 - carry / variance) + np.sqrt((carry / variance - 0.5) ** 2 + 2 * rate / variance)
+    b_infinity = beta / (beta - 1) * strike
+    b_zero = np.maximum(strike, rate / (rate - carry) * strike)
+    h = -(carry * t + 2 * volatility * np.sqrt(t)) * b_zero / (b_infinity - b_zero)
+    trigger = b_zero + (b_infinity - b_zero) * (1 - np.exp(h))
+    alpha = (trigger - strike) * trigger ** -beta
+
+    def phi(gamma, barrier):
+        lambda_ = (-rate + gamma * carry + 0.5 * gamma * (gamma - 1) * variance) * t
+        d = -(np.log(spot / barrier) + (carry + (gamma - 0.5) * variance) * t) / (volatility * np.sqrt(t))
+        kappa = 2 * carry / variance + (2 * gamma - 1)
+        return np.exp(lambda_) * spot ** gamma * (
+            norm_cdf(d) - (trigger / spot) ** kappa * norm_cdf(d - 2 * np.log(trigger / spot) / (volatility * np.sqrt(t))))
+
+    price = (alpha * spot ** beta - alpha * phi(beta, trigger) + phi(1, trigger) - phi(1, strike)
+             - strike * phi(0, trigger) + strike * phi(0, strike))
+    return np.where(spot >= trigger, spot - strike, price)
+
+
+def bjerksund_stensland(spot, strike, years, volatility, is_call, rate=RISK_FREE_RATE, dividend=0.0):
+    """
+    Returns: the Bjerksund-Stensland (1993) approximation of the price of American options.
+    Puts are priced as calls through the put-call transformation. Options that are never
+    worth exercising early are priced with Black-Scholes
+    """
+    spot, strike, volatility, is_call = np.broadcast_arrays(
+        *(np.asarray(x, dtype=float) for x in (spot, strike, volatility, is_call)))
+    t = np.maximum(np.broadcast_to(np.asarray(years, dtype=float), spot.shape), MINIMUM_TIME)
+    is_call = is_call.astype(bool)
+    carry = rate - dividend
+    # P(S, K, T, r, b) = C(K, S, T, r - b, -b)
+    call_spot = np.where(is_call, spot, strike)
+    call_strike = np.where(is_call, strike, spot)
+    call_rate = np.where(is_call, rate, rate - carry)
+    call_carry = np.where(is_call, carry, -carry)
+    with np.errstate(all='ignore'):
+        american = _bjerksund_stensland_call(call_spot, call_strike, t, call_rate, call_carry,
+                                             volatility)
+    european = black_scholes(spot, strike, t, volatility, is_call, rate, dividend)
+    price = np.where(call_carry >= call_rate, european, american)
+    intrinsic = np.maximum(np.where(is_call, spot - strike, strike - spot), 0)
+    return np.maximum(np.where(np.isfinite(price), price, european), intrinsic)
+
+
+def minimum_expiration_payoff(strikes, is_call, quantities):
+    """
+    Returns: the lowest payoff at expiration (per share, summed over the signed contracts
+    quantities) of a position in options on one underlying, or None if it is unbounded
+    below (more calls sold than bought)
+    """
+    strikes = np.asarray(strikes, dtype=float)
+    quantities = np.asarray(quantities)
+    if quantities[is_call].sum() < 0:
+        return None
+    # The payoff is piecewise linear with kinks at the strikes, so its minimum is at zero
+    # or at one of them
+    spots = np.concatenate([[0.0], strikes])[:, None]
+    intrinsic = np.where(is_call, np.maximum(spots - strikes, 0),
+                         np.maximum(strikes - spots, 0))
+    return float((intrinsic @ quantities).min())
+
+
+def realized_volatility(closes, length=20, periods_per_year=TRADING_DAYS_PER_YEAR):
+    """
+    Returns: the annualized standard deviation of the log returns of closes, a (bar x
+    symbol) array, over the last length bars. Bars before the first full window get the
+    first available estimate
+    """
+    closes = np.asarray(closes, dtype=float)
+    returns = np.full(closes.shape, np.nan)
+    returns[1:] = np.diff(np.log(closes), axis=0)
+    volatility = np.full(closes.shape, np.nan)
+    if len(closes) > length:
+        volatility[1:] = Indicators.rolling_std(returns[1:], length) * np.sqrt(periods_per_year)
+        first = volatility[length]
+        volatility[:length] = first
+    return volatility
+
+
+def estimate_implied_volatility(realized, premium=VOLATILITY_PREMIUM, minimum=MINIMUM_VOLATILITY):
+    """
+    Returns: an estimate of the implied volatility of options from the realized volatility
+    of their underlying
+    """
+    realized = np.asarray(realized, dtype=float)
+    return np.maximum(np.where(np.isfinite(realized), realized * premium, minimum), minimum)
+
+
+def implied_volatility(price, spot, strike, years, is_call, rate=RISK_FREE_RATE, dividend=0.0,
+                       model=black_scholes, low=0.01, high=5.0, iterations=50):
+    """
+    Returns: the volatility at which model prices options at price, found by bisection
+    (all options at once). Prices outside the model's range give low or high
+    """
+    shape = np.broadcast(price, spot, strike, years, is_call).shape
+    low = np.full(shape, float(low))
+    high = np.full(shape, float(high))
+    for _ in range(iterations):
+        middle = (low + high) / 2
+        too_high = model(spot, strike, years, middle, is_call, rate, dividend) > price
+        high = np.where(too_high, middle, high)
+        low = np.where(too_high, low, middle)
+    return (low + high) / 2
@@ -0,0 +1,229 @@
+import contextlib
+import cProfile
+import io
+import pstats
+import time
+import Helper
+
+# Opt-in instrumentation of a backtest run. A Profiler passed to a run is made the active
+# profiler from the start of the run, before its price data is loaded, until the run
+# finishes (or fails), and the engine reports to whichever profiler is active through
+# the module functions phase, count and observe_latency. With no active profiler they
+# return immediately, so an uninstrumented run pays one global lookup per call site.
+#
+# Phases are timed inclusively: a phase that runs inside another (e.g. data loading
+# during valuation) is counted in both.
+
+# Upper bounds (seconds) of the buckets of latency histograms
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf'))
+SAMPLERS = ("cprofile", "pyinstrument")
+
+_active = None
+_null_phase = contextlib.nullcontext()
+
+
+def get_active():
+    """
+    Returns: the active profiler, or None if no run is being profiled
+    """
+    return _active
+
+
+def phase(name):
+    """
+    Returns: a context manager that times its block as the phase name of the active
+    profiler (a no-op if there is none)
+    """
+    return _active.phase(name) if _active is not None else _null_phase
+
+
+def count(name, n=1):
+    """
+    Adds n to the counter name of the active profiler
+    """
+    if _active is not None:
+        _active.count(name, n)
+
+
+def observe_latency(name, seconds):
+    """
+    Adds a request of name that took seconds to the latency histogram of the active
+    profiler
+    """
+    if _active is not None:
+        _active.observe_latency(name, seconds)
+
+
+@contextlib.contextmanager
+def running(profiler):
+    """
+    Returns: a context manager that starts profiler (unless it is None) for its block and
+    stops it if the block raises. A run that finishes stops it itself, after the last
+    phase it reports
+    """
+    if profiler is None:
+        yield
+        return
+    profiler.start()
+    try:
+        yield
+    except BaseException:
+        profiler.stop()
+        raise
+
+
+class _PhaseTimer(object):
+    """
+    A context manager that adds the time spent in its block to a phase of a profiler
+    """
+
+    def __init__(self, phases, name):
+        self._phases = phases
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        totals = self._phases.setdefault(self._name, [0, 0.0])
+        totals[0] += 1
+        totals[1] += time.perf_counter() - self._start
+        return False
+
+
+class Profiler(object):
+    """
+    A class that collects the phase timings, counters and latency histograms of a run.
+
+    sampler turns on a whole-program profile of the run as well: cprofile (the standard
+    library profiler) or pyinstrument (a sampling profiler, if it is installed). The
+    report then includes its top functions.
+    """
+
+    def __init__(self, sampler=None, top=25):
+        if sampler is not None and sampler not in SAMPLERS:
+            Helper.log_error(f"Unknown sampler: {sampler}. Expected one of {SAMPLERS}")
+        self._sampler = sampler
+        self._top = top
+        self._phases = {}
+        self._counters = {}
+        self._latencies = {}
+        self._wall_seconds = 0.0
+        self._started_at = None
+        self._profile = None
+
+    def phase(self, name):
+        """
+        Returns: a context manager that times its block as the phase name
+        """
+        return _PhaseTimer(self._phases, name)
+
+    def count(self, name, n=1):
+        """
+        Adds n to the counter name
+        """
+        self._counters[name] = self._counters.get(name, 0) + n
+
+    def observe_latency(self, name, seconds):
+        """
+        Adds a request of name that took seconds to its latency histogram
+        """
+        histogram = self._latencies.setdefault(
+            name, {"count": 0, "seconds": 0.0, "max": 0.0, "buckets": [0] * len(LATENCY_BUCKETS)})
+        histogram["count"] += 1
+        histogram["seconds"] += seconds
+        histogram["max"] = max(histogram["max"], seconds)
+        histogram["buckets"][next(i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound)] += 1
+
+    def start(self):
+        """
+        Makes this the active profiler and starts the sampler, if any. Does nothing if
+        it is already started
+        """
+        global _active
+        if self._started_at is not None:
+            return
+        if _active is not None and _active is not self:
+            Helper.log_warn("Another run is already being profiled; its profiler is replaced")
+        _active = self
+        self._started_at = time.perf_counter()
+        if self._sampler == "cprofile":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        elif self._sampler == "pyinstrument":
+            try:
+                import pyinstrument
+            except ImportError:
+                Helper.log_warn("pyinstrument is not installed; profiling without a sampler")
+                self._sampler = None
+            else:
+                self._profile = pyinstrument.Profiler()
+                self._profile.start()
+
+    def stop(self):
+        """
+        Stops the sampler and deactivates this profiler. Does nothing if it isn't started
+        """
+        global _active
+        if self._started_at is None:
+            return
+        if self._profile is not None:
+            if self._sampler == "cprofile":
+                self._profile.disable()
+            else:
+                self._profile.stop()
+        self._wall_seconds += time.perf_counter() - self._started_at
+        self._started_at = None
+        if _active is self:
+            _active = None
+
+    def get_profile_text(self):
+        """
+        Returns: the top functions of the sampler's profile as text, or None if there is
+        no profile
+        """
+        if self._profile is None:
+            return None
+        if self._sampler == "pyinstrument":
+            return self._profile.output_text()
+        stream = io.StringIO()
+        pstats.Stats(self._profile, stream=stream).sort_stats(
+            "cumulative").print_stats(self._top)
+        return stream.getvalue()
+
+    def get_report(self):
+        """
+        Returns: a dict of the wall time of the run, the calls and seconds of each phase,
+        the counters and the latency histograms (the count of requests in each bucket of
+        LATENCY_BUCKETS)
+        """
+        return {"wall_seconds": self._wall_seconds,
+                "phases": {name: {"calls": calls, "seconds": seconds}
+                           for name, (calls, seconds) in self._phases.items()},
+                "counters": dict(self._counters),
+                "latencies": {name: {**histogram, "buckets": list(histogram["buckets"])}
+                              for name, histogram in self._latencies.items()}}
+
+    def format_report(self):
+        """
+        Returns: the report as text
+        """
+        report = self.get_report()
+        wall_seconds = report["wall_seconds"] or float('nan')
+        lines = [f"Profile of a {report['wall_seconds']:.3f}s run", "Phases:"]
+        for name, totals in sorted(report["phases"].items(), key=lambda item: -item[1]["seconds"]):
+            lines.append(f"  {name:24s} {totals['seconds']:10.3f}s {100 * totals['seconds'] / wall_seconds:6.1f}%"
+                         f" {totals['calls']:10d} calls")
+        if report["counters"]:
+            lines.append("Counters:")
+            lines.extend(f"  {name:40s} {value:10d}" for name, value in sorted(report["counters"].items()))
+        for name, histogram in sorted(report["latencies"].items()):
+            lines.append(f"Latency of {name}: {histogram['count']} requests, mean "
+                         f"{histogram['seconds'] / histogram['count']:.3f}s, max {histogram['max']:.3f}s")
+            lines.extend(f"  <= {bound:6g}s {n:8d}" for bound, n in zip(LATENCY_BUCKETS, histogram["buckets"]) if n)
+        profile_text = self.get_profile_text()
+        if profile_text:
+            lines.extend(["Profile:", profile_text])
+        return "\n".join(lines)
@@ -0,0 +1,73 @@
+import numpy as np
+
+# Equity curves are compared relative to their initial value, bar by bar, so runs over
+# the same dates line up whatever their parameters.
+
+
+def make_thresholds(curves, quantile, min_curves=4):
+    """
+    Returns: the list of the quantile of the relative equity (value / initial value) of
+    curves (lists of portfolio values over the same bars) at each bar, or nan where fewer
+    than min_curves curves reach the bar
+    """
+    curves = [np.asarray(curve, dtype=float) for curve in curves if len(curve)]
+    if len(curves) < min_curves:
+        return []
+    num_bars = max(len(curve) for curve in curves)
+    relative = np.full((len(curves), num_bars), np.nan)
+    for i, curve in enumerate(curves):
+        relative[i, :len(curve)] = curve / curve[0]
+    counts = np.isfinite(relative).sum(axis=0)
+    thresholds = np.full(num_bars, np.nan)
+    enough = counts >= min_curves
+    thresholds[enough] = np.nanquantile(relative[:, enough], quantile, axis=0)
+    return thresholds.tolist()
+
+
+class EquityPruner(object):
+    """
+    A class that stops a running backtest early when its equity falls behind.
+
+    thresholds is the minimum relative equity (value / initial value) of each bar, e.g.
+    a quantile of the runs that already finished (see make_thresholds); nan disables a
+    bar. Every interval epochs from min_bars bars on, the latest bar of the run is
+    compared to its threshold, and the run is stopped once it falls below.
+    """
+
+    def __init__(self, thresholds, interval=10, min_bars=20):
+        self._thresholds = np.asarray(thresholds, dtype=float)
+        self._interval = interval
+        self._min_bars = min_bars
+        self._pruned_at = None
+
+    def is_due(self, current_epoch):
+        """
+        Returns: True if the run should be checked before running current_epoch
+        """
+        return current_epoch % self._interval == 0
+
+    def is_pruned(self):
+        """
+        Returns: True if the run was stopped early. False otherwise
+        """
+        return self._pruned_at is not None
+
+    def get_pruned_at(self):
+        """
+        Returns: the number of bars the run had when it was stopped, None if it was not
+        """
+        return self._pruned_at
+
+    def should_prune(self, state):
+        """
+        Returns: True if the equity of state at its latest bar is below the threshold of
+        that bar, in which case the run is marked pruned. False otherwise
+        """
+        values = state.get_strategy_values()
+        num_bars = len(values)
+        if num_bars < self._min_bars or num_bars > len(self._thresholds):
+            return False
+        if values[-1] / values[0] < self._thresholds[num_bars - 1]:
+            self._pruned_at = num_bars
+            return True
+        return False
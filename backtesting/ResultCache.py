@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import pickle
+import time
+from pathlib import Path
+import Helper
+import State
+
+# Bump when a change to the engine changes backtest results, to invalidate every entry
+CACHE_VERSION = 2
+
+
+class ResultCache(object):
+    """
+    A class representing a content-addressed cache of finished backtests.
+
+    The key of a backtest is a hash of the strategy, condition and portfolio parameters,
+    the date range and resolution, and a fingerprint of the price data used up to the end
+    date and of the option listings. Each entry stores the final state of the run, which
+    holds its equity curve and fill journal. Entries are evicted least recently used first
+    once the cache grows over max_bytes.
+    """
+
+    def __init__(self, directory=None, max_bytes=512 * 1024 * 1024):
+        if directory is None:
+            directory = os.path.dirname(
+                Path(__file__).absolute()) + '/result_cache'
+        self._directory = directory
+        self._max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _get_path(self, key, extension):
+        return os.path.join(self._directory, f"{key}.{extension}")
+
+    def make_key(self, state, start_date, end_date, resolution):
+        """
+        Returns: the cache key of backtesting state from start_date to end_date
+        """
+        chains = {asset: State.Holdings.get_option_chain(asset) for asset in state.get_assets()}
+        config = {"version": CACHE_VERSION, "state": state.get_config(),
+                  "start_date": str(start_date), "end_date": str(end_date),
+                  "resolution": int(resolution),
+                  "option_pricing": State.Holdings.option_pricing.value,
+                  "option_chains": {asset: chain.get_fingerprint() for asset, chain in chains.items()
+                                    if chain is not None},
+                  "data": State.HoldingsStrategy.price_matrix.get_fingerprint(state.get_assets(), end_date)}
+        encoded = json.dumps(config, sort_keys=True, default=str)
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Returns: the final state cached under key. None if there is no such entry
+        """
+        path = self._get_path(key, "pkl")
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        os.utime(path)
+        return state
+
+    def put(self, key, state):
+        """
+        Caches the final state of a backtest under key, then evicts old entries if the
+        cache is over its size limit
+        """
+        path = self._get_path(key, "pkl")
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        with open(self._get_path(key, "json"), 'w') as f:
+            json.dump({"assets": state.get_assets(),
+                       "created": time.time()}, f)
+        self.evict()
+
+    def get_entries(self):
+        """
+        Returns: a list of (last used time, size, key) of every entry, least recently used first
+        """
+        entries = []
+        for filename in os.listdir(self._directory):
+            if filename.endswith(".pkl"):
+                stat = os.stat(os.path.join(self._directory, filename))
+                entries.append((stat.st_mtime, stat.st_size, filename[:-4]))
+        return sorted(entries)
+
+    def remove(self, key):
+        """
+        Removes the entry cached under key
+        """
+        for extension in ("pkl", "json"):
+            try:
+                os.remove(self._get_path(key, extension))
+            except FileNotFoundError:
+                pass
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is within max_bytes
+        """
+        entries = self.get_entries()
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total_bytes <= self._max_bytes:
+                break
+            self.remove(key)
+            total_bytes -= size
+
+    def invalidate(self, assets=None):
+        """
+        Removes every entry that used any of assets, or every entry if assets is None.
+        Call this after refreshing price data.
+
+        Returns: the number of entries removed
+        """
+        count = 0
+        for _, _, key in self.get_entries():
+            if assets is not None:
+                try:
+                    with open(self._get_path(key, "json")) as f:
+                        used_assets = json.load(f)["assets"]
+                except (FileNotFoundError, ValueError):
+                    used_assets = None
+                if used_assets is not None and not set(used_assets) & set(assets):
+                    continue
+            self.remove(key)
+            count += 1
+        Helper.log_info(f"Invalidated {count} cached backtests")
+        return count
@@ -0,0 +1,165 @@
+import numpy as np
+
+# The rules a position can exit on, in the order they are checked
+EXIT_REASONS = ("stop loss", "take profit", "trailing stop", "time stop")
+
+
+class RiskRules(object):
+    """
+    A class representing the exit rules of a position.
+
+    stop_loss, take_profit and trailing_stop are fractions of the entry price (of the
+    premium, for options): a position exits when it has lost stop_loss, gained
+    take_profit, or given back trailing_stop from the best price it has reached. For short
+    positions gains are price drops. max_holding_days is the number of calendar days after
+    which the position exits. None disables a rule.
+    """
+
+    def __init__(self, stop_loss=None, take_profit=None, trailing_stop=None, max_holding_days=None):
+        self._stop_loss = stop_loss
+        self._take_profit = take_profit
+        self._trailing_stop = trailing_stop
+        self._max_holding_days = max_holding_days
+
+    def __repr__(self):
+        return f"RiskRules({self.get_config()})"
+
+    def get_config(self):
+        """
+        Returns: the thresholds of these rules
+        """
+        return {"stop_loss": self._stop_loss, "take_profit": self._take_profit,
+                "trailing_stop": self._trailing_stop, "max_holding_days": self._max_holding_days}
+
+    def get_thresholds(self):
+        """
+        Returns: the vector of thresholds in the order of EXIT_REASONS, nan for disabled rules
+        """
+        return np.array([np.nan if threshold is None else threshold for threshold in
+                         (self._stop_loss, self._take_profit, self._trailing_stop,
+                          self._max_holding_days)], dtype=float)
+
+
+class RiskManager(object):
+    """
+    A class that watches every open position of a portfolio for exits.
+
+    The side, entry price, entry date, best price and rule thresholds of each position are
+    kept in arrays, one row per position, that are updated as fills come in. Checking
+    every position against the prices of a bar is then one vectorized comparison, and the
+    positions to exit are returned together.
+    """
+
+    def __init__(self, default_rules=None, capacity=64):
+        self._default_rules = default_rules if default_rules is not None else RiskRules()
+        self._symbols = []
+        self._index = {}
+        self._sides = np.zeros(capacity)
+        self._entry_prices = np.zeros(capacity)
+        self._entry_dates = np.zeros(capacity, dtype='datetime64[D]')
+        self._best_prices = np.zeros(capacity)
+        self._thresholds = np.full((capacity, len(EXIT_REASONS)), np.nan)
+        self._is_option = np.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return len(self._symbols)
+
+    def get_config(self):
+        """
+        Returns: the parameters that determine the exits of this manager
+        """
+        return {"default_rules": self._default_rules.get_config()}
+
+    def get_symbols(self):
+        """
+        Returns: the symbols of the watched positions, in row order
+        """
+        return self._symbols
+
+    def is_watching(self, symbol):
+        """
+        Returns: True if the position in symbol is watched. False otherwise
+        """
+        return symbol in self._index
+
+    def get_is_option(self):
+        """
+        Returns: the boolean vector that is True for each watched position that is an option
+        """
+        return self._is_option[:len(self._symbols)]
+
+    def _grow(self):
+        """
+        Doubles the number of rows of the arrays
+        """
+        for name in ("_sides", "_entry_prices", "_entry_dates", "_best_prices", "_thresholds",
+                     "_is_option"):
+            array = getattr(self, name)
+            grown = np.zeros((2 * len(array),) + array.shape[1:], dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+    def _remove(self, symbol):
+        """
+        Stops watching symbol, moving the last row into its row
+        """
+        i = self._index.pop(symbol)
+        last = len(self._symbols) - 1
+        if i != last:
+            moved = self._symbols[last]
+            self._symbols[i] = moved
+            self._index[moved] = i
+            for array in (self._sides, self._entry_prices, self._entry_dates, self._best_prices,
+                          self._thresholds, self._is_option):
+                array[i] = array[last]
+        self._symbols.pop()
+
+    def update_position(self, symbol, quantity, entry_price, cur_date, rules=None, is_option=False):
+        """
+        Records that quantity (signed) of symbol is now held at the average entry_price. A
+        new position (or one that changed side) starts its entry date and best price on
+        cur_date with rules (default: the manager's rules). A closed position (quantity 0)
+        is no longer watched.
+        """
+        side = np.sign(quantity)
+        if side == 0:
+            if symbol in self._index:
+                self._remove(symbol)
+            return
+        i = self._index.get(symbol)
+        if i is None or self._sides[i] != side:
+            if i is None:
+                if len(self._symbols) == len(self._sides):
+                    self._grow()
+                i = len(self._symbols)
+                self._symbols.append(symbol)
+                self._index[symbol] = i
+            rules = rules if rules is not None else self._default_rules
+            self._sides[i] = side
+            self._entry_dates[i] = np.datetime64(str(cur_date), 'D')
+            self._best_prices[i] = entry_price
+            self._thresholds[i] = rules.get_thresholds()
+            self._is_option[i] = is_option
+        self._entry_prices[i] = entry_price
+
+    def check(self, prices, cur_date):
+        """
+        Updates the best price of every position with prices (a vector in row order) and
+        returns: (exits, reasons), a boolean vector that is True for each position that
+        hits one of its rules, and the index in EXIT_REASONS of the first rule it hits
+        """
+        n = len(self._symbols)
+        prices = np.asarray(prices, dtype=float)
+        sides = self._sides[:n]
+        best_prices = np.where(sides > 0, np.maximum(self._best_prices[:n], prices),
+                               np.minimum(self._best_prices[:n], prices))
+        self._best_prices[:n] = best_prices
+        thresholds = self._thresholds[:n]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            returns = sides * (prices - self._entry_prices[:n]) / self._entry_prices[:n]
+            drawdowns = sides * (prices - best_prices) / best_prices
+            days = (np.datetime64(str(cur_date), 'D') -
+                    self._entry_dates[:n]).astype(float)
+            hits = np.column_stack([returns <= -thresholds[:, 0], returns >= thresholds[:, 1],
+                                    drawdowns <= -thresholds[:, 2], days >= thresholds[:, 3]])
+        return hits.any(axis=1), hits.argmax(axis=1)
@@ -0,0 +1,188 @@
+from abc import ABC, abstractmethod
+import numpy as np
+
+
+class RollingWindow(object):
+    """
+    A class representing the last length bars of a vector of symbols.
+
+    Bars are kept in a (length x symbol) ring buffer, so adding a bar costs one row
+    write and the window statistics are single vectorized reductions.
+    """
+
+    def __init__(self, num_symbols, length):
+        self._length = length
+        self._buffer = np.full((length, num_symbols), np.nan)
+        self._position = 0
+        self._count = 0
+
+    def get_length(self):
+        """
+        Returns: the number of bars this window holds when full
+        """
+        return self._length
+
+    def is_full(self):
+        """
+        Returns: True if the window holds length bars. False otherwise
+        """
+        return self._count == self._length
+
+    def clear(self):
+        """
+        Removes every bar from the window
+        """
+        self._buffer[:] = np.nan
+        self._position = 0
+        self._count = 0
+
+    def add(self, values):
+        """
+        Adds a bar (a vector with one value per symbol), dropping the oldest one if the
+        window is full
+        """
+        self._buffer[self._position] = values
+        self._position = (self._position + 1) % self._length
+        self._count = min(self._count + 1, self._length)
+
+    def fill(self, history):
+        """
+        Replaces the window with the last length bars of history, a (bar x symbol) array
+        ordered oldest first
+        """
+        self.clear()
+        for values in np.asarray(history, dtype=float)[-self._length:]:
+            self.add(values)
+
+    def get_oldest(self):
+        """
+        Returns: the oldest bar in the window, the one the next add drops if it is full
+        """
+        return self._buffer[self._position if self._count == self._length else 0]
+
+    def get_values(self):
+        """
+        Returns: the (bar x symbol) array of the bars in the window, oldest first
+        """
+        if self._count < self._length:
+            return self._buffer[:self._count]
+        return np.roll(self._buffer, -self._position, axis=0)
+
+    def min(self):
+        """
+        Returns: the minimum of each symbol over the window
+        """
+        return self._buffer.min(axis=0)
+
+    def max(self):
+        """
+        Returns: the maximum of each symbol over the window
+        """
+        return self._buffer.max(axis=0)
+
+    def std(self, ddof=1):
+        """
+        Returns: the standard deviation of each symbol over the window
+        """
+        return self._buffer.std(axis=0, ddof=ddof)
+
+
+class PeriodSignal(ABC):
+    """
+    Abstract class representing a signal that compares a price with the closing prices
+    of the last week_length bars (+/- sd standard deviations).
+
+    The window statistics are computed once per bar, so evaluating a quote costs
+    O(symbols) no matter how many quotes arrive between bars. The signal is False for a
+    symbol until its window is full.
+    """
+
+    def __init__(self, symbols, sd=0, week_length=5):
+        self._symbols = list(symbols)
+        self._symbol_index = {symbol: i for i, symbol in enumerate(self._symbols)}
+        self._standard_deviation = sd
+        self._week_length = week_length
+        self._window = RollingWindow(len(self._symbols), week_length)
+        self._stats = None
+
+    def get_symbols(self):
+        """
+        Returns: the symbols of this signal, in vector order
+        """
+        return self._symbols
+
+    def get_week_length(self):
+        """
+        Returns: the number of bars in the window
+        """
+        return self._week_length
+
+    def warm_up(self, closes):
+        """
+        Fills the window with the last week_length rows of closes, a (bar x symbol)
+        array ordered oldest first
+        """
+        self._window.fill(closes)
+        self._stats = None
+
+    def add_bar(self, closes):
+        """
+        Adds a completed bar (a vector of closing prices, one per symbol) to the window
+        """
+        self._window.add(closes)
+        self._stats = None
+
+    def get_stats(self):
+        """
+        Returns: the (min, max, std) vectors of the closing prices in the window
+        """
+        if self._stats is None:
+            if self._standard_deviation:
+                std = self._window.std()
+            else:
+                std = np.zeros(len(self._symbols))
+            self._stats = self._window.min(), self._window.max(), std
+        return self._stats
+
+    @abstractmethod
+    def compare(self, prices, lowest, highest, std):
+        """
+        Returns: the signal for prices given the window statistics
+        """
+        pass
+
+    def is_true(self, prices):
+        """
+        Returns: a boolean vector that is True for each symbol whose price signals
+        """
+        lowest, highest, std = self.get_stats()
+        with np.errstate(invalid='ignore'):
+            return self.compare(np.asarray(prices, dtype=float), lowest, highest, std)
+
+    def is_true_for(self, symbol, price):
+        """
+        Returns: True if the price of symbol signals. False otherwise
+        """
+        i = self._symbol_index[symbol]
+        lowest, highest, std = self.get_stats()
+        return bool(self.compare(float(price), lowest[i], highest[i], std[i]))
+
+
+class LowForPeriod(PeriodSignal):
+    """
+    Signal: True if the price is below the lowest close of the period (+ n standard
+    deviations)
+    """
+
+    def compare(self, prices, lowest, highest, std):
+        return prices < lowest + self._standard_deviation * std
+
+
+class HighForPeriod(PeriodSignal):
+    """
+    Signal: True if the price is above the highest close of the period (+ n standard
+    deviations)
+    """
+
+    def compare(self, prices, lowest, highest, std):
+        return prices > highest + self._standard_deviation * std
@@ -2,13 +2,24 @@ from enum import IntFlag, Enum
 from datetime import date, timedelta, datetime
 from pandas_datareader import data
 import Helper
+import Pricing
+import OptionChain
+import Orders
+import Fills
+import Margin
+import Profiling
+import RiskManager
+import tradier
 import pandas as pd
-import requests
+import numpy as np
 import os
 import re
+import bisect
 import calendar
+import hashlib
+import json
+import time
 from pathlib import Path
-from collections import Counter
 
 
 def load_stock_data(stock):
@@ -21,18 +32,256 @@ def load_stock_data(stock):
             the_date -= timedelta(1)
         assert str(df.iloc[-1].name) == str(the_date)
     except:
+        request_start = time.perf_counter()
         df = data.DataReader(stock,
                              start='2015-01-01',
                              end=date.today().strftime("%m/%d/%Y"),
                              data_source='yahoo')
+        Profiling.observe_latency("yahoo daily history", time.perf_counter() - request_start)
         df.to_csv(f"{path}/{stock}.csv")
     return df
 
 
 def load_crypto_data(crypto):
-    df = pd.read_csv(
-        f"price_data/hourly/{crypto}.csv", index_col="Date")
-    return df
+    """
+    Returns: the hourly prices of crypto (a CryptoDataDownload hourly CSV) as one row per
+    day, with the close of every hour in the hour's column ("12-AM" ... "11-PM") and the
+    day's Open, High, Low and Close
+    """
+    path = os.path.dirname(Path(__file__).absolute()) + '/price_data/hourly'
+    with open(f"{path}/{crypto}.csv") as f:
+        has_banner = "Date" not in f.readline()
+    df = pd.read_csv(f"{path}/{crypto}.csv", skiprows=1 if has_banner else 0)
+    try:
+        times = pd.to_datetime(df["Date"], format="%Y-%m-%d %I-%p")
+    except ValueError:
+        times = pd.to_datetime(df["Date"])
+    df = df.assign(day=times.dt.strftime("%Y-%m-%d"), hour=times.dt.strftime("%I-%p"),
+                   time=times).sort_values("time")
+    days = df.groupby("day")
+    hourly = df.pivot_table(index="day", columns="hour", values="Close", aggfunc="last")
+    hourly = hourly.reindex(columns=Time.resolution_dict[Resolution.Hourly])
+    daily = pd.DataFrame({"Open": days["Open"].first(), "High": days["High"].max(),
+                          "Low": days["Low"].min(), "Close": days["Close"].last()})
+    result = pd.concat([daily, hourly], axis=1)
+    result.index.name = "Date"
+    return result
+
+
+def get_asset_type(asset):
+    """
+    Returns: Assets.Crypto if asset has hourly price data (price_data/hourly/<asset>.csv),
+    which is only kept for crypto. Assets.Stocks otherwise
+    """
+    path = os.path.dirname(Path(__file__).absolute()) + '/price_data/hourly'
+    return Assets.Crypto if os.path.isfile(f"{path}/{asset}.csv") else Assets.Stocks
+
+
+class PriceMatrix(object):
+    """
+    A class representing the price history of a universe of assets.
+
+    Prices are stored as one 2-D (date x symbol) array per price label (Open, Close, ...)
+    so that a whole universe can be looked up, compared or valued in a single vector
+    operation instead of one DataFrame lookup per symbol. Missing bars are forward filled.
+    """
+
+    def __init__(self):
+        self._symbols = []
+        self._symbol_index = {}
+        self._dates = []
+        self._date_index = {}
+        self._fields = {}
+        self._version = 0
+
+    def __contains__(self, symbol):
+        return symbol in self._symbol_index
+
+    def __len__(self):
+        return len(self._symbols)
+
+    @staticmethod
+    def _normalize_index(df):
+        """
+        Returns: df with its index as 'YYYY-MM-DD' strings
+        """
+        df = df.copy()
+        df.index = pd.to_datetime(df.index).strftime("%Y-%m-%d")
+        return df[~df.index.duplicated(keep='last')]
+
+    def add_symbols(self, frames):
+        """
+        Adds the dataframes in frames (a dict of symbol -> dataframe) to the matrix.
+
+        All symbols are aligned on the union of their dates in one pass. Symbols that are
+        already in the matrix are replaced. A price label that only some symbols have (e.g.
+        the hourly labels of crypto) is nan for the others.
+        """
+        if not frames:
+            return
+        all_frames = {symbol: self.get_dataframe(symbol)
+                      for symbol in self._symbols if symbol not in frames}
+        for symbol in frames:
+            all_frames[symbol] = PriceMatrix._normalize_index(frames[symbol])
+        symbols = list(all_frames.keys())
+        columns = list(dict.fromkeys(
+            column for symbol in symbols for column in all_frames[symbol].columns))
+        panel = pd.concat([all_frames[symbol].reindex(columns=columns) for symbol in symbols],
+                          axis=1, keys=symbols, join='outer').sort_index()
+        panel = panel.ffill()
+        self._symbols = symbols
+        self._symbol_index = {symbol: i for i, symbol in enumerate(symbols)}
+        self._dates = list(panel.index)
+        self._date_index = {d: i for i, d in enumerate(self._dates)}
+        self._fields = {}
+        for column in columns:
+            self._fields[column] = np.ascontiguousarray(
+                panel.xs(column, axis=1, level=1)[symbols].to_numpy(dtype=np.float64))
+        self._version += 1
+
+    def save(self, directory):
+        """
+        Saves the matrix to directory as one .npy file per price label, so that it can be
+        memory-mapped by other processes with load
+        """
+        os.makedirs(directory, exist_ok=True)
+        labels = list(self._fields.keys())
+        for i, label in enumerate(labels):
+            np.save(os.path.join(directory, f"field{i}.npy"), self._fields[label])
+        with open(os.path.join(directory, "index.json"), 'w') as f:
+            json.dump({"symbols": self._symbols, "dates": self._dates,
+                       "labels": labels}, f)
+
+    def load(self, directory, mmap_mode='r'):
+        """
+        Replaces the contents of this matrix with the matrix saved in directory. By default
+        the arrays are memory-mapped read-only instead of read into memory.
+        """
+        with open(os.path.join(directory, "index.json")) as f:
+            index = json.load(f)
+        self._symbols = index["symbols"]
+        self._symbol_index = {symbol: i for i, symbol in enumerate(self._symbols)}
+        self._dates = index["dates"]
+        self._date_index = {d: i for i, d in enumerate(self._dates)}
+        self._fields = {}
+        for i, label in enumerate(index["labels"]):
+            self._fields[label] = np.load(os.path.join(
+                directory, f"field{i}.npy"), mmap_mode=mmap_mode)
+        self._version += 1
+
+    def set_rows(self, rows, symbols, values):
+        """
+        Overwrites the prices of symbols on rows (a slice or index array) with values, a
+        dict of price label -> (row x symbol) array. A memory-mapped label is copied into
+        memory the first time it is written.
+        """
+        index = np.ix_(np.arange(len(self._dates))[rows], self.get_symbol_indices(symbols))
+        for label, array in values.items():
+            field = self._fields[label]
+            if not field.flags.writeable:
+                field = self._fields[label] = np.array(field)
+            field[index] = array
+        self._version += 1
+
+    def get_dataframe(self, symbol):
+        """
+        Returns: the per-symbol dataframe for symbol
+        """
+        j = self._symbol_index[symbol]
+        return pd.DataFrame({label: self._fields[label][:, j] for label in self._fields},
+                            index=pd.Index(self._dates, name="Date")).dropna(how='all')
+
+    def get_symbols(self):
+        """
+        Returns: the symbols in this matrix, in column order
+        """
+        return self._symbols
+
+    def get_symbol_indices(self, symbols):
+        """
+        Returns: an array of the column of each symbol in symbols
+        """
+        return np.fromiter((self._symbol_index[s] for s in symbols), dtype=np.intp, count=len(symbols))
+
+    def get_dates(self):
+        """
+        Returns: the dates in this matrix, in row order
+        """
+        return self._dates
+
+    def get_version(self):
+        """
+        Returns: a number that changes every time the matrix is rebuilt
+        """
+        return self._version
+
+    def get_field(self, label):
+        """
+        Returns: the (date x symbol) array for the price label
+        """
+        return self._fields[label]
+
+    def has_field(self, label):
+        """
+        Returns: True if the matrix has the price label. False otherwise
+        """
+        return label in self._fields
+
+    def get_row(self, current_date, exact=False):
+        """
+        Returns: the row of current_date. If exact is False and there is no bar on
+        current_date, the row of the last bar before it. None if there is no such row.
+        """
+        key = str(current_date)
+        if key in self._date_index:
+            return self._date_index[key]
+        if exact:
+            return None
+        row = bisect.bisect_right(self._dates, key) - 1
+        return row if row >= 0 else None
+
+    def get_prices(self, current_date, label, symbols=None):
+        """
+        Returns: the vector of label prices on current_date (or the last bar before it)
+        for symbols. Defaults to every symbol in the matrix.
+        """
+        row = self.get_row(current_date)
+        if row is None:
+            Helper.log_error(f"No price data on or before {current_date}")
+        prices = self._fields[str(label)][row]
+        if symbols is None:
+            return prices
+        return prices[self.get_symbol_indices(symbols)]
+
+    def get_price(self, symbol, current_date, label):
+        """
+        Returns: the label price of symbol on current_date (or the last bar before it)
+        """
+        row = self.get_row(current_date)
+        if row is None:
+            Helper.log_error(f"No price data for {symbol} on or before {current_date}")
+        return self._fields[str(label)][row, self._symbol_index[symbol]]
+
+    def get_fingerprint(self, symbols, end_date=None):
+        """
+        Returns: a hash of the price data of symbols up to and including end_date
+        """
+        row = len(self._dates) - 1 if end_date is None else self.get_row(end_date)
+        row = -1 if row is None else row
+        columns = self.get_symbol_indices(symbols)
+        digest = hashlib.sha256()
+        digest.update(json.dumps([list(symbols), self._dates[:row + 1]]).encode())
+        for label in sorted(self._fields):
+            digest.update(label.encode())
+            digest.update(np.ascontiguousarray(
+                self._fields[label][:row + 1, columns]).tobytes())
+        return digest.hexdigest()
+
+    def get_window(self, row, length, label):
+        """
+        Returns: the (length x symbol) array of the label prices on the length rows before row
+        """
+        return self._fields[label][max(row - length, 0):row]
 
 
 class Assets(Enum):
@@ -41,6 +290,19 @@ class Assets(Enum):
     Crypto = 'crypto'
 
 
+class OptionPricing(Enum):
+    """
+    Where option prices come from: market history only, market history with the pricing
+    model filling in missing contracts and dates, or the pricing model only (no network)
+    """
+    Market = 'market'
+    Fallback = 'fallback'
+    Model = 'model'
+
+
+GREEKS = ("delta", "gamma", "vega", "theta")
+
+
 class OptionLength(IntFlag):
     """
     Option length
@@ -61,9 +323,9 @@ class BacktestingState(object):
     def __init__(self, asset_list, portfolio, current_date, resolution):
         self._portfolio = portfolio
         self._strategies = {}
-        self._portfolio_history = pd.DataFrame(
-            columns=["Strategy Value", "HODL Value"])
-        self._history_length = 0
+        self._strategy_values = []
+        self._hodl_values = []
+        self._value_times = []
         current_time = str(Time(resolution))
         self._initial_datetime = current_date, current_time
         self._buy_history = []
@@ -72,13 +334,11 @@ class BacktestingState(object):
         self._stocks_to_sell = set()
         self._start_date = current_date
         initial_value = self._portfolio.get_initial_value()
-        len_list = len(asset_list)
-        self._hodl_comparison = {}
-        for asset in asset_list:
-            price = HoldingsStrategy.get_stock_price(asset,
-                                                     current_date, Resolution.time_init(resolution))
-            num_shares = initial_value / price / len_list
-            self._hodl_comparison[asset] = num_shares
+        HoldingsStrategy.load_assets(asset_list)
+        self._hodl_assets = list(asset_list)
+        prices = HoldingsStrategy.get_stock_prices(
+            self._hodl_assets, current_date, Resolution.time_init(resolution))
+        self._hodl_comparison = initial_value / prices / len(asset_list)
 
     def acknowledge_buy(self, strategy, date, time):
         """
@@ -114,9 +374,18 @@ class BacktestingState(object):
 
     def get_portfolio_history(self):
         """
-        Returns: the portfolio history
+        Returns: the portfolio history, indexed by the date and time of each bar
         """
-        return self._portfolio_history, self._buy_history, self._sell_history
+        portfolio_history = pd.DataFrame({"Strategy Value": self._strategy_values,
+                                          "HODL Value": self._hodl_values},
+                                         index=pd.Index(self._value_times, name="Time"))
+        return portfolio_history, self._buy_history, self._sell_history
+
+    def get_strategy_values(self):
+        """
+        Returns: the list of portfolio values of every bar so far
+        """
+        return self._strategy_values
 
     def get_strategies(self):
         """
@@ -124,6 +393,14 @@ class BacktestingState(object):
         """
         return self._strategies
 
+    def trades_around_the_clock(self):
+        """
+        Returns: True if every strategy trades crypto, which trades on weekends and
+        holidays too. False otherwise
+        """
+        return bool(self._strategies) and all(strategy.get_asset_type() == Assets.Crypto
+                                              for strategy in self._strategies)
+
     def buying_conditions_are_met(self, strategy, current_date, current_time):
         """
         Returns: True if buying conditions are met. False otherwise
@@ -173,17 +450,20 @@ class BacktestingState(object):
         """
         Returns: a snapshot of the portfolio
         """
-        initial_value = self._portfolio_history.iloc[0]['Strategy Value']
-        current_value = self._portfolio_history.iloc[-1]['Strategy Value']
+        initial_value = self._strategy_values[0]
+        current_value = self._strategy_values[-1]
         buying_power = self._portfolio.get_buying_power()
+        margin_requirement = self._portfolio.get_margin_requirement(date, time)
         holdings = self._portfolio.get_holdings()
-        percent_change = round(100 * ((self._portfolio_history.iloc[-1] /
-                                       self._portfolio_history.iloc[0]) - 1), 2)
+        percent_change = round(100 * ((current_value / initial_value) - 1), 2)
+        hodl_percent_change = round(
+            100 * ((self._hodl_values[-1] / self._hodl_values[0]) - 1), 2)
 
         return f"Snapshot:\nInitial Value: {initial_value}\nCurrent Value: {current_value}" + \
-            f"\nBuying Power: {buying_power}\nCurrent Holdings: {holdings}\n" + \
-            f"Percent Change from Start: {percent_change['Strategy Value']}%\n" +\
-            f"Percent Change for HODL: {percent_change['HODL Value']}%"
+            f"\nBuying Power: {buying_power}\nMargin Requirement: {margin_requirement}" + \
+            f"\nCurrent Holdings: {holdings}\n" + \
+            f"Percent Change from Start: {percent_change}%\n" +\
+            f"Percent Change for HODL: {hodl_percent_change}%"
 
     def add_strategy(self, strategy):
         """
@@ -197,14 +477,21 @@ class BacktestingState(object):
         Adds the portfolio value (and HODL value)
         """
 
-        strat_value = self._portfolio.get_portfolio_value(cur_date, cur_time)
-        hodl_value = 0
-        for stock in self._hodl_comparison:
-            hodl_value += HoldingsStrategy.get_stock_price(stock,
-                                                           cur_date, cur_time) * self._hodl_comparison[stock]
-        self._portfolio_history.loc[self._history_length] = [
-            strat_value, hodl_value]
-        self._history_length += 1
+        with Profiling.phase("valuation"):
+            self._portfolio.get_margin_account().update_prices()
+            strat_value = self._portfolio.get_portfolio_value(cur_date, cur_time)
+            hodl_value = float(np.dot(HoldingsStrategy.get_stock_prices(
+                self._hodl_assets, cur_date, cur_time), self._hodl_comparison))
+            self._strategy_values.append(strat_value)
+            self._hodl_values.append(hodl_value)
+            self._value_times.append(f"{cur_date} {cur_time}")
+        with Profiling.phase("expiry sweep"):
+            self._liquidate_expired(cur_date)
+
+    def _liquidate_expired(self, cur_date):
+        """
+        Liquidates the option positions that expired before cur_date
+        """
         holdings = self._portfolio.get_holdings()
         positions_to_sell = {}
         for key in holdings:
@@ -220,10 +507,28 @@ class BacktestingState(object):
 
                     if cur_date > expiration_obj.date():
                         num_positions = positions[position][0]
-                        positions_to_sell[position] = num_positions
-        for position in positions_to_sell:
+                        positions_to_sell[position] = (
+                            key, expiration_obj.date(), num_positions)
+        for position, (key, expiration_date, num_positions) in positions_to_sell.items():
             self._portfolio.liquidate(
-                key, position, expiration_obj.date(), num_positions)
+                key, position, expiration_date, num_positions)
+
+    def get_config(self):
+        """
+        Returns: the parameters that determine the result of a backtest of this state
+        """
+        return {"portfolio": self._portfolio.get_config(), "hodl_assets": self._hodl_assets,
+                "start_date": str(self._start_date),
+                "strategies": [strategy.get_config() for strategy in self._strategies]}
+
+    def get_assets(self):
+        """
+        Returns: every asset traded or benchmarked in this state
+        """
+        assets = list(self._hodl_assets)
+        for strategy in self._strategies:
+            assets.extend(a for a in strategy.get_asset_names() if a not in assets)
+        return assets
 
     def add_initial_holdings(self, holding_list, date, resolution):
         """
@@ -248,20 +553,33 @@ class Holdings(object):
     """
     options_prices = {}
     failed_options_prices = {}
+    option_pricing = OptionPricing.Fallback
+    # Underlying -> OptionChain of the exchange's listing, when one is known
+    option_chains = None
+    # Fractional (crypto) positions smaller than this are considered closed
+    DUST = 1e-9
 
     def __init__(self, holding_name, num_shares, initial_price, options_df=None, type_asset=Assets.Stocks,
                  initial_purchase_date=None):
         self._type = type_asset
-        if Helper.hasNumbers(holding_name):
-            match = re.match(r"(\D+)(\d{2})(\d{2})(\d{2})", holding_name)
-            self._underlying_name = match.group(1)
-        else:
-            self._underlying_name = holding_name
+        self._underlying_name = Holdings.get_underlying(holding_name)
         self._position_list = dict()
         self._position_list[holding_name] = [
             num_shares, initial_price, str(initial_purchase_date)]
         Holdings.options_prices[holding_name] = options_df
 
+    @staticmethod
+    def get_underlying(holding_name):
+        """
+        Returns: the underlying of an option symbol, or holding_name itself for a stock or
+        crypto
+        """
+        if Helper.hasNumbers(holding_name):
+            match = re.match(r"(\D+)(\d{2})(\d{2})(\d{2})", holding_name)
+            if match:
+                return match.group(1)
+        return holding_name
+
     def __hash__(self):
         return hash(self._underlying_name)
 
@@ -275,22 +593,95 @@ class Holdings(object):
         return self.__str__()
 
     @staticmethod
-    def get_options_symbol(stock, last_price, current_date, strikes_above=0, option_type='C', expiration_length=OptionLength.Monthly):
-        if last_price < 20:
-            strike = round(last_price + strikes_above)
-        elif last_price < 100:
-            strike = 5 * round((last_price + 5 * strikes_above) / 5)
-        else:
-            strike = 10 * round((last_price + 10 * strikes_above) / 10)
+    def _select_contract(stock, last_price, current_date, strikes_above, option_type, expiration_length,
+                         target_delta):
+        """
+        Returns: (expiration, strike, chain) of the option picked by get_options_symbol,
+        where chain is the chain the strike was picked from (None for the standard grid)
+        """
         # Get strike price 4 weeks out
         friday = Portfolio._option_expiration(current_date, expiration_length)
-        match = re.search(r"20(\d\d)-(\d\d)-(\d\d)", str(friday))
-        str_price = str(int(strike))
-        while len(str_price) < 5:
-            str_price = '0' + str_price
-        str_price = str_price + "000"
-        symbol = f"{stock}{match.group(1)}{match.group(2)}{match.group(3)}{option_type}{str_price}"
-        return symbol
+        chain = Holdings.get_option_chain(stock)
+        expiration = chain.get_expiration(friday) if chain is not None else None
+        if expiration is None:
+            chain = None
+        if target_delta is not None:
+            if chain is None:
+                expiration = friday
+                chain = OptionChain.OptionChain(stock)
+                chain.add_standard_strikes(expiration, option_type, last_price)
+            strike = chain.select_by_delta(expiration, option_type, target_delta, last_price, current_date,
+                                           Holdings.estimate_volatility(stock, current_date))
+            strike = chain.offset_strike(
+                expiration, option_type, strike, strikes_above)
+        else:
+            step = OptionChain.standard_strike_step(last_price)
+            strike = step * round((last_price + step * strikes_above) / step)
+            if chain is not None:
+                strike = chain.nearest_strike(expiration, option_type, strike)
+            else:
+                expiration = friday
+        return expiration, strike, chain
+
+    @staticmethod
+    def get_options_symbol(stock, last_price, current_date, strikes_above=0, option_type='C', expiration_length=OptionLength.Monthly,
+                           target_delta=None):
+        """
+        Returns: the symbol of the option on stock expiring around expiration_length from
+        current_date. The strike is strikes_above standard strike steps from last_price, or
+        if target_delta is given, strikes_above listed strikes from the strike with the
+        closest delta. When the listing in option_chains lists the expiration, only listed
+        strikes are picked.
+        """
+        expiration, strike, _ = Holdings._select_contract(
+            stock, last_price, current_date, strikes_above, option_type, expiration_length, target_delta)
+        return OptionChain.make_symbol(stock, expiration, option_type, strike)
+
+    @staticmethod
+    def get_spread_symbols(stock, last_price, current_date, strikes_above, spread_width, option_type='C',
+                           expiration_length=OptionLength.Monthly, target_delta=None):
+        """
+        Returns: the symbols of the two legs of a vertical, the option get_options_symbol
+        picks and the one spread_width listed strikes above it. If the chain can't supply
+        a different strike that far, the second leg is spread_width standard strike steps
+        above the first instead, so the legs are never the same contract.
+        """
+        expiration, strike, chain = Holdings._select_contract(
+            stock, last_price, current_date, strikes_above, option_type, expiration_length, target_delta)
+        far_strike = chain.offset_strike(expiration, option_type, strike, spread_width) \
+            if chain is not None else strike
+        if spread_width != 0 and (far_strike - strike) * spread_width <= 0:
+            far_strike = strike + spread_width * OptionChain.standard_strike_step(last_price)
+        return (OptionChain.make_symbol(stock, expiration, option_type, strike),
+                OptionChain.make_symbol(stock, expiration, option_type, far_strike))
+
+    @staticmethod
+    def get_option_chain(underlying):
+        """
+        Returns: the OptionChain of underlying in option_chains, or None if no listing of
+        its contracts is known. option_chains must hold the exchange's listing (see
+        load_option_chains), never the contracts that happen to be downloaded, which
+        would make the traded contracts depend on the local cache
+        """
+        if Holdings.option_chains is None:
+            return None
+        return Holdings.option_chains.get(underlying)
+
+    @staticmethod
+    def load_option_chains(underlyings):
+        """
+        Adds the listings of underlyings in the listings store (see
+        OptionChain.load_listing) to option_chains. The store is refreshed from Tradier
+        first, unless option prices are modelled
+        """
+        if Holdings.option_chains is None:
+            Holdings.option_chains = {}
+        for underlying in underlyings:
+            if underlying not in Holdings.option_chains:
+                chain = OptionChain.load_listing(
+                    underlying, refresh=Holdings.option_pricing != OptionPricing.Model)
+                if chain is not None:
+                    Holdings.option_chains[underlying] = chain
 
     @staticmethod
     def get_options_data(symbol):
@@ -299,48 +690,148 @@ class Holdings(object):
         at a strike price just above strikes above.
         """
         if symbol in Holdings.failed_options_prices:
+            Profiling.count("options data: known missing")
             return None
         if symbol in Holdings.options_prices and Holdings.options_prices[symbol] is not None:
+            Profiling.count("options data: memory hit")
             return Holdings.options_prices[symbol]
+        elif Holdings.option_pricing == OptionPricing.Model:
+            Profiling.count("options data: modelled")
+            with Profiling.phase("option modelling"):
+                df = Holdings.synthesize_options_data(symbol)
+            Holdings.options_prices[symbol] = df
+            return df
         else:
             path = os.path.dirname(
                 Path(__file__).absolute()) + '/price_data/options'
             filename = f"{path}/{symbol}{str(date.today())}.csv"
             df = None
             if os.path.isfile(filename):
+                Profiling.count("options data: disk hit")
                 df = pd.read_csv(filename, header=0, index_col="Date",
                                  names=["Date", "Open", "High", "Low", "Close", "Volume"])
             else:
-                api_key = os.environ['TRADIER_API_KEY']
+                Profiling.count("options data: fetched")
                 try:
-                    trade_data_response = requests.get('https://sandbox.tradier.com/v1/markets/history?',
-                                                       params={'symbol': symbol,
-                                                               'start': '2015-01-01'},
-                                                       headers={'Authorization': api_key,
-                                                                'Accept': 'application/json'})
-                    trade_data_json = trade_data_response.json()
-                    trade_data_arr = trade_data_json['history']['day']
-                    dates = []
-                    trade_data = []
-                    for element in trade_data_arr:
-                        dates.append(element['date'])
-                        trade_data.append([element['open'], element['high'],
-                                           element['low'], element['close'], element['volume']])
-                    df = pd.DataFrame(trade_data, index=dates,
-                                      columns=["Open", "High", "Low", "Close", "Volume"])
+                    df = tradier.get_history(symbol, '2015-01-01')
                     df.to_csv(filename)
                     Holdings.options_prices[symbol] = df
                 except Exception as e:
                     Helper.log_warn(f"Exception: {e}")
-                    Holdings.failed_options_prices[symbol] = True
+                    Profiling.count("options data: fetch failed")
+                    if Holdings.option_pricing == OptionPricing.Fallback:
+                        # Model prices are kept in memory only, never saved as market data
+                        Profiling.count("options data: modelled fallback")
+                        df = Holdings.synthesize_options_data(symbol)
+                        Holdings.options_prices[symbol] = df
+                        Helper.log_info(
+                            f"No history for {symbol}; using model prices")
+                    else:
+                        Holdings.failed_options_prices[symbol] = True
             return df
 
+    @staticmethod
+    def _get_underlying_column(underlying):
+        """
+        Returns: the column of underlying in the price matrix, loading it if needed
+        """
+        if underlying not in HoldingsStrategy.price_matrix:
+            HoldingsStrategy.load_assets([underlying])
+        return HoldingsStrategy.price_matrix.get_symbol_indices([underlying])[0]
+
+    @staticmethod
+    def synthesize_options_data(symbol, history_days=400):
+        """
+        Returns: a dataframe in the shape of the market history of the option symbol, with
+        every bar priced by the Bjerksund-Stensland model from the underlying's bars and
+        an implied volatility estimated from its realized volatility. The history covers
+        the history_days before expiration and has no volume (nan).
+        """
+        underlying, expiration, option_type, strike = Pricing.parse_option_symbol(symbol)
+        column = Holdings._get_underlying_column(underlying)
+        matrix = HoldingsStrategy.price_matrix
+        dates = np.array(matrix.get_dates(), dtype='datetime64[D]')
+        volatility = Pricing.estimate_implied_volatility(
+            Pricing.realized_volatility(matrix.get_field("Close")[:, column]))
+        rows = (dates <= np.datetime64(expiration)) & \
+            (dates > np.datetime64(expiration) - np.timedelta64(history_days, 'D'))
+        is_call = option_type == 'C'
+        prices = {}
+        for label in ("Open", "High", "Low", "Close"):
+            spot = matrix.get_field(label)[rows, column]
+            prices[label] = Pricing.bjerksund_stensland(
+                spot, strike, Pricing.years_to_expiration(dates[rows], expiration, label),
+                volatility[rows], is_call)
+        high = np.maximum.reduce([prices[label] for label in prices])
+        low = np.minimum.reduce([prices[label] for label in prices])
+        df = pd.DataFrame({"Open": prices["Open"], "High": high, "Low": low, "Close": prices["Close"],
+                           "Volume": np.nan}, index=np.asarray(matrix.get_dates())[rows])
+        df[["Open", "High", "Low", "Close"]] = df[[
+            "Open", "High", "Low", "Close"]].round(2).clip(lower=0.01)
+        return df
+
+    @staticmethod
+    def estimate_volatility(underlying, current_date):
+        """
+        Returns: the implied volatility of options on underlying estimated from its
+        realized volatility up to current_date
+        """
+        column = Holdings._get_underlying_column(underlying)
+        row = HoldingsStrategy.price_matrix.get_row(current_date)
+        closes = HoldingsStrategy.price_matrix.get_field("Close")[:, column]
+        return Pricing.estimate_implied_volatility(
+            Pricing.realized_volatility(closes[max(row - 60, 0):row + 1])[-1])
+
+    @staticmethod
+    def estimate_options_price(options_name, current_date, time, df=None):
+        """
+        Returns: the model price of the option on current_date at time. If df (the
+        option's market history) is given, the implied volatility is calibrated to its
+        last close before current_date; otherwise it is estimated from the underlying's
+        realized volatility.
+        """
+        underlying, expiration, option_type, strike = Pricing.parse_option_symbol(
+            options_name)
+        column = Holdings._get_underlying_column(underlying)
+        matrix = HoldingsStrategy.price_matrix
+        row = matrix.get_row(current_date)
+        closes = matrix.get_field("Close")[:, column]
+        is_call = option_type == 'C'
+        earlier = [] if df is None else [d for d in df.index if d < str(current_date)]
+        if earlier:
+            reference_date = earlier[-1]
+            volatility = Pricing.implied_volatility(
+                df.loc[reference_date, "Close"], closes[matrix.get_row(reference_date)], strike,
+                Pricing.years_to_expiration(reference_date, expiration, "Close"), is_call,
+                model=Pricing.bjerksund_stensland)
+        else:
+            volatility = Holdings.estimate_volatility(underlying, current_date)
+        price = Pricing.bjerksund_stensland(
+            matrix.get_field(str(time))[row, column], strike,
+            Pricing.years_to_expiration(current_date, expiration, time), volatility, is_call)
+        return max(round(float(price), 2), 0.01)
+
+    @staticmethod
+    def _is_missing_bar(options_name, df, current_date):
+        """
+        Returns: True if the underlying of options_name traded on current_date, before the
+        option expired, but df has no bar for it. False otherwise
+        """
+        underlying, expiration, _, _ = Pricing.parse_option_symbol(options_name)
+        return str(current_date) not in df.index and current_date <= expiration and \
+            underlying in HoldingsStrategy.price_matrix and \
+            HoldingsStrategy.price_matrix.get_row(current_date, exact=True) is not None
+
     @staticmethod
     def get_options_price(options_name, current_date, time):
         """
         Returns: the current price of the stock at this date and time
         """
         df = Holdings.get_options_data(options_name)
+        if Holdings.option_pricing != OptionPricing.Market and \
+                Holdings._is_missing_bar(options_name, df, current_date):
+            Profiling.count("options price: missing bar modelled")
+            return Holdings.estimate_options_price(options_name, current_date, time, df)
         i = 0
         while True:
             delta = timedelta(days=i)
@@ -374,7 +865,11 @@ class Holdings(object):
                                  for x in re.split(r'[\-]', iloc2.name)]
                     date_obj2 = date(
                         date_arr2[0], date_arr2[1], date_arr2[2])
-                    if j == 0:
+                    Profiling.count("options price: not found, estimated")
+                    if Holdings.option_pricing != OptionPricing.Market:
+                        answer = Holdings.estimate_options_price(
+                            options_name, current_date, time, df)
+                    elif j == 0:
                         answer = (df.loc[str(date_obj)].loc[str(time)])
                     else:
                         answer = (df.loc[str(date_obj)].loc[str(
@@ -385,6 +880,18 @@ class Holdings(object):
                     Helper.log_warn(f"Date not found: {current_date}")
                     return answer
 
+    @staticmethod
+    def get_options_volume(options_name, current_date):
+        """
+        Returns: the number of contracts of the option traded on current_date, or nan if
+        unknown
+        """
+        df = Holdings.get_options_data(options_name)
+        try:
+            return float(df.loc[str(current_date), "Volume"])
+        except (KeyError, TypeError, AttributeError):
+            return np.nan
+
     def get_underlying_name(self):
         """
         Returns: the underlying name of the holdings
@@ -403,6 +910,13 @@ class Holdings(object):
         """
         return self._position_list == dict()
 
+    def get_num_shares(self):
+        """
+        Returns: the number of shares (or coins) held of a stock or crypto holding
+        """
+        return self._position_list[self._underlying_name][0] \
+            if self._underlying_name in self._position_list else 0
+
     def get_positions(self):
         """
         Returns: the positions in this holding.
@@ -417,15 +931,15 @@ class Holdings(object):
             position_info = self._position_list[stock_name]
             positions_before_adding = position_info[0]
             position_info[0] += num_assets
-            if position_info[0] != 0:
-                position_info[1] = (position_info[1] + price *
+            if abs(position_info[0]) > Holdings.DUST:
+                position_info[1] = (position_info[1] * positions_before_adding + price *
                                     num_assets) / (positions_before_adding + num_assets)
 
             Holdings.options_prices[stock_name] = dataframe
         else:
             self._position_list[stock_name] = [
                 num_assets, price, str(initial_purchase_date)]
-        if self._position_list[stock_name][0] == 0:
+        if abs(self._position_list[stock_name][0]) <= Holdings.DUST:
             del self._position_list[stock_name]
 
     def subtract_shares(self, stock_name, num_assets):
@@ -433,7 +947,7 @@ class Holdings(object):
         Adds additional shares to holdings
         """
         self._position_list[stock_name][0] -= num_assets
-        if self._position_list[stock_name][0] == 0:
+        if abs(self._position_list[stock_name][0]) <= Holdings.DUST:
             del self._position_list[stock_name]
 
 
@@ -445,21 +959,20 @@ class HoldingsStrategy(object):
     includes the buying/selling conditions for the stock, and how many days
     between deploying the strategy can it be deployed again
     """
-    stock_info = {}
+    price_matrix = PriceMatrix()
 
     def __init__(self, strategy_name, asset_list, buying_allocation=1, buying_allocation_type='percent_portfolio', maximum_allocation_per_stock=1, option_type='C',
                  minimum_allocation=0.0, buying_delay=1, selling_delay=0, selling_allocation=0.1, assets=Assets.Stocks, must_be_profitable_to_sell=False,
-                 strikes_above=0, expiration_length=OptionLength.Monthly, start_with_spreads=True, spread_type='debit', spread_width=1):
+                 strikes_above=0, expiration_length=OptionLength.Monthly, start_with_spreads=True, spread_type='debit', spread_width=1,
+                 maximum_net_delta=None, target_delta=None, close_as_group=False, risk_rules=None):
         self._strategy_name = strategy_name
         self._stock_list = asset_list
         self._assets = assets
         self._expiration_length = expiration_length
         self._spread_width = spread_width
-        for stock in asset_list:
-            if assets != 'crypto':
-                HoldingsStrategy.stock_info[stock] = load_stock_data(stock)
-            else:
-                HoldingsStrategy.stock_info[stock] = load_crypto_data(stock)
+        HoldingsStrategy.load_assets(asset_list, assets)
+        if assets == Assets.Options:
+            Holdings.load_option_chains(asset_list)
         self._buying_conditions = []
         self._selling_conditions = []
         self._stocks_to_buy = []
@@ -476,6 +989,10 @@ class HoldingsStrategy(object):
         self._option_type = option_type
         self._start_with_spreads = start_with_spreads
         self._spread_type = spread_type
+        self._maximum_net_delta = maximum_net_delta
+        self._target_delta = target_delta
+        self._close_as_group = close_as_group
+        self._risk_rules = risk_rules
 
     def __str__(self):
         """
@@ -489,6 +1006,18 @@ class HoldingsStrategy(object):
         """
         return f"Strategy '{self._strategy_name}' for {self._stock_list}"
 
+    def get_config(self):
+        """
+        Returns: the parameters of this strategy and of its conditions
+        """
+        config = {key: value for key, value in vars(self).items()
+                  if key not in ("_buying_conditions", "_selling_conditions", "_stocks_to_buy", "_stocks_to_sell")}
+        for key in ("_buying_conditions", "_selling_conditions"):
+            conditions = getattr(self, key)
+            config[key] = conditions.get_config() if conditions else None
+        config["_risk_rules"] = self._risk_rules.get_config() if self._risk_rules else None
+        return config
+
     def must_be_profitable(self):
         """
         Returns: whether or not the portfolio must be profitable to sell.
@@ -570,26 +1099,85 @@ class HoldingsStrategy(object):
         """
         self._selling_conditions = selling_conditions
 
+    def closes_as_group(self):
+        """
+        Returns: True if selling an option leg closes every leg of its position group.
+        False otherwise
+        """
+        return self._close_as_group
+
+    def get_target_delta(self):
+        """
+        Returns: the delta options are picked at if this strategy is an option, or None to
+        pick them by strikes above
+        """
+        return self._target_delta
+
+    def get_risk_rules(self):
+        """
+        Returns: the RiskRules of the positions this strategy opens, or None for the
+        portfolio's default rules
+        """
+        return self._risk_rules
+
     def get_strikes_above(self):
         """
         Returns: the stock strategy's strikes above if this strategy is an option
         """
         return self._strikes_above
 
+    @staticmethod
+    def load_assets(asset_list, assets=None, reload=False):
+        """
+        Loads the price data of every asset in asset_list that is not already in the
+        price matrix, and adds them to the matrix in one batch. If reload is True, assets
+        already in the matrix are reloaded too, e.g. to pick up new bars. assets is the
+        type of every asset, or None to pick it per asset (see get_asset_type).
+        """
+        missing = [asset for asset in asset_list
+                   if reload or asset not in HoldingsStrategy.price_matrix]
+        if not missing:
+            return
+        with Profiling.phase("data loading"):
+            frames = {}
+            for asset in missing:
+                if asset in frames:
+                    continue
+                if (assets or get_asset_type(asset)) != Assets.Crypto:
+                    frames[asset] = load_stock_data(asset)
+                else:
+                    frames[asset] = load_crypto_data(asset)
+            HoldingsStrategy.price_matrix.add_symbols(frames)
+
     @staticmethod
     def get_stock_price(stock, current_date, time):
         """
         Returns: the current price of the stock at this date and time
         """
-        if stock in HoldingsStrategy.stock_info:
-            df = HoldingsStrategy.stock_info[stock]
-        else:
-            df = load_stock_data(stock)
-            HoldingsStrategy.stock_info[stock] = df
-        try:
-            return round(df.loc[str(current_date)].loc[str(time)], 2)
-        except KeyError:
-            return round(df.loc[str(current_date - timedelta(1))].loc[str(time)], 2)
+        if stock not in HoldingsStrategy.price_matrix:
+            HoldingsStrategy.load_assets([stock])
+        return round(HoldingsStrategy.price_matrix.get_price(stock, current_date, time), 2)
+
+    @staticmethod
+    def get_stock_prices(stocks, current_date, time):
+        """
+        Returns: the vector of current prices of stocks at this date and time
+        """
+        HoldingsStrategy.load_assets(stocks)
+        return np.round(HoldingsStrategy.price_matrix.get_prices(current_date, time, stocks), 2)
+
+    @staticmethod
+    def get_stock_volumes(stocks, current_date):
+        """
+        Returns: the vector of volumes of stocks on current_date, nan where unknown (no bar
+        on current_date, or no volume in the price data)
+        """
+        HoldingsStrategy.load_assets(stocks)
+        matrix = HoldingsStrategy.price_matrix
+        row = matrix.get_row(current_date, exact=True)
+        if row is None or not matrix.has_field("Volume"):
+            return np.full(len(stocks), np.nan)
+        return matrix.get_field("Volume")[row, matrix.get_symbol_indices(stocks)]
 
     def buying_conditions_are_met(self, date, time):
         """
@@ -627,6 +1215,12 @@ class HoldingsStrategy(object):
         """
         return self._maximum_allocation_for_stock
 
+    def get_maximum_net_delta(self):
+        """
+        Returns: The maximum net delta (in shares) allowed per asset, or None for no limit
+        """
+        return self._maximum_net_delta
+
     def get_minimum_allocation(self):
         """
         Returns: The minimum allocation for this strategy
@@ -652,18 +1246,322 @@ class Portfolio(object):
 
     This class holds information to simulate a portfolio. It includes
     information like the starting amount, the current portfolio holdings,
-    and trading fees
+    and trading fees. Orders are filled by its fill model (see Fills), by default in full
+    at the quoted price for trading_fees per fill. Short option legs are held against a
+    margin requirement (see Margin), and orders are only filled if the buying power in
+    excess of the requirement covers them. If it has a risk manager, every position is
+    checked against its exit rules on every bar.
     """
 
     def __init__(self, initial_cash=100000.00,
-                 trading_fees=0.75):
+                 trading_fees=0.75, fill_model=None, margin_method=Margin.MarginMethod.RegT,
+                 risk_manager=None):
 
         self._current_holdings = {}
         self._buying_power = initial_cash
         self._initial_value = initial_cash
-        self._margin = 0  # will add margin later
+        self._margin = Margin.MarginAccount(margin_method)
+        self._risk_manager = risk_manager
         self._fees = trading_fees
+        self._fill_model = fill_model if fill_model is not None else Fills.PerfectFill(
+            trading_fees)
+        self._pending_orders = []
         self._conditions = []
+        self._journal = []
+        # symbol -> {strategy: contracts (or shares) it opened that are still held}
+        self._open_by_strategy = {}
+        self._position_groups = {}
+        self._next_group_id = 0
+
+    def get_config(self):
+        """
+        Returns: the parameters that determine the result of a backtest of this portfolio
+        """
+        return {"initial_cash": self._initial_value, "trading_fees": self._fees,
+                "fill_model": self._fill_model.get_config(), "margin": self._margin.get_config(),
+                "risk_manager": self._risk_manager.get_config() if self._risk_manager else None}
+
+    def get_margin_account(self):
+        """
+        Returns: the margin account of this portfolio
+        """
+        return self._margin
+
+    @staticmethod
+    def _quote(cur_date, cur_time):
+        """
+        Returns: the quote function of the margin account at this date and time
+        """
+        def quote(underlying, symbols):
+            return (HoldingsStrategy.get_stock_price(underlying, cur_date, cur_time),
+                    np.array([Holdings.get_options_price(symbol, cur_date, cur_time)
+                              for symbol in symbols]))
+        return quote
+
+    def get_margin_requirement(self, cur_date, cur_time):
+        """
+        Returns: the margin requirement of the positions in this portfolio
+        """
+        return self._margin.get_requirement(self._quote(cur_date, cur_time), cur_date, cur_time)
+
+    def get_excess_buying_power(self, cur_date, cur_time):
+        """
+        Returns: the buying power that is not held against the margin requirement
+        """
+        return self.get_buying_power() - self.get_margin_requirement(cur_date, cur_time)
+
+    def has_margin_for(self, symbols, quantities, cost, cur_date, cur_time):
+        """
+        Returns: True if the excess buying power covers cost plus the margin that adding
+        quantities of the option symbols requires. False otherwise
+        """
+        quote = self._quote(cur_date, cur_time)
+        change = self._margin.get_requirement_change(
+            symbols, quantities, quote, cur_date, cur_time) if symbols else 0.0
+        return cost + change < self.get_excess_buying_power(cur_date, cur_time)
+
+    def get_fill_model(self):
+        """
+        Returns: the fill model of this portfolio
+        """
+        return self._fill_model
+
+    def _fill(self, symbols, quantities, prices, cur_date, is_option, fractional=False):
+        """
+        Returns: (fill_prices, filled_quantities, commission) of filling quantities of
+        symbols quoted at prices, according to the fill model
+        """
+        if not self._fill_model.uses_volume:
+            volumes = np.nan
+        elif is_option:
+            volumes = np.array([Holdings.get_options_volume(symbol, cur_date)
+                                for symbol in symbols])
+        else:
+            volumes = HoldingsStrategy.get_stock_volumes(symbols, cur_date)
+        return self._fill_model.fill(prices, quantities, volumes, 100 if is_option else 1,
+                                     fractional)
+
+    def _fill_legs(self, symbols, quantities, prices, cur_date):
+        """
+        Returns: (fill_prices, filled_quantities, commission) of the legs of a multi-leg
+        order. The order fills in whole units (its legs divided by their greatest common
+        divisor), as many as every leg can fill, so that the legs stay in ratio
+        """
+        quantities = np.asarray(quantities, dtype=int)
+        fill_prices, filled, commission = self._fill(
+            symbols, quantities, prices, cur_date, True)
+        if np.array_equal(filled, quantities):
+            return fill_prices, quantities, commission
+        unit = quantities // np.gcd.reduce(np.abs(quantities))
+        num_units = int(np.min(np.abs(filled) // np.abs(unit)))
+        if num_units == 0:
+            return fill_prices, np.zeros_like(quantities), 0.0
+        fill_prices, _, commission = self._fill(
+            symbols, unit * num_units, prices, cur_date, True)
+        return fill_prices, unit * num_units, commission
+
+    def _carry_over(self, kind, arguments, carried):
+        """
+        Queues the unfilled part of an order (the call kind(**arguments) that filled it)
+        to be filled on the next bar, unless it has been carried over the maximum number
+        of bars of the fill model
+        """
+        if carried < self._fill_model.get_max_carry_bars():
+            self._pending_orders.append(
+                {"kind": kind, "arguments": arguments, "carried": carried + 1})
+
+    def get_pending_orders(self):
+        """
+        Returns: the orders that are partially filled and carried over to later bars
+        """
+        return self._pending_orders
+
+    def fill_pending_orders(self, cur_date, cur_time):
+        """
+        Tries to fill the rest of every order carried over from earlier bars
+        """
+        pending_orders, self._pending_orders = self._pending_orders, []
+        for order in pending_orders:
+            getattr(self, order["kind"])(cur_date=cur_date, cur_time=cur_time,
+                                         carried=order["carried"], **order["arguments"])
+
+    def record_fill(self, action, symbol, quantity, price, cur_date, cur_time, strategy=None, group=None):
+        """
+        Adds a fill to the fill journal
+        """
+        self._journal.append({"date": str(cur_date), "time": str(cur_time), "action": action,
+                              "symbol": symbol, "quantity": quantity, "price": price,
+                              "strategy": str(strategy) if strategy is not None else None,
+                              "group": group})
+        if action == "open":
+            self._add_open_by_strategy(symbol, strategy, abs(quantity))
+        else:
+            self._remove_open_by_strategy(symbol, strategy, abs(quantity))
+        if self._risk_manager is not None:
+            self._update_risk_position(symbol, strategy, cur_date)
+
+    def _add_open_by_strategy(self, symbol, strategy, quantity):
+        """
+        Counts quantity of symbol as opened by strategy and still held
+        """
+        held = self._open_by_strategy.setdefault(symbol, {})
+        held[strategy] = held.get(strategy, 0) + quantity
+
+    def _remove_open_by_strategy(self, symbol, strategy, quantity):
+        """
+        Counts quantity of symbol as no longer held, taken from what strategy opened first
+        and then from the other strategies in the order they opened it. Strategies left
+        with nothing held are dropped
+        """
+        held = self._open_by_strategy.get(symbol)
+        if not held:
+            return
+        owners = sorted(held, key=lambda owner: owner is not strategy)
+        for owner in owners:
+            if quantity <= Holdings.DUST:
+                break
+            removed = min(quantity, held[owner])
+            held[owner] -= removed
+            quantity -= removed
+            if held[owner] <= Holdings.DUST:
+                del held[owner]
+        if not held:
+            del self._open_by_strategy[symbol]
+
+    def _update_risk_position(self, symbol, strategy, cur_date):
+        """
+        Passes the position in symbol now held to the risk manager, with the risk rules of
+        strategy
+        """
+        holding = self._current_holdings.get(Holdings.get_underlying(symbol))
+        positions = holding.get_positions() if holding is not None else {}
+        if symbol not in positions:
+            self._risk_manager.update_position(symbol, 0, 0.0, cur_date)
+            return
+        rules = strategy.get_risk_rules() if isinstance(strategy, HoldingsStrategy) else None
+        self._risk_manager.update_position(symbol, positions[symbol][0], positions[symbol][1], cur_date,
+                                           rules, symbol != Holdings.get_underlying(symbol))
+
+    def get_risk_manager(self):
+        """
+        Returns: the risk manager of this portfolio, or None
+        """
+        return self._risk_manager
+
+    def get_position_prices(self, symbols, is_option, cur_date, cur_time):
+        """
+        Returns: the vector of current prices of the positions in symbols, where is_option
+        is the boolean vector that is True for the options among them. Shares are priced
+        in one lookup
+        """
+        prices = np.zeros(len(symbols))
+        is_option = np.asarray(is_option, dtype=bool)
+        share_rows = np.flatnonzero(~is_option)
+        if len(share_rows):
+            prices[share_rows] = HoldingsStrategy.get_stock_prices(
+                [symbols[i] for i in share_rows], cur_date, cur_time)
+        for i in np.flatnonzero(is_option):
+            prices[i] = Holdings.get_options_price(symbols[i], cur_date, cur_time)
+        return prices
+
+    def get_option_positions(self):
+        """
+        Returns: (symbols, quantities, entry_prices), the option positions in this portfolio
+        and the vectors of their signed contracts and average entry prices
+        """
+        symbols = []
+        positions = []
+        for holding in self._current_holdings.values():
+            if holding.get_type() == Assets.Options:
+                for position, position_info in holding.get_positions().items():
+                    symbols.append(position)
+                    positions.append(position_info[:2])
+        positions = np.array(positions, dtype=float).reshape(-1, 2)
+        return symbols, positions[:, 0], positions[:, 1]
+
+    def apply_risk_exits(self, cur_date, cur_time):
+        """
+        Checks every position against its exit rules at the current prices and closes the
+        ones that hit a rule, together. A position that is part of a position group closes
+        the whole group.
+
+        Returns: a dict of each exited symbol to the rule it hit
+        """
+        symbols = list(self._risk_manager.get_symbols())
+        if not symbols:
+            return {}
+        is_option = self._risk_manager.get_is_option().copy()
+        exits, reasons = self._risk_manager.check(
+            self.get_position_prices(symbols, is_option, cur_date, cur_time), cur_date)
+        exited = {}
+        closed_groups = set()
+        for i in np.flatnonzero(exits):
+            symbol = symbols[i]
+            if not self._risk_manager.is_watching(symbol):
+                # Closed with a position group earlier in this pass
+                continue
+            reason = RiskManager.EXIT_REASONS[reasons[i]]
+            strategy = f"Risk manager ({reason})"
+            group_id = self.get_position_group(symbol) if is_option[i] else None
+            if group_id is not None:
+                if group_id not in closed_groups:
+                    closed_groups.add(group_id)
+                    self.close_position_group(group_id, cur_date, cur_time, strategy)
+            elif is_option[i]:
+                holding = self._current_holdings[Holdings.get_underlying(symbol)]
+                self.close_option(symbol, abs(holding.get_positions()[symbol][0]), strategy,
+                                  cur_date, cur_time)
+            else:
+                self.close_shares(symbol, self._current_holdings[symbol].get_num_shares(), strategy,
+                                  cur_date, cur_time)
+            exited[symbol] = reason
+        return exited
+
+    def get_fill_journal(self):
+        """
+        Returns: a dataframe of every fill in this portfolio, in order
+        """
+        return pd.DataFrame(self._journal, columns=["date", "time", "action", "symbol",
+                                                    "quantity", "price", "strategy", "group"])
+
+    def get_position_groups(self):
+        """
+        Returns: a dict of group id to the dict of symbol to contracts still held of each
+        multi-leg position
+        """
+        return {group_id: group["legs"] for group_id, group in self._position_groups.items()}
+
+    def get_position_group(self, symbol):
+        """
+        Returns: the id of the oldest position group holding symbol, or None
+        """
+        for group_id, group in self._position_groups.items():
+            if symbol in group["legs"]:
+                return group_id
+        return None
+
+    def _remove_from_groups(self, symbol, num_contracts, group_id=None):
+        """
+        Removes num_contracts of symbol from the position groups holding it, from group_id
+        first if it is given and then oldest first
+        """
+        group_ids = list(self._position_groups)
+        if group_id in self._position_groups:
+            group_ids.remove(group_id)
+            group_ids.insert(0, group_id)
+        for group_id in group_ids:
+            legs = self._position_groups[group_id]["legs"]
+            if num_contracts == 0:
+                break
+            if symbol not in legs or np.sign(legs[symbol]) != np.sign(num_contracts):
+                continue
+            removed = num_contracts if abs(num_contracts) <= abs(legs[symbol]) else legs[symbol]
+            legs[symbol] -= removed
+            num_contracts -= removed
+            if legs[symbol] == 0:
+                del legs[symbol]
+            if not legs:
+                del self._position_groups[group_id]
 
     def liquidate(self, stock_name, option_name, expiration_date, num_contracts):
         """
@@ -679,6 +1577,8 @@ class Portfolio(object):
             total_price = 0
         self.increase_buying_power(total_price)
         self.subtract_holdings(option_name, num_contracts)
+        self.record_fill("expire", option_name, -num_contracts,
+                         last_price, expiration_date, "Close")
         Helper.log_info(
             f"\n{abs(num_contracts)} {option_name} contracts expired on {expiration_date} for ${last_price} per share.\n---")
         return abool
@@ -706,6 +1606,8 @@ class Portfolio(object):
         Returns: the value of all assets/cash in the portfolio
         """
         holdings_value = 0.0
+        share_names = []
+        share_quantities = []
         for holding_name in self._current_holdings:
             holding = self._current_holdings[holding_name]
             if holding.get_type() == Assets.Options:
@@ -716,7 +1618,11 @@ class Portfolio(object):
                     num_assets = positions[position][0]
                     holdings_value += num_assets * price
             else:
-                Helper.log_error("Unimplemented")
+                share_names.append(holding_name)
+                share_quantities.append(holding.get_num_shares())
+        if share_names:
+            holdings_value += float(np.dot(HoldingsStrategy.get_stock_prices(
+                share_names, date, time), share_quantities))
         return self.get_buying_power() + holdings_value
 
     def is_profitable(self, date, time):
@@ -729,21 +1635,14 @@ class Portfolio(object):
         """
         Returns: True if this portfolio contains stock. False otherwise.
         """
-        for holding in self._current_holdings:
-            if holding.get_underlying_name() == asset:
-                return True
-        return False
+        return asset in self._current_holdings
 
     def get_current_allocation(self, asset, last_price, date, time):
         """
-        Returns: the total value asset in this portfolio.
+        Returns: the total value of the shares of asset in this portfolio.
         """
         if self.contains(asset):
-            holdings_value = 0.0
-            for holding in self._current_holdings:
-                if holding.get_name() == asset:
-                    holdings_value += holding.get_num_assets() * last_price
-            return holdings_value
+            return self._current_holdings[asset].get_num_shares() * last_price
         else:
             return 0.0
 
@@ -752,11 +1651,8 @@ class Portfolio(object):
         Returns: the percent of the portfolio that this stock makes up.
         """
         if self.contains(stock):
-            holdings_value = 0.0
-            for holding in self._current_holdings:
-                if holding.get_name() == stock:
-                    holdings_value += holding.get_num_assets() * last_price
-            return holdings_value / self.get_portfolio_value(date, time)
+            return self.get_current_allocation(stock, last_price, date, time) / \
+                self.get_portfolio_value(date, time)
         else:
             return 0.0
 
@@ -775,33 +1671,50 @@ class Portfolio(object):
                 del self._current_holdings[name]
         else:
             self._current_holdings[name] = new_holding
+        if asset_type == Assets.Options:
+            self._update_margin_position(stock)
 
-    def subtract_holdings(self, stock, num_shares):
+    def _update_margin_position(self, symbol):
         """
-        Subtract the holdings to the portfolio
+        Passes the contracts of the option symbol now held to the margin account
         """
-        new_holding = Holdings(stock, num_shares, 0, None)
-        name = new_holding.get_underlying_name()
+        holding = self._current_holdings.get(Holdings.get_underlying(symbol))
+        positions = holding.get_positions() if holding is not None else {}
+        self._margin.update_position(
+            symbol, positions[symbol][0] if symbol in positions else 0)
+
+    def subtract_holdings(self, stock, num_shares, group_id=None):
+        """
+        Subtract the holdings to the portfolio. Contracts are taken out of the position
+        group group_id first, if it is given
+        """
+        name = Holdings.get_underlying(stock)
         if name in self._current_holdings:
             holding = self._current_holdings[name]
             holding.subtract_shares(stock, num_shares)
             if holding.is_empty():
                 del self._current_holdings[name]
+            if self._position_groups:
+                self._remove_from_groups(stock, num_shares, group_id)
+            if holding.get_type() == Assets.Options:
+                self._update_margin_position(stock)
         else:
             Helper.log_error(
                 f"Selling shares you don't own: {stock}. Exiting program...")
 
-    def decrease_buying_power(self, cost):
+    def decrease_buying_power(self, cost, fees=None):
         """
-        Decreases the buying power by cost
+        Decreases the buying power by cost and fees (default: the trading fees)
         """
-        self._buying_power = self._buying_power - (cost + self._fees)
+        fees = self._fees if fees is None else fees
+        self._buying_power = self._buying_power - (cost + fees)
 
-    def increase_buying_power(self, gain):
+    def increase_buying_power(self, gain, fees=None):
         """
-        Decreases the buying power by cost
+        Increases the buying power by gain, less fees (default: the trading fees)
         """
-        self._buying_power = self._buying_power + (gain - self._fees)
+        fees = self._fees if fees is None else fees
+        self._buying_power = self._buying_power + (gain - fees)
 
     def shares_to_buy(self, stock_strategy, buying_allocation, date, time, last_price):
         """
@@ -810,7 +1723,7 @@ class Portfolio(object):
         asset_type = stock_strategy.get_asset_type()
         type_allo = type(buying_allocation)
         buying_allo_type = stock_strategy.get_buying_allocation_type()
-        if asset_type == 'stocks':
+        if asset_type == Assets.Stocks:
             if type_allo == int:
                 dollars_to_spend = buying_allocation * last_price
                 num_shares = buying_allocation
@@ -828,7 +1741,7 @@ class Portfolio(object):
                 Helper.log_error(
                     f"Buying allocation should be an int or float")
             return num_shares, num_shares * last_price
-        elif asset_type == 'crypto':
+        elif asset_type == Assets.Crypto:
             if type_allo == int:
                 dollars_to_spend = buying_allocation * last_price
                 num_shares = buying_allocation
@@ -849,7 +1762,8 @@ class Portfolio(object):
 
     @staticmethod
     def __option_expiration_helper(date, options_length):
-        if options_length == OptionLength.Monthly:
+        # Monthly and two-monthly options both expire on the third Friday of the month
+        if options_length in (OptionLength.Monthly, OptionLength.TwoMonthly):
             now = date
             first_day_of_month = datetime(now.year, now.month, 1)
             first_friday = first_day_of_month + \
@@ -887,15 +1801,124 @@ class Portfolio(object):
             max_allocation = max_allocation * \
                 self.get_portfolio_value(cur_date, cur_time)
         # check max allocation
-        tmp_holding = Holdings(stock_name, 0, 0)
-        name = tmp_holding.get_underlying_name()
-        count = 0
-        if name in self._current_holdings:
-            positions = self._current_holdings[name].get_positions()
-            for position in positions:
-                count += Holdings.get_options_price(
-                    position, cur_date, cur_time) * positions[position][0]
-        return count * 100 < max_allocation
+        name = Holdings.get_underlying(stock_name)
+        return self.get_allocations([name], cur_date, cur_time)[0] < max_allocation
+
+    def get_allocations(self, asset_list, cur_date, cur_time):
+        """
+        Returns: the vector of the value of the options or shares held on each asset in
+        asset_list
+        """
+        asset_index = {asset: i for i, asset in enumerate(asset_list)}
+        allocations = np.zeros(len(asset_list))
+        for name in self._current_holdings:
+            if name in asset_index:
+                holding = self._current_holdings[name]
+                if holding.get_type() != Assets.Options:
+                    allocations[asset_index[name]] += holding.get_num_shares() * \
+                        HoldingsStrategy.get_stock_price(name, cur_date, cur_time)
+                    continue
+                positions = holding.get_positions()
+                for position in positions:
+                    allocations[asset_index[name]] += Holdings.get_options_price(
+                        position, cur_date, cur_time) * positions[position][0] * 100
+        return allocations
+
+    def get_position_greeks(self, cur_date, cur_time):
+        """
+        Returns: (symbols, greeks) where symbols are the option positions in this portfolio
+        and greeks is a dict of the delta, gamma, vega and theta vectors of each position
+        (per contract greek x 100 x number of contracts held).
+
+        Every position is valued in one batched pass: the implied volatility of each
+        contract is solved from its current price, then its Black-Scholes greeks are
+        computed at that volatility.
+        """
+        symbols, quantities, _ = self.get_option_positions()
+        if not symbols:
+            return symbols, {greek: np.zeros(0) for greek in GREEKS}
+        underlyings, expirations, is_call, strikes = Pricing.parse_option_symbols(
+            symbols)
+        prices = np.array([Holdings.get_options_price(symbol, cur_date, cur_time)
+                           for symbol in symbols])
+        spots = HoldingsStrategy.get_stock_prices(
+            underlyings, cur_date, cur_time)
+        years = Pricing.years_to_expiration(cur_date, expirations, cur_time)
+        volatility = Pricing.implied_volatility(
+            prices, spots, strikes, years, is_call)
+        greeks = Pricing.black_scholes_greeks(
+            spots, strikes, years, volatility, is_call)
+        size = 100 * quantities
+        return symbols, {greek: greeks[greek] * size for greek in GREEKS}
+
+    def get_greeks_by_underlying(self, cur_date, cur_time):
+        """
+        Returns: a dataframe of the net delta, gamma, vega and theta of the option
+        positions on each underlying
+        """
+        symbols, greeks = self.get_position_greeks(cur_date, cur_time)
+        underlyings = Pricing.parse_option_symbols(symbols)[0]
+        names, index = np.unique(np.array(underlyings, dtype=str), return_inverse=True)
+        return pd.DataFrame({greek: np.bincount(index, greeks[greek], len(names))
+                             for greek in GREEKS}, index=names)
+
+    def get_greeks_by_strategy(self, cur_date, cur_time):
+        """
+        Returns: a dataframe of the net delta, gamma, vega and theta of the option
+        positions opened by each strategy, one row per strategy. A position opened by
+        several strategies is split between them in proportion to the contracts each
+        opened that are still held.
+        """
+        symbols, greeks = self.get_position_greeks(cur_date, cur_time)
+        held = {symbol: self._open_by_strategy.get(symbol) or {None: 1} for symbol in symbols}
+        # strategies are told apart by identity, since two of them can share a name
+        strategies = list({id(strategy): strategy for symbol in symbols for strategy in held[symbol]}.values())
+        strategy_index = {id(strategy): i for i, strategy in enumerate(strategies)}
+        weights = np.zeros((len(symbols), len(strategies)))
+        for i, symbol in enumerate(symbols):
+            total = sum(held[symbol].values())
+            for strategy, contracts in held[symbol].items():
+                weights[i, strategy_index[id(strategy)]] = contracts / total
+        matrix = np.column_stack([greeks[greek] for greek in GREEKS]) if symbols \
+            else np.zeros((0, len(GREEKS)))
+        return pd.DataFrame(weights.T @ matrix, index=[str(strategy) for strategy in strategies],
+                            columns=list(GREEKS))
+
+    def get_net_deltas(self, asset_list, cur_date, cur_time):
+        """
+        Returns: the vector of the net delta (in shares) of the option positions on each
+        asset in asset_list
+        """
+        asset_index = {asset: i for i, asset in enumerate(asset_list)}
+        net_deltas = np.zeros(len(asset_list))
+        if not any(name in asset_index for name in self._current_holdings):
+            return net_deltas
+        symbols, greeks = self.get_position_greeks(cur_date, cur_time)
+        for underlying, delta in zip(Pricing.parse_option_symbols(symbols)[0], greeks["delta"]):
+            if underlying in asset_index:
+                net_deltas[asset_index[underlying]] += delta
+        return net_deltas
+
+    def check_max_net_deltas(self, asset_list, stock_strategy, cur_date, cur_time):
+        """
+        Returns: a boolean vector that is True for each asset in asset_list whose absolute
+        net delta is below the maximum net delta allowed by stock_strategy
+        """
+        max_delta = stock_strategy.get_maximum_net_delta()
+        if max_delta is None:
+            return np.ones(len(asset_list), dtype=bool)
+        return np.abs(self.get_net_deltas(asset_list, cur_date, cur_time)) < max_delta
+
+    def check_max_allocations(self, asset_list, stock_strategy, cur_date, cur_time):
+        """
+        Returns: a boolean vector that is True for each asset in asset_list that is below
+        the maximum allocation allowed by stock_strategy
+        """
+        max_allocation = stock_strategy.get_maximum_allocation()
+        if type(max_allocation) != int:
+            max_allocation = max_allocation * \
+                self.get_portfolio_value(cur_date, cur_time)
+        return self.get_allocations(asset_list, cur_date, cur_time) < max_allocation
 
     def buy_options(self, stock, stock_strategy, cur_date, cur_time):
         """
@@ -905,36 +1928,60 @@ class Portfolio(object):
         last_price = HoldingsStrategy.get_stock_price(
             stock, cur_date, cur_time)
         symbol = Holdings.get_options_symbol(
-            stock, last_price, cur_date, stock_strategy.get_strikes_above(), stock_strategy.get_option_type(), stock_strategy.expiration_length())
+            stock, last_price, cur_date, stock_strategy.get_strikes_above(), stock_strategy.get_option_type(), stock_strategy.expiration_length(),
+            stock_strategy.get_target_delta())
         if not self.check_max_allocation(symbol, stock_strategy, cur_date, cur_time):
             Helper.log_warn(
                 f"Portfolio currently has maximum allocation of {stock}")
             return abool
         # TODO Also, make all data saved to local database and attempt to fetch from there
+        return self.open_option(symbol, stock_strategy.get_buying_allocation(), stock_strategy,
+                                cur_date, cur_time)
+
+    def open_option(self, symbol, num_contracts, stock_strategy, cur_date, cur_time, carried=0):
+        """
+        Buys (or sells, if num_contracts is negative) to open num_contracts of the option
+        symbol. The part the fill model doesn't fill is carried over to later bars.
+
+        Returns: True if any contract is filled. False otherwise
+        """
+        abool = False
         df = Holdings.get_options_data(symbol)
-        if df is None:
+        if df is None or Pricing.parse_option_symbol(symbol)[1] < cur_date:
+            return abool
+        fill_prices, filled, commission = self._fill(
+            [symbol], [num_contracts], [Holdings.get_options_price(symbol, cur_date, cur_time)],
+            cur_date, True)
+        num_filled = int(filled[0])
+        if num_filled == 0:
+            self._carry_over("open_option", {"symbol": symbol, "num_contracts": num_contracts,
+                                             "stock_strategy": stock_strategy}, carried)
             return abool
-        num_contracts = stock_strategy.get_buying_allocation()
-        holdings_price = Holdings.get_options_price(symbol, cur_date, cur_time)
-        total_price = 100 * num_contracts * holdings_price
-        buying_power = self.get_buying_power()
-        if total_price < buying_power and total_price != 0.0:
+        holdings_price = round(float(fill_prices[0]), 2)
+        total_price = 100 * num_filled * holdings_price
+        if total_price != 0.0 and self.has_margin_for([symbol], [num_filled], total_price + commission,
+                                                      cur_date, cur_time):
             abool = True
-            self.decrease_buying_power(total_price)
-            self.add_holdings(symbol, num_contracts, holdings_price,
+            self.decrease_buying_power(total_price, commission)
+            self.add_holdings(symbol, num_filled, holdings_price,
                               Assets.Options, cur_date, df)
+            self.record_fill("open", symbol, num_filled, holdings_price,
+                             cur_date, cur_time, stock_strategy)
+            if num_filled != num_contracts:
+                self._carry_over("open_option", {"symbol": symbol, "num_contracts": num_contracts - num_filled,
+                                                 "stock_strategy": stock_strategy}, carried)
             if total_price > 0:
                 Helper.log_info(
-                    f"\nBought (to open) {num_contracts} {symbol} (${holdings_price} stock price) contract(s) on {cur_date} at {cur_time} for " +
+                    f"\nBought (to open) {num_filled} {symbol} (${holdings_price} stock price) contract(s) on {cur_date} at {cur_time} for " +
                     f"${holdings_price} per contract.\n{stock_strategy}\n---")
             else:
                 Helper.log_info(
-                    f"\nSold (to open) {-1 * num_contracts} {symbol} (${holdings_price} stock price) contract(s) on " +
+                    f"\nSold (to open) {-1 * num_filled} {symbol} (${holdings_price} stock price) contract(s) on " +
                     f"{cur_date} at {cur_time} for ${holdings_price} per contract.\n{stock_strategy}\n---")
         else:
             abool = False
             Helper.log_warn(
-                f"Insufficent buying power to buy {stock} on {cur_date} at {cur_time}\n{stock_strategy}\n---")
+                f"Insufficent buying power to buy {symbol} on {cur_date} at {cur_time}\n{stock_strategy}\n---")
         return abool
 
     def buy_spreads(self, stock, stock_strategy, cur_date, cur_time):
@@ -944,54 +1991,102 @@ class Portfolio(object):
         abool = False
         last_price = HoldingsStrategy.get_stock_price(
             stock, cur_date, cur_time)
-        if stock_strategy.get_spread_type() == 'debit':
-            symbol_list = [
-                Holdings.get_options_symbol(
-                    stock, last_price, cur_date, stock_strategy.get_strikes_above(), stock_strategy.get_option_type(), stock_strategy.expiration_length()),
-                Holdings.get_options_symbol(
-                    stock, last_price, cur_date, stock_strategy.get_strikes_above() + stock_strategy.get_spread_width(), stock_strategy.get_option_type(), stock_strategy.expiration_length())]
-        else:
-            symbol_list = [
-                Holdings.get_options_symbol(
-                    stock, last_price, cur_date, stock_strategy.get_strikes_above() + stock_strategy.get_spread_width(), stock_strategy.get_option_type(), stock_strategy.expiration_length()),
-                Holdings.get_options_symbol(
-                    stock, last_price, cur_date, stock_strategy.get_strikes_above(), stock_strategy.get_option_type(), stock_strategy.expiration_length())]
+        symbol_list = list(Holdings.get_spread_symbols(
+            stock, last_price, cur_date, stock_strategy.get_strikes_above(), stock_strategy.get_spread_width(),
+            stock_strategy.get_option_type(), stock_strategy.expiration_length(), stock_strategy.get_target_delta()))
+        if stock_strategy.get_spread_type() != 'debit':
+            symbol_list.reverse()
 
         if not self.check_max_allocation(symbol_list[0], stock_strategy, cur_date, cur_time):
             Helper.log_warn(
                 f"Portfolio currently has maximum allocation of {stock} on {cur_date} at {cur_time}")
             return abool
+        order = Orders.MultiLegOrder.vertical(
+            symbol_list[0], symbol_list[1], stock_strategy.get_buying_allocation())
+        return self.fill_order(order, stock_strategy, cur_date, cur_time)
 
-        # TODO Also, make all data saved to local database and attempt to fetch from there
-        df_list = [Holdings.get_options_data(
-            symbol_list[0]), Holdings.get_options_data(symbol_list[1])]
-        if df_list[0] is None or df_list[1] is None:
-            return abool
-        num_contracts = stock_strategy.get_buying_allocation()
-        holdings_price = Holdings.get_options_price(
-            symbol_list[0], cur_date, cur_time) * 100 * num_contracts
-        holdings_price2 = Holdings.get_options_price(
-            symbol_list[1], cur_date, cur_time) * 100 * num_contracts
-        total_price = holdings_price - holdings_price2
-        buying_power = self.get_buying_power()
-        if total_price < buying_power and total_price != 0.0:
-            abool = True
-            self.decrease_buying_power(total_price)
-            self.add_holdings(symbol_list[0], num_contracts, holdings_price / 100,
-                              Assets.Options, cur_date, df_list[0])
-            Helper.log_info(
-                f"\nBought (to open) {num_contracts} {symbol_list[0]} (${last_price} stock price) contract(s) on {cur_date} at {cur_time} for " +
-                f"${holdings_price / 100} per contract.\n{stock_strategy}\n---")
-            self.add_holdings(symbol_list[1], -1 * num_contracts, holdings_price2 / 100,
-                              Assets.Options, cur_date, df_list[1])
-            Helper.log_info(
-                f"\nSold (to open) {-1 * num_contracts} {symbol_list[1]} (${last_price} stock price) contract(s) on " +
-                f"{cur_date} at {cur_time} for ${holdings_price2 /100} per contract.\n{stock_strategy}\n---")
-        else:
-            abool = False
+    def fill_order(self, order, stock_strategy, cur_date, cur_time, carried=0):
+        """
+        Fills every leg of the multi-leg order at once, or none of them. The legs are priced
+        together and the order is filled only if the excess buying power covers its cost
+        and the margin it requires. The filled legs are held as one position group. If the fill model fills
+        only some units of the order, the rest is carried over to later bars as another
+        order.
+
+        Returns: True if the order is filled. False otherwise
+        """
+        symbols = order.get_symbols()
+        df_list = [Holdings.get_options_data(symbol) for symbol in symbols]
+        if any(df is None for df in df_list):
+            return False
+        prices = np.array([Holdings.get_options_price(symbol, cur_date, cur_time)
+                           for symbol in symbols])
+        fill_prices, filled, commission = self._fill_legs(
+            symbols, order.get_quantities(), prices, cur_date)
+        if not filled.any():
+            self._carry_over("fill_order", {"order": order, "stock_strategy": stock_strategy},
+                             carried)
+            return False
+        fill_prices = np.round(fill_prices, 2)
+        filled_order = Orders.MultiLegOrder(order.get_name(), symbols, filled)
+        total_price = filled_order.get_cost(fill_prices)
+        if total_price == 0.0 or not self.has_margin_for(symbols, filled, total_price + commission,
+                                                         cur_date, cur_time):
             Helper.log_warn(
-                f"Insufficent buying power to buy {stock}\n{stock_strategy} on {cur_date} at {cur_time}\n---")
-        return abool
+                f"Insufficent buying power to buy {order}\n{stock_strategy} on {cur_date} at {cur_time}\n---")
+            return False
+        group_id = self._next_group_id
+        self._next_group_id += 1
+        self.decrease_buying_power(total_price, commission)
+        for symbol, quantity, price, df in zip(symbols, filled, fill_prices, df_list):
+            self.add_holdings(symbol, int(quantity), price,
+                              Assets.Options, cur_date, df)
+            self.record_fill("open", symbol, int(quantity), price,
+                             cur_date, cur_time, stock_strategy, group_id)
+        self._position_groups[group_id] = {"name": order.get_name(), "strategy": str(stock_strategy),
+                                           "legs": dict(zip(symbols, filled.tolist()))}
+        if not np.array_equal(filled, order.get_quantities()):
+            self._carry_over("fill_order", {"order": Orders.MultiLegOrder(
+                order.get_name(), symbols, order.get_quantities() - filled),
+                "stock_strategy": stock_strategy}, carried)
+        Helper.log_info(
+            f"\nOpened {filled_order} on {cur_date} at {cur_time} for ${total_price} " +
+            f"(leg prices: {fill_prices.tolist()}).\n{stock_strategy}\n---")
+        return True
+
+    def close_position_group(self, group_id, cur_date, cur_time, strategy=None, carried=0):
+        """
+        Closes every leg still held in the position group in one operation. If the fill
+        model fills only some units of the group, the rest is carried over to later bars.
+
+        Returns: True if the group is closed. False otherwise
+        """
+        if group_id not in self._position_groups:
+            return False
+        legs = dict(self._position_groups[group_id]["legs"])
+        symbols = list(legs)
+        held = np.array([legs[symbol] for symbol in symbols])
+        prices = np.array([Holdings.get_options_price(symbol, cur_date, cur_time)
+                           for symbol in symbols])
+        fill_prices, filled, commission = self._fill_legs(
+            symbols, -held, prices, cur_date)
+        quantities = -filled
+        if not np.array_equal(quantities, held):
+            self._carry_over("close_position_group", {"group_id": group_id, "strategy": strategy},
+                             carried)
+        if not quantities.any():
+            return False
+        fill_prices = np.round(fill_prices, 2)
+        # Worthless legs are abandoned rather than traded
+        total_price = 100 * float(np.dot(np.where(prices == 0.01, 0, fill_prices), quantities))
+        self.increase_buying_power(total_price, commission)
+        for symbol, quantity, price in zip(symbols, quantities, fill_prices):
+            self.subtract_holdings(symbol, int(quantity), group_id)
+            self.record_fill("close", symbol, -int(quantity), price,
+                             cur_date, cur_time, strategy, group_id)
+        Helper.log_info(
+            f"\nClosed position group {group_id} ({dict(zip(symbols, quantities.tolist()))}) on {cur_date} at {cur_time} for ${total_price}.\n{strategy}\n---")
+        return True
 
     def buy(self, stock, stock_strategy, current_date, current_time):
         """
@@ -1010,10 +2105,60 @@ class Portfolio(object):
             else:
                 abool = self.buy_options(
                     stock, stock_strategy, current_date, current_time)
+        elif asset_type in (Assets.Stocks, Assets.Crypto):
+            abool = self.buy_shares(
+                stock, stock_strategy, current_date, current_time)
         else:
             Helper.log_error("Not Implemented")
         return abool
 
+    def buy_shares(self, stock, stock_strategy, cur_date, cur_time):
+        """
+        Helper function for buy to purchase shares (whole shares of stocks, fractional
+        coins of crypto) as opposed to options.
+        """
+        last_price = HoldingsStrategy.get_stock_price(
+            stock, cur_date, cur_time)
+        num_shares, total_price = self.shares_to_buy(
+            stock_strategy, stock_strategy.get_buying_allocation(), cur_date, cur_time, last_price)
+        if num_shares <= 0:
+            return False
+        return self.open_shares(stock, num_shares, stock_strategy, cur_date, cur_time)
+
+    def open_shares(self, stock, num_shares, stock_strategy, cur_date, cur_time, carried=0):
+        """
+        Buys num_shares of stock. The part the fill model doesn't fill is carried over to
+        later bars.
+
+        Returns: True if any share is filled. False otherwise
+        """
+        fractional = stock_strategy.get_asset_type() == Assets.Crypto
+        fill_prices, filled, commission = self._fill(
+            [stock], [num_shares], [HoldingsStrategy.get_stock_price(stock, cur_date, cur_time)],
+            cur_date, False, fractional)
+        num_filled = float(filled[0]) if fractional else int(filled[0])
+        if num_filled <= 0:
+            self._carry_over("open_shares", {"stock": stock, "num_shares": num_shares,
+                                             "stock_strategy": stock_strategy}, carried)
+            return False
+        price = round(float(fill_prices[0]), 2)
+        total_price = num_filled * price
+        if total_price + commission > self.get_excess_buying_power(cur_date, cur_time):
+            Helper.log_warn(
+                f"Insufficent buying power to buy {stock} on {cur_date} at {cur_time}\n{stock_strategy}\n---")
+            return False
+        self.decrease_buying_power(total_price, commission)
+        self.add_holdings(stock, num_filled, price,
+                          stock_strategy.get_asset_type(), cur_date)
+        self.record_fill("open", stock, num_filled, price,
+                         cur_date, cur_time, stock_strategy)
+        if num_shares - num_filled > Holdings.DUST:
+            self._carry_over("open_shares", {"stock": stock, "num_shares": num_shares - num_filled,
+                                             "stock_strategy": stock_strategy}, carried)
+        Helper.log_info(
+            f"\nBought {num_filled} {stock} shares on {cur_date} at {cur_time} for ${price} per share.\n{stock_strategy}\n---")
+        return True
+
     def sell(self, stock, stock_strategy, date, time):
         """
         Sells stock according to the stock_strategy
@@ -1021,6 +2166,9 @@ class Portfolio(object):
         asset_type = stock_strategy.get_asset_type()
         abool = False
         if asset_type == Assets.Options:
+            group_id = self.get_position_group(stock)
+            if stock_strategy.closes_as_group() and group_id is not None:
+                return self.close_position_group(group_id, date, time, stock_strategy)
             return self.sell_option(stock, date, time, stock_strategy)
         last_price = HoldingsStrategy.get_stock_price(stock, date, time)
         current_value_holdings = self.get_current_allocation(
@@ -1033,6 +2181,8 @@ class Portfolio(object):
         elif asset_type == Assets.Crypto:
             exact_shares_gain = selling_allocation * current_value_holdings
             shares_to_sell = exact_shares_gain / last_price
+        if shares_to_sell <= 0:
+            return abool
         min_allo = stock_strategy.get_minimum_allocation()
         portfolio_value = self.get_portfolio_value(date, time)
         current_allo = self.get_current_allocation(
@@ -1041,42 +2191,93 @@ class Portfolio(object):
             Helper.log_warn(
                 f"Portfolio currently has minimum allocation of {stock}")
         else:
-            abool = True
-            self.increase_buying_power(exact_shares_gain)
-            self.subtract_holdings(stock, shares_to_sell)
-            Helper.log_info(
-                f"Sold {shares_to_sell} {stock} shares on {date} at {time} for ${last_price} per share.")
+            abool = self.close_shares(stock, shares_to_sell, stock_strategy, date, time)
         return abool
 
+    def close_shares(self, stock, num_shares, stock_strategy, cur_date, cur_time, carried=0):
+        """
+        Sells num_shares of stock (at most the shares held). The part the fill model
+        doesn't fill is carried over to later bars.
+
+        Returns: True if any share is filled. False otherwise
+        """
+        if not self.contains(stock):
+            return False
+        holding = self._current_holdings[stock]
+        num_shares = min(num_shares, holding.get_num_shares())
+        fractional = holding.get_type() == Assets.Crypto
+        fill_prices, filled, commission = self._fill(
+            [stock], [-num_shares], [HoldingsStrategy.get_stock_price(stock, cur_date, cur_time)],
+            cur_date, False, fractional)
+        num_filled = -float(filled[0]) if fractional else -int(filled[0])
+        if num_shares - num_filled > Holdings.DUST:
+            self._carry_over("close_shares", {"stock": stock, "num_shares": num_shares - num_filled,
+                                              "stock_strategy": stock_strategy}, carried)
+        if num_filled <= 0:
+            return False
+        price = round(float(fill_prices[0]), 2)
+        self.increase_buying_power(num_filled * price, commission)
+        self.subtract_holdings(stock, num_filled)
+        self.record_fill("close", stock, -num_filled,
+                         price, cur_date, cur_time, stock_strategy)
+        Helper.log_info(
+            f"Sold {num_filled} {stock} shares on {cur_date} at {cur_time} for ${price} per share.")
+        return True
+
     def sell_option(self, option_name, current_date, current_time, strategy):
         """
         Sells the option according to the stock strategy
         """
+        return self.close_option(option_name, strategy.get_selling_allocation(), strategy,
+                                 current_date, current_time)
 
+    def close_option(self, option_name, num_contracts, strategy, cur_date, cur_time, carried=0):
+        """
+        Sells (or buys, for a short position) to close num_contracts of the option
+        position option_name. The part the fill model doesn't fill is carried over to later
+        bars.
+
+        Returns: True if any contract is filled. False otherwise
+        """
         abool = False
-        stock_name = re.match(r"\D+", option_name).group(0)
+        stock_name = Holdings.get_underlying(option_name)
+        if stock_name not in self._current_holdings or \
+                option_name not in self._current_holdings[stock_name].get_positions():
+            return abool
         position_info = self._current_holdings[stock_name].get_positions()[
             option_name]
         price_multiplier = 1
         if position_info[0] < 0:
             price_multiplier = -1
+        num_contracts = min(num_contracts, abs(position_info[0]))
         last_price = Holdings.get_options_price(
-            option_name, current_date, current_time)
-        num_contracts = strategy.get_selling_allocation()
-        total_price = 100 * num_contracts * last_price * price_multiplier
+            option_name, cur_date, cur_time)
+        fill_prices, filled, commission = self._fill(
+            [option_name], [-num_contracts * price_multiplier], [last_price], cur_date, True)
+        num_filled = abs(int(filled[0]))
+        if num_filled != num_contracts:
+            self._carry_over("close_option", {"option_name": option_name,
+                                              "num_contracts": num_contracts - num_filled,
+                                              "strategy": strategy}, carried)
+        if num_filled == 0:
+            return abool
+        fill_price = round(float(fill_prices[0]), 2)
+        total_price = 100 * num_filled * fill_price * price_multiplier
         abool = True
         if last_price == 0.01:
             total_price = 0
-        self.increase_buying_power(total_price)
-        self.subtract_holdings(option_name, num_contracts * price_multiplier)
+        self.increase_buying_power(total_price, commission)
+        self.subtract_holdings(option_name, num_filled * price_multiplier)
+        self.record_fill("close", option_name, -num_filled * price_multiplier,
+                         fill_price, cur_date, cur_time, strategy)
         if total_price > 0:
             Helper.log_info(
-                f"\nSold (to close) {num_contracts} {option_name} (${HoldingsStrategy.get_stock_price(stock_name, current_date, current_time)} stock price) contract(s) on {current_date}" +
-                f" at {current_time} for ${last_price} per contract.\n{strategy}\n---")
+                f"\nSold (to close) {num_filled} {option_name} (${HoldingsStrategy.get_stock_price(stock_name, cur_date, cur_time)} stock price) contract(s) on {cur_date}" +
+                f" at {cur_time} for ${fill_price} per contract.\n{strategy}\n---")
         else:
             Helper.log_info(
-                f"\nBought (to close) {num_contracts} {option_name}  (${HoldingsStrategy.get_stock_price(stock_name, current_date, current_time)} stock price) contract(s) on {current_date} " +
-                f"at {current_time} for ${last_price} per contract.\n{strategy}\n---")
+                f"\nBought (to close) {num_filled} {option_name}  (${HoldingsStrategy.get_stock_price(stock_name, cur_date, cur_time)} stock price) contract(s) on {cur_date} " +
+                f"at {cur_time} for ${fill_price} per contract.\n{strategy}\n---")
         return abool
 
 
@@ -1094,17 +2295,15 @@ class Resolution(IntFlag):
 
     @staticmethod
     def time_init(resolution):
-        if resolution == Resolution.Daily:
-            return 'Open'
+        if resolution in Time.resolution_dict:
+            return Time.resolution_dict[resolution][0]
         assert False
 
     @staticmethod
     def forward_time(time, resolution):
-        if resolution == Resolution.Daily:
-            if time == 'Open':
-                return 'Close'
-            else:
-                return "Open"
+        if resolution in Time.resolution_dict:
+            times = Time.resolution_dict[resolution]
+            return times[(times.index(str(time)) + 1) % len(times)]
         Helper.log_error(f"Unimplemented resolution {resolution}")
 
 
@@ -0,0 +1,314 @@
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+import pandas as pd
+from pathlib import Path
+import Backtesting
+import Helper
+import Pruning
+import State
+
+
+def expand_grid(grid):
+    """
+    Returns: the list of every parameter dict in the grid, a dict of parameter -> list of values
+    """
+    keys = sorted(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[key] for key in keys])]
+
+
+def run_parameter_set(asset_list, start_date, end_date, params, pruning=None):
+    """
+    Runs one headless backtest_strategy and returns its result record. If pruning (the
+    keyword arguments of a Pruning.EquityPruner) is given, the run is stopped early when it
+    falls behind and the record is marked pruned
+    """
+    record = {"params": params, "start_date": start_date, "end_date": end_date,
+              "summary": None, "equity": None, "times": None, "pruned": False, "error": None}
+    pruner = Pruning.EquityPruner(**pruning) if pruning else None
+    try:
+        state = Backtesting.backtest_strategy(
+            asset_list, start_date, end_date, plot=False, pruner=pruner, **params)
+        record["pruned"] = pruner is not None and pruner.is_pruned()
+        record["summary"] = Backtesting.summarize_backtest(state)
+        portfolio_history = state.get_portfolio_history()[0]
+        record["equity"] = portfolio_history["Strategy Value"].tolist()
+        record["times"] = portfolio_history.index.tolist()
+    except (Exception, SystemExit) as e:
+        record["error"] = repr(e)
+    return record
+
+
+class WorkQueue(object):
+    """
+    A class representing a filesystem work queue for a parameter sweep.
+
+    The queue is a directory that every worker can reach (a local disk for local workers,
+    or a shared mount for several machines). Work units move between subdirectories:
+    pending -> claimed -> results. A unit is claimed with an atomic rename, so each unit
+    is run by exactly one worker. The price matrix is saved once under prices and
+    memory-mapped by every worker. A directory can be reused: each sweep tags its units
+    and their results with its own run id.
+    """
+
+    def __init__(self, queue_dir):
+        self._queue_dir = queue_dir
+        for name in ("pending", "claimed", "results", "prices", "logs"):
+            os.makedirs(self.get_path(name), exist_ok=True)
+
+    def get_path(self, *names):
+        """
+        Returns: the path of names inside the queue directory
+        """
+        return os.path.join(self._queue_dir, *names)
+
+    @staticmethod
+    def _write_json(path, obj):
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmp_path, path)
+
+    def put(self, unit):
+        """
+        Adds the work unit to the pending queue
+        """
+        WorkQueue._write_json(self.get_path(
+            "pending", f"{unit['unit_id']}.json"), unit)
+
+    def claim(self, worker_id):
+        """
+        Returns: the next pending work unit, now claimed by worker_id. None if the queue is empty
+        """
+        for filename in sorted(os.listdir(self.get_path("pending"))):
+            if not filename.endswith(".json"):
+                continue
+            claimed_path = self.get_path("claimed", filename)
+            try:
+                os.rename(self.get_path("pending", filename), claimed_path)
+            except FileNotFoundError:
+                # another worker claimed it first
+                continue
+            os.utime(claimed_path)
+            with open(claimed_path) as f:
+                unit = json.load(f)
+            unit["worker_id"] = worker_id
+            return unit
+        return None
+
+    def complete(self, unit, results):
+        """
+        Stores the results of a claimed work unit and removes it from the claimed queue
+        """
+        WorkQueue._write_json(self.get_path("results", f"{unit['unit_id']}.json"),
+                              {"unit_id": unit["unit_id"], "run_id": unit.get("run_id"),
+                               "worker_id": unit["worker_id"], "results": results})
+        try:
+            os.remove(self.get_path("claimed", f"{unit['unit_id']}.json"))
+        except FileNotFoundError:
+            # the unit was requeued as stale while it was still running
+            pass
+
+    def heartbeat(self, unit):
+        """
+        Marks a claimed work unit as still running so that it is not requeued as stale
+        """
+        try:
+            os.utime(self.get_path("claimed", f"{unit['unit_id']}.json"))
+        except FileNotFoundError:
+            pass
+
+    def requeue_stale(self, timeout):
+        """
+        Moves units that were claimed more than timeout seconds ago back to pending, for
+        workers that died. Returns: the number of units requeued
+        """
+        count = 0
+        now = time.time()
+        for filename in os.listdir(self.get_path("claimed")):
+            path = self.get_path("claimed", filename)
+            try:
+                if now - os.path.getmtime(path) > timeout:
+                    os.rename(path, self.get_path("pending", filename))
+                    count += 1
+            except FileNotFoundError:
+                pass
+        return count
+
+    def num_pending(self):
+        """
+        Returns: the number of units not yet finished
+        """
+        return len(os.listdir(self.get_path("pending"))) + len(os.listdir(self.get_path("claimed")))
+
+    def get_results(self, run_id=None):
+        """
+        Returns: the result records of every finished unit, or only of the units of the
+        sweep run_id if it is given
+        """
+        results = []
+        for filename in sorted(os.listdir(self.get_path("results"))):
+            if filename.endswith(".json"):
+                with open(self.get_path("results", filename)) as f:
+                    finished = json.load(f)
+                if run_id is None or finished.get("run_id") == run_id:
+                    results.extend(finished["results"])
+        return results
+
+
+class SweepCoordinator(object):
+    """
+    A class that splits a backtest_strategy parameter grid into work units, hands them
+    to workers through a WorkQueue and merges their results.
+
+    run_id (default: a new unique id) tags the units of the sweep, so that only their
+    results are collected from a queue directory that earlier sweeps left results in.
+    """
+
+    def __init__(self, queue_dir, asset_list, start_date, end_date, unit_size=4, run_id=None):
+        self._queue = WorkQueue(queue_dir)
+        self._run_id = run_id or uuid.uuid4().hex[:12]
+        self._asset_list = asset_list
+        self._start_date = start_date
+        self._end_date = end_date
+        self._unit_size = unit_size
+        self._num_units = 0
+
+    def get_queue(self):
+        """
+        Returns: the work queue of this sweep
+        """
+        return self._queue
+
+    def get_run_id(self):
+        """
+        Returns: the id that tags the units of this sweep
+        """
+        return self._run_id
+
+    def get_results(self):
+        """
+        Returns: the result records of the finished units of this sweep
+        """
+        return self._queue.get_results(self._run_id)
+
+    def prepare_price_cache(self):
+        """
+        Loads the price data of the universe once and saves it for the workers to memory-map
+        """
+        State.HoldingsStrategy.load_assets(self._asset_list)
+        State.HoldingsStrategy.price_matrix.save(
+            self._queue.get_path("prices"))
+
+    def submit(self, grid, start_date=None, end_date=None, tags=None, pruning=None):
+        """
+        Splits the parameter grid into work units and adds them to the queue. The units
+        are run from start_date to end_date (default: the sweep's dates), and tags (a
+        dict) is copied into the result record of every parameter set. If pruning (the
+        keyword arguments of a Pruning.EquityPruner) is given, runs that fall behind are
+        stopped early. Workers price options the way this process does
+        (State.Holdings.option_pricing).
+        Returns: the number of work units
+        """
+        param_sets = expand_grid(grid) if isinstance(grid, dict) else list(grid)
+        num_units = 0
+        for i in range(0, len(param_sets), self._unit_size):
+            self._queue.put({"unit_id": f"{self._run_id}-{self._num_units:06d}", "run_id": self._run_id,
+                             "asset_list": self._asset_list,
+                             "start_date": start_date or self._start_date,
+                             "end_date": end_date or self._end_date, "tags": tags or {},
+                             "pruning": pruning,
+                             "option_pricing": State.Holdings.option_pricing.value,
+                             "params": param_sets[i:i + self._unit_size]})
+            num_units += 1
+            self._num_units += 1
+        Helper.log_info(
+            f"Submitted {len(param_sets)} parameter sets in {num_units} work units")
+        return num_units
+
+    def run_local_workers(self, num_workers, stale_timeout=None):
+        """
+        Starts num_workers worker processes on this machine and waits until they have
+        emptied the queue
+        """
+        processes = []
+        for i in range(num_workers):
+            log_file = open(self._queue.get_path("logs", f"worker-{i}.log"), 'w')
+            processes.append((subprocess.Popen(
+                [sys.executable, str(Path(__file__).absolute()),
+                 "worker", self._queue.get_path(), f"local-{i}"],
+                stdout=log_file, stderr=subprocess.STDOUT), log_file))
+        for process, log_file in processes:
+            process.wait()
+            log_file.close()
+        if stale_timeout is not None and self._queue.requeue_stale(stale_timeout):
+            self.run_local_workers(num_workers, stale_timeout)
+
+    def wait(self, poll_interval=5, stale_timeout=None):
+        """
+        Waits until every work unit has been finished by (possibly remote) workers
+        """
+        while self._queue.num_pending():
+            if stale_timeout is not None:
+                self._queue.requeue_stale(stale_timeout)
+            time.sleep(poll_interval)
+
+    def collect(self, equity=False):
+        """
+        Returns: a dataframe with one row per parameter set, its dates, tags, summary and
+        error. If equity is True, also returns a dataframe of the equity curves, one column
+        per row.
+        """
+        records = self.get_results()
+        rows = []
+        for record in records:
+            row = dict(record["params"])
+            row.update(record.get("tags", {}))
+            row["start_date"] = record.get("start_date")
+            row["end_date"] = record.get("end_date")
+            row["pruned"] = record.get("pruned", False)
+            row.update(record["summary"] or {})
+            row["error"] = record["error"]
+            rows.append(row)
+        table = pd.DataFrame(rows)
+        if not equity:
+            return table
+        curves = pd.DataFrame(
+            {i: pd.Series(record["equity"]) for i, record in enumerate(records) if record["equity"]})
+        return table, curves
+
+
+def run_worker(queue_dir, worker_id=None):
+    """
+    Runs work units from the queue in queue_dir until it is empty
+    """
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    queue = WorkQueue(queue_dir)
+    State.HoldingsStrategy.price_matrix.load(queue.get_path("prices"))
+    unit = queue.claim(worker_id)
+    while unit is not None:
+        Helper.log_info(f"Worker {worker_id} running {unit['unit_id']}")
+        if "option_pricing" in unit:
+            State.Holdings.option_pricing = State.OptionPricing(unit["option_pricing"])
+        results = []
+        for params in unit["params"]:
+            record = run_parameter_set(
+                unit["asset_list"], unit["start_date"], unit["end_date"], params,
+                pruning=unit.get("pruning"))
+            record["tags"] = unit.get("tags", {})
+            results.append(record)
+            queue.heartbeat(unit)
+        queue.complete(unit, results)
+        unit = queue.claim(worker_id)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == "worker":
+        run_worker(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+    else:
+        print(f"Usage: python {sys.argv[0]} worker <queue_dir> [worker_id]")
@@ -0,0 +1,430 @@
+import json
+import re
+import threading
+import time
+import zlib
+import numpy as np
+import pandas as pd
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import OptionChain
+import Pricing
+import State
+
+# Deterministic synthetic market data, for runs that can't or shouldn't touch the
+# network: underlying bars follow a geometric Brownian motion drawn from a seed, option
+# chains list the strikes an exchange would around the underlying's price range, and
+# option bars are priced from the underlying with the same model as
+# Holdings.synthesize_options_data, with a volume drawn from the symbol. The same seed
+# gives the same market on every machine.
+#
+# FakeTradierServer serves a SyntheticMarket over HTTP in the shape of Tradier's market
+# data API, so the fetch and cache path of a run can be exercised end to end offline:
+#
+#     market = Synthetic.SyntheticMarket(num_symbols=4)
+#     with Synthetic.FakeTradierServer(market) as server:
+#         tradier.set_base_url(server.get_url())
+#         ...
+
+HISTORY_START = '2019-01-01'
+HISTORY_END = '2020-07-01'
+
+
+def make_symbols(num_symbols, suffix=""):
+    """
+    Returns: num_symbols ticker symbols made only of letters (option symbols are parsed
+    on the first digit), e.g. SYAAA, SYAAB, ...
+    """
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    return [f"SY{letters[i // 676 % 26]}{letters[i // 26 % 26]}{letters[i % 26]}{suffix}"
+            for i in range(num_symbols)]
+
+
+def make_daily_frames(symbols, start_date=HISTORY_START, end_date=HISTORY_END, seed=0):
+    """
+    Returns: a dict of symbol -> dataframe of business-day bars (Open, High, Low, Close,
+    Adj Close and Volume) following a geometric Brownian motion, the same for every seed
+    """
+    dates = pd.bdate_range(start_date, end_date)
+    rng = np.random.default_rng(seed)
+    frames = {}
+    for symbol in symbols:
+        closes = rng.uniform(20, 200) * np.exp(np.cumsum(rng.normal(0, 0.02, len(dates))))
+        opens = np.concatenate([[closes[0]], closes[:-1]]) * np.exp(rng.normal(0, 0.005, len(dates)))
+        spread = np.abs(rng.normal(0, 0.01, len(dates)))
+        frames[symbol] = pd.DataFrame({"High": np.maximum(opens, closes) * (1 + spread),
+                                       "Low": np.minimum(opens, closes) * (1 - spread),
+                                       "Open": opens, "Close": closes, "Volume": 1e6, "Adj Close": closes},
+                                      index=pd.Index(dates.strftime("%Y-%m-%d"), name="Date"))
+    return frames
+
+
+def make_hourly_frames(symbols, start_date=HISTORY_START, end_date=HISTORY_END, seed=0):
+    """
+    Returns: a dict of symbol -> dataframe of daily rows with the close of every hour,
+    in the shape of State.load_crypto_data, following a geometric Brownian motion
+    """
+    days = pd.date_range(start_date, end_date)
+    hours = State.Time.resolution_dict[State.Resolution.Hourly]
+    rng = np.random.default_rng(seed)
+    frames = {}
+    for symbol in symbols:
+        closes = (rng.uniform(100, 10000) * np.exp(np.cumsum(
+            rng.normal(0, 0.005, len(days) * len(hours))))).reshape(len(days), len(hours))
+        frame = pd.DataFrame(closes, columns=hours, index=pd.Index(days.strftime("%Y-%m-%d"), name="Date"))
+        frame.insert(0, "Close", closes[:, -1])
+        frame.insert(0, "Low", closes.min(axis=1))
+        frame.insert(0, "High", closes.max(axis=1))
+        frame.insert(0, "Open", closes[:, 0])
+        frames[symbol] = frame
+    return frames
+
+
+def get_monthly_expirations(start_date, end_date):
+    """
+    Returns: the standard monthly expirations (third Fridays) from start_date to end_date
+    """
+    expirations = []
+    month = date.fromisoformat(start_date).replace(day=1)
+    while month <= date.fromisoformat(end_date):
+        expiration = month + timedelta(days=(4 - month.weekday()) % 7 + 14)
+        if str(expiration) >= start_date:
+            expirations.append(expiration)
+        month = (month + timedelta(days=32)).replace(day=1)
+    return expirations
+
+
+def make_option_chain(underlying, frame, expirations, listing_days=400, width=0.2):
+    """
+    Returns: the OptionChain of underlying (whose bars are frame) listing calls and puts
+    on every expiration, at standard strikes covering the range of its closes over the
+    listing_days before the expiration, widened by width either way
+    """
+    chain = OptionChain.OptionChain(underlying)
+    closes = frame["Close"]
+    for expiration in expirations:
+        listed = closes[(closes.index <= str(expiration)) &
+                        (closes.index > str(expiration - timedelta(days=listing_days)))]
+        if listed.empty:
+            continue
+        step = OptionChain.standard_strike_step(float(listed.iloc[-1]))
+        low = max(step, step * np.floor(listed.min() * (1 - width) / step))
+        for strike in np.arange(low, listed.max() * (1 + width) + step, step):
+            for option_type in ('C', 'P'):
+                chain.add_contract(expiration, option_type, float(strike))
+    return chain
+
+
+def make_option_history(symbol, frame, history_days=400, seed=0):
+    """
+    Returns: a dataframe of the daily bars (Open, High, Low, Close, Volume) of the OCC
+    option symbol over the history_days before its expiration, priced by the
+    Bjerksund-Stensland model from its underlying's bars (frame) like
+    Holdings.synthesize_options_data. The volume is drawn from the symbol and seed, and
+    is highest near the money
+    """
+    _, expiration, option_type, strike = Pricing.parse_option_symbol(symbol)
+    dates = np.array(frame.index, dtype='datetime64[D]')
+    volatility = Pricing.estimate_implied_volatility(
+        Pricing.realized_volatility(frame["Close"].to_numpy(dtype=float)))
+    rows = (dates <= np.datetime64(expiration)) & \
+        (dates > np.datetime64(expiration) - np.timedelta64(history_days, 'D'))
+    is_call = option_type == 'C'
+    prices = {}
+    for label in ("Open", "High", "Low", "Close"):
+        prices[label] = Pricing.bjerksund_stensland(
+            frame[label].to_numpy(dtype=float)[rows], strike,
+            Pricing.years_to_expiration(dates[rows], expiration, label), volatility[rows], is_call)
+    moneyness = np.abs(np.log(frame["Close"].to_numpy(dtype=float)[rows] / strike))
+    rng = np.random.default_rng([zlib.crc32(symbol.encode()), seed])
+    df = pd.DataFrame({"Open": prices["Open"], "High": np.maximum.reduce(list(prices.values())),
+                       "Low": np.minimum.reduce(list(prices.values())), "Close": prices["Close"],
+                       "Volume": rng.poisson(2000 * np.exp(-10 * moneyness))},
+                      index=np.asarray(frame.index)[rows])
+    df[["Open", "High", "Low", "Close"]] = df[[
+        "Open", "High", "Low", "Close"]].round(2).clip(lower=0.01)
+    return df
+
+
+class SyntheticMarket(object):
+    """
+    A class representing a synthetic market: the daily bars of a universe of
+    underlyings, their option chains and the bars of every listed option, generated on
+    demand and kept.
+    """
+
+    def __init__(self, symbols=None, num_symbols=4, start_date=HISTORY_START, end_date=HISTORY_END, seed=0):
+        self._symbols = list(symbols) if symbols is not None else make_symbols(num_symbols)
+        self._start_date = start_date
+        self._end_date = end_date
+        self._seed = seed
+        self._frames = make_daily_frames(self._symbols, start_date, end_date, seed)
+        self._expirations = get_monthly_expirations(start_date, end_date)
+        self._chains = {}
+        self._option_histories = {}
+
+    def get_symbols(self):
+        """
+        Returns: the underlyings of the market
+        """
+        return self._symbols
+
+    def get_frames(self):
+        """
+        Returns: a dict of underlying -> dataframe of its daily bars
+        """
+        return self._frames
+
+    def get_chain(self, underlying):
+        """
+        Returns: the OptionChain of underlying
+        """
+        if underlying not in self._chains:
+            self._chains[underlying] = make_option_chain(
+                underlying, self._frames[underlying], self._expirations)
+        return self._chains[underlying]
+
+    def get_option_symbols(self, underlying):
+        """
+        Returns: the OCC symbols of every option listed on underlying
+        """
+        chain = self.get_chain(underlying)
+        return [OptionChain.make_symbol(underlying, expiration, option_type, strike)
+                for expiration in chain.get_expirations() for option_type in ('C', 'P')
+                for strike in chain.get_strikes(expiration, option_type)]
+
+    def is_listed(self, symbol):
+        """
+        Returns: True if symbol is an underlying or a listed option of the market. False
+        otherwise
+        """
+        if symbol in self._frames:
+            return True
+        match = re.match(r"(\D+)\d{6}[CP]\d{8}$", symbol)
+        if match is None or match.group(1) not in self._frames:
+            return False
+        _, expiration, option_type, strike = Pricing.parse_option_symbol(symbol)
+        return strike in self.get_chain(match.group(1)).get_strikes(expiration, option_type)
+
+    def get_history(self, symbol, start_date=None, end_date=None):
+        """
+        Returns: the dataframe of the daily bars of symbol (an underlying or a listed
+        option) from start_date to end_date, or None if it is not listed
+        """
+        if not self.is_listed(symbol):
+            return None
+        if symbol in self._frames:
+            df = self._frames[symbol][["Open", "High", "Low", "Close", "Volume"]]
+        else:
+            if symbol not in self._option_histories:
+                underlying = Pricing.parse_option_symbol(symbol)[0]
+                self._option_histories[symbol] = make_option_history(
+                    symbol, self._frames[underlying], seed=self._seed)
+            df = self._option_histories[symbol]
+        return df[(df.index >= (start_date or "")) & (df.index <= (end_date or "9999"))]
+
+    def get_quote(self, symbol, quote_date=None):
+        """
+        Returns: a dict of Tradier's quote fields for symbol on its last bar on or before
+        quote_date (default: the last bar of the market), or None if it is not listed
+        """
+        df = self.get_history(symbol, end_date=quote_date)
+        if df is None or df.empty:
+            return None
+        bar = df.iloc[-1]
+        previous_close = float(df["Close"].iloc[-2]) if len(df) > 1 else float(bar["Open"])
+        last = round(float(bar["Close"]), 2)
+        half_spread = max(0.01, round(0.0005 * last, 2)) if symbol in self._frames \
+            else max(0.01, round(0.025 * last, 2))
+        quote = {"symbol": symbol, "description": symbol, "exch": "Q",
+                 "type": "stock" if symbol in self._frames else "option",
+                 "last": last, "change": round(last - previous_close, 2),
+                 "volume": int(bar["Volume"]), "open": round(float(bar["Open"]), 2),
+                 "high": round(float(bar["High"]), 2), "low": round(float(bar["Low"]), 2),
+                 "close": last, "prevclose": round(previous_close, 2),
+                 "bid": round(max(last - half_spread, 0.0), 2), "ask": round(last + half_spread, 2),
+                 "trade_date": int(time.mktime(date.fromisoformat(df.index[-1]).timetuple()) * 1000)}
+        if symbol not in self._frames:
+            underlying, expiration, option_type, strike = Pricing.parse_option_symbol(symbol)
+            quote.update({"underlying": underlying, "strike": strike,
+                          "option_type": "call" if option_type == 'C' else "put",
+                          "expiration_date": str(expiration), "contract_size": 100})
+        return quote
+
+    def install(self):
+        """
+        Replaces the price matrix with the bars of the market and the option chains with
+        its chains, and empties the option price caches
+        """
+        State.HoldingsStrategy.price_matrix = State.PriceMatrix()
+        State.HoldingsStrategy.price_matrix.add_symbols(self._frames)
+        State.Holdings.option_chains = {symbol: self.get_chain(symbol) for symbol in self._symbols}
+        State.Holdings.options_prices.clear()
+        State.Holdings.failed_options_prices.clear()
+
+
+class _TradierHandler(BaseHTTPRequestHandler):
+    """
+    Answers the requests of a FakeTradierServer
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _answer(self, params):
+        server = self.server
+        server.count_request()
+        if server.latency:
+            time.sleep(server.latency)
+        if server.api_key is not None and \
+                self.headers.get("Authorization", "").replace("Bearer ", "") != server.api_key:
+            self._send_json(401, {"fault": {"faultstring": "Invalid Access Token"}})
+            return
+        path = urlparse(self.path).path.rstrip('/')
+        if path == "/v1/markets/history":
+            self._send_json(200, server.get_history_response(params))
+        elif path == "/v1/markets/quotes":
+            self._send_json(200, server.get_quotes_response(params))
+        elif path == "/v1/markets/options/expirations":
+            self._send_json(200, server.get_expirations_response(params))
+        else:
+            self._send_json(404, {"fault": {"faultstring": f"Unknown path {path}"}})
+
+    def do_GET(self):
+        self._answer({key: values[-1] for key, values in parse_qs(urlparse(self.path).query).items()})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode("utf-8"))
+        query = parse_qs(urlparse(self.path).query)
+        self._answer({key: values[-1] for key, values in {**query, **form}.items()})
+
+
+class FakeTradierServer(ThreadingHTTPServer):
+    """
+    A local HTTP server that answers /v1/markets/history, /v1/markets/quotes and
+    /v1/markets/options/expirations from a SyntheticMarket in the shape of Tradier's
+    responses.
+
+    latency (seconds) is added to every request, to measure fetching as if over a
+    network. If api_key is given, requests without it are refused like Tradier does.
+    Quotes are of the bar on quote_date (default: the last bar of the market).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, market, host="127.0.0.1", port=0, latency=0.0, api_key=None, quote_date=None):
+        super().__init__((host, port), _TradierHandler)
+        self.market = market
+        self.latency = latency
+        self.api_key = api_key
+        self._quote_date = quote_date
+        self._num_requests = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def get_url(self):
+        """
+        Returns: the base URL of the server, e.g. http://127.0.0.1:54321
+        """
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def get_num_requests(self):
+        """
+        Returns: the number of requests answered so far
+        """
+        return self._num_requests
+
+    def count_request(self):
+        """
+        Counts a request
+        """
+        with self._lock:
+            self._num_requests += 1
+
+    def start(self):
+        """
+        Starts answering requests on a background thread. Returns: the server
+        """
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the server and closes its socket
+        """
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
+    def get_history_response(self, params):
+        """
+        Returns: the response to a history request: {"history": {"day": bars}}, a single
+        bar not in a list, or {"history": null} if the symbol has no bars
+        """
+        df = self.market.get_history(params.get("symbol", ""), params.get("start"), params.get("end"))
+        if df is None or df.empty:
+            return {"history": None}
+        days = [{"date": day, "open": round(float(bar.Open), 2), "high": round(float(bar.High), 2),
+                 "low": round(float(bar.Low), 2), "close": round(float(bar.Close), 2),
+                 "volume": int(bar.Volume)} for day, bar in zip(df.index, df.itertuples())]
+        return {"history": {"day": days if len(days) > 1 else days[0]}}
+
+    def get_quotes_response(self, params):
+        """
+        Returns: the response to a quotes request: {"quotes": {"quote": quotes,
+        "unmatched_symbols": {"symbol": symbols}}}, with a single element not in a list
+        and each key left out when it has no elements
+        """
+        quotes = []
+        unmatched = []
+        for symbol in filter(None, params.get("symbols", "").split(",")):
+            quote = self.market.get_quote(symbol.strip(), self._quote_date)
+            if quote is None:
+                unmatched.append(symbol.strip())
+            else:
+                quotes.append(quote)
+        response = {}
+        if quotes:
+            response["quote"] = quotes if len(quotes) > 1 else quotes[0]
+        if unmatched:
+            response["unmatched_symbols"] = {"symbol": unmatched if len(unmatched) > 1 else unmatched[0]}
+        return {"quotes": response}
+
+    def get_expirations_response(self, params):
+        """
+        Returns: the response to an expirations request with strikes: {"expirations":
+        {"expiration": [{"date": ..., "strikes": {"strike": strikes}}]}}, with a single
+        element not in a list, or {"expirations": null} if the symbol lists no options
+        """
+        underlying = params.get("symbol", "")
+        if underlying not in self.market.get_symbols():
+            return {"expirations": None}
+        chain = self.market.get_chain(underlying)
+        expirations = [{"date": str(expiration),
+                        "strikes": {"strike": sorted(set(chain.get_strikes(expiration, 'C')) |
+                                                     set(chain.get_strikes(expiration, 'P')))}}
+                       for expiration in chain.get_expirations()]
+        if not expirations:
+            return {"expirations": None}
+        return {"expirations": {"expiration": expirations if len(expirations) > 1 else expirations[0]}}
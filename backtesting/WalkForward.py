@@ -0,0 +1,193 @@
+import datetime
+import pandas as pd
+import Helper
+import Sweep
+
+# Walk-forward optimization: the history is split into windows of an in-sample slice
+# followed by an out-of-sample slice. The parameter grid is swept over every in-sample
+# slice, and the best parameter set of each window is then run on its out-of-sample
+# slice only, so every point of the resulting equity curve comes from parameters that
+# were chosen without seeing it.
+#
+# Both phases go through one Sweep queue: the price data of the whole history is loaded
+# once and memory-mapped by the workers, and option prices fetched for one window stay in
+# the on-disk option cache for the windows that overlap it.
+
+
+def make_windows(start_date, end_date, in_sample_days, out_of_sample_days, step_days=None, anchored=False):
+    """
+    Returns: the list of (in_sample_start, in_sample_end, out_of_sample_start,
+    out_of_sample_end) date strings that fit between start_date and end_date. Windows
+    move forward by step_days (default: out_of_sample_days, so the out-of-sample slices
+    tile the history). If anchored, every in-sample slice starts at start_date.
+    """
+    start = datetime.date.fromisoformat(start_date)
+    end = datetime.date.fromisoformat(end_date)
+    step = datetime.timedelta(days=step_days or out_of_sample_days)
+    in_sample = datetime.timedelta(days=in_sample_days)
+    out_of_sample = datetime.timedelta(days=out_of_sample_days)
+    windows = []
+    window_start = start
+    while window_start + in_sample + out_of_sample <= end + datetime.timedelta(days=1):
+        in_sample_end = window_start + in_sample - datetime.timedelta(days=1)
+        out_of_sample_end = in_sample_end + out_of_sample
+        windows.append(((start if anchored else window_start).isoformat(), in_sample_end.isoformat(),
+                        (in_sample_end + datetime.timedelta(days=1)).isoformat(),
+                        out_of_sample_end.isoformat()))
+        window_start += step
+    return windows
+
+
+def stitch_equity(curves, initial_value=None):
+    """
+    Returns: one equity series made of curves (a list of series, in time order), each
+    scaled so it starts where the previous one ended. The first curve is scaled to start
+    at initial_value (default: unscaled). Points that repeat an earlier time are dropped
+    """
+    stitched = []
+    value = initial_value
+    for curve in curves:
+        if curve.empty:
+            continue
+        scaled = curve * (value / curve.iloc[0]) if value is not None else curve
+        if stitched:
+            scaled = scaled[scaled.index > stitched[-1].index[-1]]
+        stitched.append(scaled)
+        value = float(curve.iloc[-1] * (value / curve.iloc[0])) if value is not None \
+            else float(curve.iloc[-1])
+    if not stitched:
+        return pd.Series(dtype=float, name="Strategy Value")
+    return pd.concat(stitched).rename("Strategy Value")
+
+
+class WalkForward(object):
+    """
+    A class that runs a walk-forward optimization of backtest_strategy parameters.
+
+    objective is the column of Backtesting.summarize_backtest that is maximized in
+    sample (e.g. return), or a function of a summary row to maximize.
+    """
+
+    def __init__(self, queue_dir, asset_list, start_date, end_date, in_sample_days, out_of_sample_days,
+                 step_days=None, anchored=False, objective="return", unit_size=4):
+        self._sweep = Sweep.SweepCoordinator(
+            queue_dir, asset_list, start_date, end_date, unit_size=unit_size)
+        self._windows = make_windows(start_date, end_date, in_sample_days, out_of_sample_days,
+                                     step_days=step_days, anchored=anchored)
+        self._objective = objective
+        if not self._windows:
+            Helper.log_error(
+                f"No walk-forward window of {in_sample_days}+{out_of_sample_days} days fits "
+                f"between {start_date} and {end_date}")
+
+    def get_windows(self):
+        """
+        Returns: the list of (in_sample_start, in_sample_end, out_of_sample_start,
+        out_of_sample_end) of each window
+        """
+        return self._windows
+
+    def get_sweep(self):
+        """
+        Returns: the SweepCoordinator that runs the backtests
+        """
+        return self._sweep
+
+    def _score(self, table):
+        """
+        Returns: the objective of every row of table
+        """
+        if callable(self._objective):
+            return table.apply(self._objective, axis=1)
+        return table[self._objective]
+
+    def select(self, table, param_names):
+        """
+        Returns: a dict of window to (params, score), the parameter dict that scored best
+        on its in-sample slice and its score, from the rows of table (as returned by
+        SweepCoordinator.collect)
+        """
+        in_sample = table[(table["phase"] == "in_sample") & table["error"].isna()]
+        scores = self._score(in_sample).astype(float)
+        winners = {}
+        for window, rows in in_sample.assign(score=scores).groupby("window"):
+            rows = rows.dropna(subset=["score"])
+            if rows.empty:
+                Helper.log_warn(f"Every in-sample run of window {window} failed")
+                continue
+            best = rows.loc[rows["score"].idxmax()]
+            winners[window] = ({name: best[name].item() if hasattr(best[name], "item") else best[name]
+                                for name in param_names}, float(best["score"]))
+        return winners
+
+    def _run(self, num_workers, stale_timeout):
+        """
+        Runs the submitted units with local workers, or waits for remote ones if
+        num_workers is 0
+        """
+        if num_workers:
+            self._sweep.run_local_workers(num_workers, stale_timeout=stale_timeout)
+        else:
+            self._sweep.wait(stale_timeout=stale_timeout)
+
+    def run(self, grid, num_workers=4, stale_timeout=None):
+        """
+        Sweeps grid (a dict of parameter -> list of values) over every in-sample slice in
+        parallel, then runs the winner of each window on its out-of-sample slice.
+        num_workers local workers are started for each phase; with 0 the queue is left to
+        remote workers.
+
+        Returns: (windows, equity), a dataframe with one row per window, its dates, winning
+        parameters, in-sample score and out-of-sample summary, and the stitched
+        out-of-sample equity curve indexed by time
+        """
+        param_names = sorted(grid.keys()) if isinstance(grid, dict) else \
+            sorted(set().union(*[params.keys() for params in grid]))
+        self._sweep.prepare_price_cache()
+        for i, (in_start, in_end, _, _) in enumerate(self._windows):
+            self._sweep.submit(grid, start_date=in_start, end_date=in_end,
+                               tags={"window": i, "phase": "in_sample"})
+        self._run(num_workers, stale_timeout)
+        table = self._sweep.collect()
+        winners = self.select(table, param_names)
+        for i, (params, _) in winners.items():
+            _, _, out_start, out_end = self._windows[i]
+            self._sweep.submit([params], start_date=out_start, end_date=out_end,
+                               tags={"window": i, "phase": "out_of_sample"})
+        self._run(num_workers, stale_timeout)
+        table, curves = self._collect_out_of_sample(winners)
+        return table, stitch_equity([curves[i] for i in sorted(curves)],
+                                    initial_value=self._get_initial_value(table))
+
+    def _get_initial_value(self, table):
+        """
+        Returns: the initial value of the first out-of-sample run, to start the stitched curve at
+        """
+        values = table["initial_value"].dropna() if "initial_value" in table else []
+        return float(values.iloc[0]) if len(values) else None
+
+    def _collect_out_of_sample(self, winners):
+        """
+        Returns: (windows, curves), the table of windows and a dict of window to its
+        out-of-sample equity curve
+        """
+        rows = []
+        curves = {}
+        for record in self._sweep.get_results():
+            tags = record.get("tags", {})
+            if tags.get("phase") != "out_of_sample":
+                continue
+            i = tags["window"]
+            in_start, in_end, out_start, out_end = self._windows[i]
+            row = {"window": i, "in_sample_start": in_start, "in_sample_end": in_end,
+                   "out_of_sample_start": out_start, "out_of_sample_end": out_end,
+                   **winners[i][0], "in_sample_score": winners[i][1],
+                   **(record["summary"] or {}), "error": record["error"]}
+            rows.append(row)
+            if record["equity"]:
+                curves[i] = pd.Series(record["equity"], index=pd.Index(record["times"], name="Time"),
+                                      dtype=float)
+        table = pd.DataFrame(rows)
+        if not table.empty:
+            table = table.sort_values("window").reset_index(drop=True)
+        return table, curves
@@ -0,0 +1,68 @@
+import unittest
+import numpy as np
+import Indicators
+
+
+def make_bars(num_bars=500, num_symbols=20, seed=0):
+    """
+    Returns: (high, low, close) of a random walk of num_bars bars of num_symbols symbols
+    """
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, (num_bars, num_symbols)), axis=0))
+    high = close * (1 + rng.uniform(0, 0.02, close.shape))
+    low = close * (1 - rng.uniform(0, 0.02, close.shape))
+    return high, low, close
+
+
+def add_gaps(values, rows, columns):
+    """
+    Returns: a copy of values with nan on the given rows of the given columns
+    """
+    values = values.copy()
+    values[np.ix_(rows, columns)] = np.nan
+    return values
+
+
+class TestBatchAndStreaming(unittest.TestCase):
+    """
+    Feeding a streaming indicator every row of a matrix reproduces the batch form
+    """
+
+    def assert_match(self, high, low, close):
+        num_symbols = close.shape[1]
+        checks = {
+            "sma": (Indicators.sma(close, 20), Indicators.stream(Indicators.SMA(num_symbols, 20), close)),
+            "ema": (Indicators.ema(close, 20), Indicators.stream(Indicators.EMA(num_symbols, 20), close)),
+            "bollinger": (np.array(Indicators.bollinger_bands(close, 20)),
+                          np.array(Indicators.stream(Indicators.BollingerBands(num_symbols, 20), close))),
+            "rsi": (Indicators.rsi(close, 14), Indicators.stream(Indicators.RSI(num_symbols, 14), close)),
+            "atr": (Indicators.atr(high, low, close, 14),
+                    Indicators.stream(Indicators.ATR(num_symbols, 14), high, low, close)),
+            "zscore": (Indicators.zscore(close, 20), Indicators.stream(Indicators.ZScore(num_symbols, 20), close)),
+            "percentile": (Indicators.rolling_percentile(close, 20),
+                           Indicators.stream(Indicators.RollingPercentile(num_symbols, 20), close)),
+        }
+        for name, (batch, streamed) in checks.items():
+            with self.subTest(indicator=name):
+                np.testing.assert_allclose(streamed, batch, rtol=1e-9, atol=1e-9, equal_nan=True)
+
+    def test_random_walk(self):
+        self.assert_match(*make_bars())
+
+    def test_missing_bars(self):
+        high, low, close = make_bars()
+        # single missing bars, a run of them and one right before a resync of the sums
+        rows = [25, 101, 102, 103, 239, 400]
+        self.assert_match(*(add_gaps(x, rows, [0, 3, 7]) for x in (high, low, close)))
+
+    def test_rolling_sums_recover_after_missing_bar(self):
+        close = make_bars(num_symbols=1)[2]
+        close[50] = np.nan
+        streamed = Indicators.stream(Indicators.SMA(1, 20), close)
+        # nan exactly while the missing bar is in the window
+        self.assertTrue(np.isnan(streamed[50:70]).all())
+        self.assertFalse(np.isnan(streamed[70:]).any())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import datetime
+import json
+import os
+import tempfile
+import unittest
+import OptionChain
+import Pricing
+import State
+import Synthetic
+import tradier
+
+
+class TestListings(unittest.TestCase):
+    """
+    Option listings are loaded from the listings store, refreshed from a local Tradier
+    stand-in serving a synthetic market
+    """
+
+    def setUp(self):
+        self.market = Synthetic.SyntheticMarket(num_symbols=2)
+        self.server = Synthetic.FakeTradierServer(self.market).start()
+        self.base_url = tradier.set_base_url(self.server.get_url())
+        self.api_key = os.environ.get("TRADIER_API_KEY")
+        os.environ["TRADIER_API_KEY"] = "Bearer test"
+        self.directory = tempfile.TemporaryDirectory()
+        self.listings_directory = OptionChain.LISTINGS_DIRECTORY
+        OptionChain.LISTINGS_DIRECTORY = self.directory.name
+        self.option_chains = State.Holdings.option_chains
+        self.option_pricing = State.Holdings.option_pricing
+        self.price_matrix = State.HoldingsStrategy.price_matrix
+
+    def tearDown(self):
+        State.HoldingsStrategy.price_matrix = self.price_matrix
+        State.Holdings.option_pricing = self.option_pricing
+        State.Holdings.option_chains = self.option_chains
+        OptionChain.LISTINGS_DIRECTORY = self.listings_directory
+        self.directory.cleanup()
+        if self.api_key is None:
+            del os.environ["TRADIER_API_KEY"]
+        else:
+            os.environ["TRADIER_API_KEY"] = self.api_key
+        tradier.set_base_url(self.base_url)
+        self.server.stop()
+
+    def test_load_listing_matches_the_market(self):
+        chain = OptionChain.load_listing("SYAAA")
+        self.assertEqual(chain.get_fingerprint(), self.market.get_chain("SYAAA").get_fingerprint())
+        self.assertTrue(os.path.isfile(f"{self.directory.name}/SYAAA.json"))
+
+    def test_listing_is_fetched_once_a_day(self):
+        OptionChain.load_listing("SYAAA")
+        num_requests = self.server.get_num_requests()
+        chain = OptionChain.load_listing("SYAAA")
+        self.assertEqual(self.server.get_num_requests(), num_requests)
+        self.assertEqual(chain.get_fingerprint(), self.market.get_chain("SYAAA").get_fingerprint())
+
+    def test_stored_expirations_are_kept(self):
+        with open(f"{self.directory.name}/SYAAA.json", 'w') as f:
+            json.dump({"fetched": "2000-01-01", "expirations": {"2018-12-21": [90.0, 100.0]}}, f)
+        chain = OptionChain.load_listing("SYAAA")
+        self.assertEqual(chain.get_strikes(datetime.date(2018, 12, 21), 'C'), [90.0, 100.0])
+        self.assertEqual(len(chain), len(self.market.get_chain("SYAAA")) + 4)
+
+    def test_no_listing(self):
+        self.assertIsNone(OptionChain.load_listing("SYAAA", refresh=False))
+        self.assertIsNone(OptionChain.load_listing("UNLISTED"))
+
+    def test_option_strategies_load_their_listings(self):
+        State.HoldingsStrategy.price_matrix = State.PriceMatrix()
+        State.HoldingsStrategy.price_matrix.add_symbols(self.market.get_frames())
+        State.Holdings.option_pricing = State.OptionPricing.Fallback
+        State.Holdings.option_chains = None
+        State.HoldingsStrategy("Test", ["SYAAA"], assets=State.Assets.Options)
+        self.assertIn("SYAAA", State.Holdings.option_chains)
+        cur_date = datetime.date(2020, 3, 20)
+        last_price = State.HoldingsStrategy.get_stock_price("SYAAA", cur_date, "Close")
+        near, far = State.Holdings.get_spread_symbols("SYAAA", last_price, cur_date, 0, 1)
+        chain = self.market.get_chain("SYAAA")
+        for symbol in (near, far):
+            _, expiration, option_type, strike = Pricing.parse_option_symbol(symbol)
+            self.assertIn(strike, chain.get_strikes(expiration, option_type))
+        self.assertNotEqual(near, far)
+
+
+if __name__ == "__main__":
+    unittest.main()
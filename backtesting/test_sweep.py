@@ -0,0 +1,86 @@
+import collections
+import glob
+import json
+import os
+import re
+import tempfile
+import unittest
+import State
+import Sweep
+import Synthetic
+
+
+class TestLocalSweep(unittest.TestCase):
+    """
+    A sweep over a synthetic universe, run by two local worker processes, runs every work
+    unit once and merges the results of every parameter set
+    """
+
+    GRID = {"long_buying_delay": [2, 4], "short_sd": [0, 1], "target_percent_gain": [0.5]}
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.price_matrix = State.HoldingsStrategy.price_matrix
+        self.option_chains = State.Holdings.option_chains
+        self.option_pricing = State.Holdings.option_pricing
+        market = Synthetic.SyntheticMarket(num_symbols=2)
+        market.install()
+        # priced by the model, so the workers need no network
+        State.Holdings.option_pricing = State.OptionPricing.Model
+        self.coordinator = Sweep.SweepCoordinator(
+            self.directory.name, market.get_symbols(), "2020-01-01", "2020-03-01", unit_size=1)
+
+    def tearDown(self):
+        State.HoldingsStrategy.price_matrix = self.price_matrix
+        State.Holdings.option_chains = self.option_chains
+        State.Holdings.option_pricing = self.option_pricing
+        State.Holdings.options_prices.clear()
+        State.Holdings.failed_options_prices.clear()
+        self.directory.cleanup()
+
+    def test_two_workers(self):
+        queue = self.coordinator.get_queue()
+        self.coordinator.prepare_price_cache()
+        num_units = self.coordinator.submit(self.GRID)
+        self.assertEqual(num_units, 4)
+        self.coordinator.run_local_workers(2)
+
+        self.assertEqual(queue.num_pending(), 0)
+        unit_ids = [f"{self.coordinator.get_run_id()}-{i:06d}" for i in range(num_units)]
+        results = {}
+        for unit_id in unit_ids:
+            with open(queue.get_path("results", f"{unit_id}.json")) as f:
+                results[unit_id] = json.load(f)
+        self.assertEqual(sorted(os.listdir(queue.get_path("results"))), [f"{unit_id}.json" for unit_id in unit_ids])
+        self.assertTrue({result["worker_id"] for result in results.values()} <= {"local-0", "local-1"})
+        # every unit was run by exactly one worker
+        runs = collections.Counter()
+        for log_path in glob.glob(queue.get_path("logs", "worker-*.log")):
+            with open(log_path) as f:
+                runs.update(re.findall(r"running (\S+)", f.read()))
+        self.assertEqual(runs, collections.Counter(unit_ids))
+
+        table = self.coordinator.collect()
+        self.assertEqual(len(table), len(Sweep.expand_grid(self.GRID)))
+        self.assertEqual(sorted(map(tuple, table[sorted(self.GRID)].values.tolist())),
+                         sorted(tuple(params[key] for key in sorted(self.GRID))
+                                for params in Sweep.expand_grid(self.GRID)))
+        self.assertTrue(table["error"].isna().all(), table["error"].tolist())
+        self.assertTrue(table["return"].notna().all())
+
+    def test_results_of_other_sweeps_are_ignored(self):
+        # an earlier sweep left a finished unit in the same queue directory
+        earlier = Sweep.SweepCoordinator(self.directory.name, ["SYAAA"], "2020-01-01", "2020-03-01")
+        earlier.submit([{"long_buying_delay": 9}])
+        queue = earlier.get_queue()
+        unit = queue.claim("local-0")
+        queue.complete(unit, [{"params": unit["params"][0], "summary": {"return": 1.0},
+                               "equity": None, "times": None, "pruned": False, "error": None}])
+        self.assertNotEqual(earlier.get_run_id(), self.coordinator.get_run_id())
+        self.assertEqual(len(earlier.collect()), 1)
+        self.assertTrue(self.coordinator.collect().empty)
+        self.assertEqual(len(queue.get_results()), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,26 +1,121 @@
-import http
-import requests
 import os
+import sys
+import time
+import requests
 import pandas as pd
+import Profiling
+
+# The Tradier market data API. Requests go to TRADIER_BASE_URL (the sandbox by default),
+# which set_base_url overrides, e.g. to point a run at a Synthetic.FakeTradierServer.
+# The API key is read from TRADIER_API_KEY when a request is made, not at import, so
+# the module can be imported without one.
+
+DEFAULT_BASE_URL = "https://sandbox.tradier.com"
+
+_base_url = None
+_session = None
+
+
+def get_base_url():
+    """
+    Returns: the base URL requests are sent to
+    """
+    return _base_url or os.environ.get("TRADIER_BASE_URL", DEFAULT_BASE_URL)
+
+
+def set_base_url(url):
+    """
+    Sends requests to url instead (None restores TRADIER_BASE_URL or the sandbox).
+    Returns: the URL that was set before
+    """
+    global _base_url
+    previous = _base_url
+    _base_url = url.rstrip('/') if url else None
+    return previous
+
+
+def get_headers():
+    """
+    Returns: the headers of a request, with the API key in TRADIER_API_KEY
+    """
+    return {'Authorization': os.environ['TRADIER_API_KEY'], 'Accept': 'application/json'}
+
+
+def get_session():
+    """
+    Returns: the HTTP session shared by requests, which keeps connections alive between them
+    """
+    global _session
+    if _session is None:
+        _session = requests.Session()
+    return _session
+
+
+def _get(path, params, name):
+    """
+    Returns: the decoded JSON response of a GET request to path, timed as name
+    """
+    request_start = time.perf_counter()
+    response = get_session().get(f"{get_base_url()}{path}", params=params, headers=get_headers())
+    Profiling.observe_latency(name, time.perf_counter() - request_start)
+    return response.json()
+
+
+def _as_list(element):
+    """
+    Returns: element as a list; Tradier returns a lone element instead of a list of one
+    """
+    if element is None:
+        return []
+    return element if isinstance(element, list) else [element]
+
+
+def get_history(symbol, start='2015-01-01', end=None):
+    """
+    Returns: the daily bars (Open, High, Low, Close, Volume) of symbol (a stock or an OCC
+    option symbol) from start to end (default: today), indexed by date. Raises if the
+    request fails or symbol has no history
+    """
+    params = {'symbol': symbol, 'start': start}
+    if end is not None:
+        params['end'] = end
+    trade_data_json = _get('/v1/markets/history', params, "tradier history")
+    # a symbol without history has none ('history': null), which raises here
+    trade_data_arr = trade_data_json['history']['day']
+    if isinstance(trade_data_arr, dict):
+        trade_data_arr = [trade_data_arr]
+    dates = []
+    trade_data = []
+    for element in trade_data_arr:
+        dates.append(element['date'])
+        trade_data.append([element['open'], element['high'],
+                           element['low'], element['close'], element['volume']])
+    return pd.DataFrame(trade_data, index=dates,
+                        columns=["Open", "High", "Low", "Close", "Volume"])
+
+
+def get_quotes(symbols):
+    """
+    Returns: the list of quotes (dicts of Tradier's quote fields) of symbols, fetched in
+    one request. Unknown symbols are left out
+    """
+    quotes_json = _get('/v1/markets/quotes', {'symbols': ",".join(symbols)}, "tradier quotes")
+    return _as_list((quotes_json.get('quotes') or {}).get('quote'))
+
+
+def get_option_expirations(underlying):
+    """
+    Returns: a dict of the date (YYYY-MM-DD) of every listed expiration of options on
+    underlying to the list of its listed strikes, fetched in one request
+    """
+    expirations_json = _get('/v1/markets/options/expirations',
+                            {'symbol': underlying, 'includeAllRoots': 'true', 'strikes': 'true'},
+                            "tradier expirations")
+    return {expiration['date']: [float(strike) for strike in _as_list((expiration.get('strikes') or {}).get('strike'))]
+            for expiration in _as_list((expirations_json.get('expirations') or {}).get('expiration'))}
+
 
-api_key = os.environ['TRADIER_API_KEY']
-
-trade_data_response = requests.get('https://sandbox.tradier.com/v1/markets/history?',
-                                   params={'symbol': 'NVDA200117P00220000',
-                                           'start': '2020-01-01'},
-                                   headers={'Authorization': api_key,
-                                            'Accept': 'application/json'})
-
-print("Response", trade_data_response)
-trade_data_json = trade_data_response.json()
-# print("JSON", trade_data_json)
-trade_data_arr = trade_data_json['history']['day']
-dates = []
-trade_data = []
-for element in trade_data_arr:
-    dates.append(element['date'])
-    trade_data.append([element['open'], element['high'],
-                       element['low'], element['close'], element['volume']])
-df = pd.DataFrame(trade_data, index=dates,
-                  columns=["Open", "High", "Low", "Close", "Volume"])
-print(df)
+if __name__ == "__main__":
+    symbol = sys.argv[1] if len(sys.argv) > 1 else 'NVDA200117P00220000'
+    print(get_history(symbol, '2020-01-01'))
+    print(get_quotes([symbol]))
@@ -1,7 +1,14 @@
 from abc import ABC, abstractmethod
 import pandas as pd
 import datetime
+import os
 import re
+import sys
+from pathlib import Path
+
+sys.path.append(os.path.join(os.path.dirname(
+    Path(__file__).absolute()), '..', 'backtesting'))
+import Signals
 
 
 class Condition(ABC):
@@ -136,14 +143,20 @@ class TimePeriodCondition(Condition):
     """
     Condition parent class for conditions that has to deal with a stock's price
     within a time period.
+
+    This is a single-stock adapter over the incremental signal shared with backtesting
+    (see backtesting/Signals.py). The window is warmed up with the last week_length
+    closes of the data.
     """
+    signal_class = None
 
     def __init__(self, data, portfolio, sd=0, week_length=5):
         super().__init__(data, portfolio)
         self._standard_deviation = sd
         self._week_length = week_length
-        self._changing_week_data = pd.DataFrame()
-        self._changing_day_data = pd.DataFrame()
+        self._signal = self.signal_class(
+            ["stock"], sd, week_length)
+        self._signal.warm_up(data[["Close"]].to_numpy())
 
     def get_week_length(self):
         """
@@ -151,37 +164,17 @@ class TimePeriodCondition(Condition):
         """
         return self._week_length
 
-    def warm_up_data(self, today):
+    def add_datapoint(self, datapoint):
         """
-        Warms-up changing_data to be prefilled with values.
+        Adds a completed bar to the window.
         """
-        if self._changing_week_data.empty:
-            dataframe = self.get_data()
-            if type(today) == pd._libs.tslibs.timestamps.Timestamp:
-                today = today.strftime("%Y/%m/%d")
-            arr = []
-            i = 0
-            # warm-up data with everyday starting from yesterday
-            while len(arr) < self._week_length:
-                i -= 1
-                try:
-                    arr.append(dataframe.iloc[i])
-                except KeyError as e:
-                    print(e)
-            self._changing_week_data = pd.DataFrame(arr[::-1])
+        self._signal.add_bar([datapoint["Close"]])
 
-    def add_datapoint(self, datapoint):
+    def is_true(self, current_date, current_price):
         """
-        Adds a datapoint to the changing data.
+        Returns: True if this condition is true, False otherwise
         """
-        # print("before", self._changing_week_data)
-        self._changing_week_data = self._changing_week_data[1:]
-        # print('during', self._changing_week_data)
-        self._changing_week_data = self._changing_week_data.append(datapoint)
-        # print('after', self._changing_week_data)
-        # print(datapoint)
-        if len(self._changing_week_data) < self._week_length:
-            assert False
+        return self._signal.is_true_for("stock", current_price)
 
 
 class IsLowForPeriod(TimePeriodCondition):
@@ -189,68 +182,22 @@ class IsLowForPeriod(TimePeriodCondition):
     Condition: Is True if the stock is low for the week (+/- n standard
     deviations). False otherwise
     """
+    signal_class = Signals.LowForPeriod
 
     def __init__(self, data, portfolio, sd=0, week_length=5):
         super().__init__(data, portfolio, sd, week_length)
 
-    def is_true_stocks(self, current_date, current_price):
-        """
-        Helper function for is_true for handling stock data
-        """
-        abool = False
-        try:
-            self.warm_up_data(current_date)
-            # if current price < lowest price in dataframe, abool = True
-            lowest_price = self._changing_week_data["Close"].min()
-            # print("price + sd", current_price +
-            #       (self._standard_deviation * self._changing_week_data["Close"].std()))
-            # print("lowest price", lowest_price)
-            print("current_price", current_price, type(current_price))
-            if current_price < lowest_price + (self._standard_deviation * self._changing_week_data["Close"].std()):
-                # print("lowest_price", lowest_price)
-                # print((self._standard_deviation *
-                #        self._changing_week_data["Close"].std()))
-                abool = True
-        except KeyError as e:
-            print("Exception", e)
-        return abool
-
-    def is_true(self, current_date, current_price):
-        """
-        Returns: True if this condition is true, False otherwise
-        """
-        return self.is_true_stocks(current_date, current_price)
-
 
 class IsHighForPeriod(TimePeriodCondition):
     """
     Condition: Is True if the stock is high for the week (+/- n standard
     deviations). False otherwise
     """
+    signal_class = Signals.HighForPeriod
 
     def __init__(self, data, portfolio, sd=0, week_length=5):
         super().__init__(data, portfolio, sd, week_length)
 
-    def is_true_stocks(self, current_date, current_price):
-        """
-        Helper function for is_true for handling stock data
-        """
-        abool = False
-        try:
-            self.warm_up_data(current_date)
-            highest_price = self._changing_week_data["Close"].max()
-            if current_price > highest_price + (self._standard_deviation * self._changing_week_data["Close"].std()):
-                abool = True
-        except KeyError:
-            pass
-        return abool
-
-    def is_true(self, current_date, current_price):
-        """
-        Returns: True if this condition is true, False otherwise
-        """
-        return self.is_true_stocks(current_date, current_price)
-
 
 class HasMoreBuyToOpen(Condition):
     """
@@ -0,0 +1,321 @@
+import asyncio
+import datetime
+import io
+import logging
+import os
+import sqlite3
+import threading
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS positions (
+        position_id VARCHAR(255) PRIMARY KEY,
+        position_type VARCHAR(255),
+        num_positions INTEGER,
+        avg_cost float(2)
+    )""",
+
+    """
+    CREATE TABLE IF NOT EXISTS fills (
+        position_id VARCHAR(255) NOT NULL,
+        fill_time TIMESTAMP NOT NULL,
+        quantity INTEGER NOT NULL,
+        price float(2) NOT NULL
+    )""",
+
+    """
+    CREATE INDEX IF NOT EXISTS fills_position_time ON fills (position_id, fill_time)
+    """,
+
+    """
+    CREATE TABLE IF NOT EXISTS portfolio (
+        portfolio_cash float(2) NOT NULL,
+        portfolio_value float(2) NOT NULL,
+        time_last_updated TIMESTAMP NOT NULL
+    )""",
+
+    """
+    CREATE INDEX IF NOT EXISTS portfolio_time ON portfolio (time_last_updated)
+    """,
+)
+
+UPSERT_POSITION = """
+    INSERT INTO positions (position_id, position_type, num_positions, avg_cost)
+    VALUES {values}
+    ON CONFLICT (position_id) DO UPDATE SET
+        num_positions = excluded.num_positions,
+        avg_cost = excluded.avg_cost
+    """
+
+SELECT_POSITIONS = """
+    SELECT position_id, position_type, num_positions, avg_cost FROM positions
+    WHERE position_id IN ({ids})
+    """
+
+
+def apply_fills(positions, fills):
+    """
+    Returns: the (position_id, position_type, num_positions, avg_cost) rows of the
+    positions touched by fills, a list of (position_id, position_type, fill_time,
+    quantity, price) applied in order to positions, the rows held before them. The average
+    cost is re-averaged by fills that add to a position, kept by fills that reduce it, and
+    reset to the fill price when a fill flips it to the other side.
+    """
+    held = {position_id: [position_type, num, avg_cost]
+            for position_id, position_type, num, avg_cost in positions}
+    touched = []
+    for position_id, position_type, _, quantity, price in fills:
+        if position_id not in held:
+            held[position_id] = [position_type, 0, 0.0]
+        if position_id not in touched:
+            touched.append(position_id)
+        row = held[position_id]
+        num, avg_cost = row[1], row[2]
+        total = num + quantity
+        if num == 0 or (num > 0) == (quantity > 0):
+            avg_cost = (avg_cost * num + price * quantity) / total
+        elif total == 0:
+            avg_cost = 0.0
+        elif (total > 0) != (num > 0):
+            avg_cost = price
+        row[1], row[2] = total, avg_cost
+    return [(position_id, *held[position_id]) for position_id in touched]
+
+
+class PostgresBackend(object):
+    """
+    A class that writes batches to PostgreSQL through a thread-safe connection pool.
+
+    Fills are appended with COPY; positions and snapshots are written with one
+    execute_values statement per batch.
+    """
+
+    def __init__(self, database='forwardtesting', min_connections=1, max_connections=4):
+        import psycopg2.pool
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            min_connections, max_connections, host=os.environ['POSTGRE_HOST'], database=database,
+            user=os.environ['POSTGRE_USER'], password=os.environ['POSTGRE_PASSWORD'])
+
+    def execute(self, cmds):
+        """
+        Executes each command in cmds in one transaction
+        """
+        conn = self._pool.getconn()
+        try:
+            with conn:
+                with conn.cursor() as cursor:
+                    for cmd in cmds:
+                        cursor.execute(cmd)
+        finally:
+            self._pool.putconn(conn)
+
+    def write_batch(self, fills, snapshots):
+        """
+        Writes fills and portfolio snapshots in one transaction
+        """
+        from psycopg2.extras import execute_values
+        conn = self._pool.getconn()
+        try:
+            with conn:
+                with conn.cursor() as cursor:
+                    if fills:
+                        buffer = io.StringIO()
+                        for position_id, _, fill_time, quantity, price in fills:
+                            buffer.write(
+                                f"{position_id}\t{fill_time.isoformat()}\t{quantity}\t{price}\n")
+                        buffer.seek(0)
+                        cursor.copy_expert(
+                            "COPY fills (position_id, fill_time, quantity, price) FROM STDIN", buffer)
+                        ids = sorted({fill[0] for fill in fills})
+                        cursor.execute(SELECT_POSITIONS.format(ids=", ".join(["%s"] * len(ids))) +
+                                       " FOR UPDATE", ids)
+                        execute_values(cursor, UPSERT_POSITION.format(values="%s"),
+                                       apply_fills(cursor.fetchall(), fills))
+                    if snapshots:
+                        execute_values(cursor, "INSERT INTO portfolio (portfolio_cash, portfolio_value, "
+                                       "time_last_updated) VALUES %s", snapshots)
+        finally:
+            self._pool.putconn(conn)
+
+    def close(self):
+        self._pool.closeall()
+
+
+class SQLiteBackend(object):
+    """
+    A class that writes batches to an SQLite file, a stand-in for PostgreSQL in tests and
+    offline runs. Batches are written with executemany.
+    """
+
+    def __init__(self, path=':memory:'):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+    def execute(self, cmds):
+        """
+        Executes each command in cmds in one transaction
+        """
+        with self._lock, self._conn:
+            for cmd in cmds:
+                self._conn.execute(cmd)
+
+    def query(self, cmd):
+        """
+        Returns: the rows returned by cmd
+        """
+        with self._lock:
+            return self._conn.execute(cmd).fetchall()
+
+    def write_batch(self, fills, snapshots):
+        """
+        Writes fills and portfolio snapshots in one transaction
+        """
+        with self._lock, self._conn:
+            if fills:
+                self._conn.executemany("INSERT INTO fills (position_id, fill_time, quantity, price) "
+                                       "VALUES (?, ?, ?, ?)",
+                                       [(position_id, fill_time.isoformat(), quantity, price)
+                                        for position_id, _, fill_time, quantity, price in fills])
+                ids = sorted({fill[0] for fill in fills})
+                positions = self._conn.execute(
+                    SELECT_POSITIONS.format(ids=", ".join(["?"] * len(ids))), ids).fetchall()
+                self._conn.executemany(UPSERT_POSITION.format(values="(?, ?, ?, ?)"),
+                                       apply_fills(positions, fills))
+            if snapshots:
+                self._conn.executemany("INSERT INTO portfolio (portfolio_cash, portfolio_value, "
+                                       "time_last_updated) VALUES (?, ?, ?)",
+                                       [(cash, value, t.isoformat()) for cash, value, t in snapshots])
+
+    def close(self):
+        self._conn.close()
+
+
+class PositionStore(object):
+    """
+    A class that persists the fills and portfolio snapshots of the live engine.
+
+    Writes are queued in memory and flushed in batches by a background task, either
+    when batch_size records are waiting or every flush_interval seconds. The database
+    calls run in a worker thread, so recording a fill never blocks the quote loop.
+    """
+
+    def __init__(self, backend, batch_size=500, flush_interval=1.0):
+        self._backend = backend
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._fills = []
+        self._snapshots = []
+        self._wakeup = None
+        self._task = None
+        self._closing = False
+
+    def create_schema(self):
+        """
+        Creates the tables and indexes if they don't exist
+        """
+        self._backend.execute(SCHEMA)
+
+    def get_backend(self):
+        """
+        Returns: the database backend of this store
+        """
+        return self._backend
+
+    def record_fill(self, position_id, position_type, quantity, price, fill_time=None):
+        """
+        Queues a fill to be written
+        """
+        self._fills.append((position_id, position_type,
+                            fill_time or datetime.datetime.now(), quantity, price))
+        self._notify()
+
+    def record_snapshot(self, portfolio_cash, portfolio_value, snapshot_time=None):
+        """
+        Queues a portfolio snapshot to be written
+        """
+        self._snapshots.append(
+            (portfolio_cash, portfolio_value, snapshot_time or datetime.datetime.now()))
+        self._notify()
+
+    def _notify(self):
+        if self._wakeup is not None and len(self._fills) + len(self._snapshots) >= self._batch_size:
+            self._wakeup.set()
+
+    def take_batch(self):
+        """
+        Returns: (fills, snapshots) queued so far, and empties the queue
+        """
+        fills, self._fills = self._fills, []
+        snapshots, self._snapshots = self._snapshots, []
+        return fills, snapshots
+
+    def return_batch(self, fills, snapshots):
+        """
+        Puts back a batch taken by take_batch that could not be written, ahead of the
+        records queued since, so it is written first on the next flush
+        """
+        self._fills[:0] = fills
+        self._snapshots[:0] = snapshots
+
+    def flush(self):
+        """
+        Writes every queued record now, blocking until they are written. If the write
+        fails, the records stay queued and the error is raised
+        """
+        fills, snapshots = self.take_batch()
+        if fills or snapshots:
+            try:
+                self._backend.write_batch(fills, snapshots)
+            except Exception:
+                self.return_batch(fills, snapshots)
+                raise
+
+    async def flush_async(self):
+        """
+        Writes every queued record in a worker thread. If the write fails, the records
+        stay queued and the error is raised
+        """
+        fills, snapshots = self.take_batch()
+        if fills or snapshots:
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._backend.write_batch, fills, snapshots)
+            except Exception:
+                self.return_batch(fills, snapshots)
+                raise
+
+    async def run(self):
+        """
+        Flushes queued records in the background until close is called. A failed write
+        is logged and retried on the next flush
+        """
+        self._wakeup = asyncio.Event()
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush_async()
+            except Exception:
+                logging.exception("Writing %d fills and %d snapshots failed; retrying on the next flush",
+                                  len(self._fills), len(self._snapshots))
+
+    def start(self):
+        """
+        Starts the background writer on the running event loop
+        """
+        self._task = asyncio.ensure_future(self.run())
+        return self._task
+
+    async def close(self):
+        """
+        Stops the background writer and writes every queued record
+        """
+        self._closing = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+        if self._task is not None:
+            await self._task
+        await self.flush_async()
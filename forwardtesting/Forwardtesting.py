@@ -1,98 +1,136 @@
 import logging
+import asyncio
 import datetime
-import pytz
-import holidays
 import os
 import sys
-import http.client
-import json
-import time
 import pandas_datareader
 import pandas as pd
-import Conditions
+from pathlib import Path
+import QuoteFeeds
 import State
 
+sys.path.append(os.path.join(os.path.dirname(
+    Path(__file__).absolute()), '..', 'backtesting'))
+import Signals
+
+
+def load_stock_data(stock):
+    path = os.path.dirname(Path(__file__).absolute()) + '/price_data'
+    today = datetime.date.today()
+    try:
+        df = pd.read_csv(
+            f"{path}/{stock}.csv", index_col="Date")
+        while today.weekday() > 4:
+            today = today + datetime.timedelta(-1)
+        if str(today) != df.iloc[-1].name:
+            assert False
+    except:
+        df = pandas_datareader.data.DataReader(stock,
+                                               start='2020-5-1',
+                                               end=today.strftime(
+                                                   "%m/%d/%Y"),
+                                               data_source='yahoo')
+        df.to_csv(f"{path}/{stock}.csv")
+    return df
+
 
 class ForwardTesting(object):
-    def __init__(self, stock, buying_delay):
-        self.last_purchase = None
-        self.stock = stock
+    """
+    An asyncio forward-testing engine.
+
+    The engine consumes quotes for many stocks from an interchangeable QuoteFeed (batched
+    polling, streaming, or a fake feed for tests) and evaluates the buying condition of a
+    stock on every quote for it with the incremental signals shared with backtesting.
+    Price history is reloaded once per trading session, on the first quote of the day,
+    and warms up the signals for every stock at once. If a Database.PositionStore is
+    given, simulated fills, stamped with the time of their quote, and a portfolio
+    snapshot at the end of every session are persisted through its write-behind queue.
+    """
+
+    def __init__(self, stocks, buying_delay, feed=None, data_loader=load_stock_data, store=None):
+        self.stocks = list(stocks)
         self.buying_delay = buying_delay
+        self.feed = feed or QuoteFeeds.TradierPollingFeed(self.stocks)
+        self.data_loader = data_loader
+        self.store = store
+        self.portfolio = State.Portfolio()
+        self.last_purchase = {stock: None for stock in self.stocks}
+        self.session_date = None
+        self.last_prices = {}
+        self.last_quote_time = None
+        self.data = {}
+        self.buying_condition = None
 
-    def load_stock_data(self):
-        today = datetime.date.today()
-        try:
-            df = pd.read_csv(
-                f"price_data/{self.stock}.csv", index_col="Date")
-            while today.weekday() > 4:
-                today = today + datetime.timedelta(-1)
-            if str(today) != df.iloc[-1].name:
-                assert False
-        except:
-            df = pandas_datareader.data.DataReader(self.stock,
-                                                   start='2020-5-1',
-                                                   end=today.strftime(
-                                                       "%m/%d/%Y"),
-                                                   data_source='yahoo')
-            df.to_csv(f"price_data/{self.stock}.csv")
-        finally:
-            return df
-
-    def get_stock_quote(self, connection):
-        api_key = os.environ['TRADIER_API_KEY']
-        headers = {"Accept": "application/json",
-                   "Authorization": api_key}
-        connection.request(
-            'GET', f'/v1/markets/quotes?symbols={self.stock}', None, headers)
-        try:
-            response = connection.getresponse()
-            content = response.read().decode("utf-8")
-            my_json = json.loads(content)
-            return my_json
-        except http.client.HTTPException as e:
-            print("Exception during request", e)
-            return None
-
-    def market_is_open(self):
-        tz = pytz.timezone('US/Eastern')
-        us_holidays = holidays.US()
-        now = datetime.datetime.now(tz)
-        openTime = datetime.time(hour=9, minute=30, second=0)
-        closeTime = datetime.time(hour=16, minute=0, second=0)
-        abool = now.strftime('%Y-%m-%d') in us_holidays or now.time() < openTime or now.time() > closeTime \
-            or now.date().weekday() > 4
-        return not abool
-
-    def buy_or_sell(self, df, portfolio, price, buying_condition):
-        enough_time_passed = not self.last_purchase or datetime.date.today(
-        ) - self.last_purchase > datetime.timedelta(self.buying_delay)
-        if buying_condition.is_true(datetime.date.today(), price) and enough_time_passed:
-            # buy; including add things to database
-            pass
+    def load_session_data(self, session_date):
+        """
+        Reloads the price history of every stock and warms up the buying signal with the
+        bars before session_date, like the backtest warms it up with the bars before the
+        one it evaluates
+        """
+        for stock in self.stocks:
+            self.data[stock] = self.data_loader(stock)
+        closes = pd.concat([self.data[stock]["Close"] for stock in self.stocks],
+                           axis=1, keys=self.stocks).sort_index().ffill()
+        closes = closes[pd.to_datetime(closes.index) < pd.Timestamp(session_date)]
+        self.buying_condition = Signals.LowForPeriod(
+            self.stocks, 3, week_length=7)
+        self.buying_condition.warm_up(closes.to_numpy())
+
+    async def start_session(self, session_date):
+        """
+        Starts the trading session of session_date
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.load_session_data, session_date)
+        self.session_date = session_date
+        print("Started session", session_date)
+
+    def record_snapshot(self):
+        """
+        Queues a snapshot of the portfolio, valued at the last quotes, as of the last quote
+        """
+        if self.store is not None and self.last_quote_time is not None:
+            self.store.record_snapshot(self.portfolio.get_buying_power(),
+                                       self.portfolio.get_portfolio_value(self.last_prices),
+                                       self.last_quote_time)
+
+    def buy_or_sell(self, stock, price, today, quote_time=None):
+        last_purchase = self.last_purchase[stock]
+        enough_time_passed = not last_purchase or today - \
+            last_purchase > datetime.timedelta(self.buying_delay)
+        if self.buying_condition.is_true_for(stock, price) and enough_time_passed:
+            print("Buying signal", stock, price, today)
+            self.last_purchase[stock] = today
+            self.portfolio.open_shares(stock, 1, price)
+            if self.store is not None:
+                self.store.record_fill(stock, 'stocks', 1, price, quote_time)
         # if selling_condition (i.e., plussed 60% of my position)
 
         # print('price', price)
 
-    def run(self):
-        connection = http.client.HTTPSConnection(
-            'sandbox.tradier.com', 443, timeout=30)
-        df = self.load_stock_data()
-        portfolio = State.Portfolio()
-        buying_condition = Conditions.IsLowForPeriod(
-            df, portfolio, 3, week_length=7)
-        while True:
-            if self.market_is_open():
-                my_json = self.get_stock_quote(connection)
-                print(my_json)
-                price = my_json['quotes']['quote']['last']
-                self.buy_or_sell(df, portfolio, price, buying_condition)
-            else:
-                # reload the data
-                df = self.load_stock_data()
-                buying_condition = Conditions.IsLowForPeriod(
-                    df, portfolio, 3, week_length=7)
-                print("Market is closed")
-            time.sleep(3)
+    async def on_quote(self, quote):
+        """
+        Handles one quote from the feed
+        """
+        today = quote["time"].date()
+        if today != self.session_date:
+            self.record_snapshot()
+            await self.start_session(today)
+        self.last_prices[quote["symbol"]] = quote["price"]
+        self.last_quote_time = quote["time"]
+        if quote["symbol"] in self.last_purchase:
+            self.buy_or_sell(quote["symbol"], quote["price"], today, quote["time"])
+
+    async def run(self):
+        if self.store is not None:
+            self.store.start()
+        try:
+            async for quote in self.feed.quotes():
+                await self.on_quote(quote)
+        finally:
+            if self.store is not None:
+                self.record_snapshot()
+                await self.store.close()
 
 
 if __name__ == "__main__":
@@ -102,5 +140,5 @@ if __name__ == "__main__":
     #     datefmt='%Y-%m-%d:%H:%M:%S',
     #     level=logging.INFO)
 
-    test = ForwardTesting("AMZN", buying_delay=5)
-    test.run()
+    test = ForwardTesting(["AMZN"], buying_delay=5)
+    asyncio.run(test.run())
@@ -0,0 +1,212 @@
+from abc import ABC, abstractmethod
+import asyncio
+import datetime
+import http.client
+import json
+import os
+import random
+import threading
+import holidays
+import pytz
+
+EASTERN = pytz.timezone('US/Eastern')
+US_HOLIDAYS = holidays.US()
+OPEN_TIME = datetime.time(hour=9, minute=30, second=0)
+CLOSE_TIME = datetime.time(hour=16, minute=0, second=0)
+
+
+def market_is_open(now=None):
+    """
+    Returns: True if the US stock market is open at now (default: the current time)
+    """
+    now = now or datetime.datetime.now(EASTERN)
+    abool = now.date() in US_HOLIDAYS or now.time() < OPEN_TIME or now.time() > CLOSE_TIME \
+        or now.date().weekday() > 4
+    return not abool
+
+
+def next_market_open(now=None):
+    """
+    Returns: the datetime of the next market open after now (default: the current time)
+    """
+    now = now or datetime.datetime.now(EASTERN)
+    day = now.date()
+    if now.time() >= OPEN_TIME:
+        day += datetime.timedelta(1)
+    while day in US_HOLIDAYS or day.weekday() > 4:
+        day += datetime.timedelta(1)
+    return EASTERN.localize(datetime.datetime.combine(day, OPEN_TIME))
+
+
+class QuoteFeed(ABC):
+    """
+    Abstract class representing a source of quotes for the forward-testing engine.
+
+    A feed is an async iterator of quotes. Each quote is a dict with the keys "symbol",
+    "price" and "time" (a timezone-aware datetime). Feeds are interchangeable: the engine
+    does not know whether quotes are polled, streamed or replayed.
+    """
+
+    def __init__(self, symbols):
+        self._symbols = list(symbols)
+
+    def get_symbols(self):
+        """
+        Returns: the symbols this feed quotes
+        """
+        return self._symbols
+
+    @abstractmethod
+    def quotes(self):
+        """
+        Returns: an async iterator of quotes
+        """
+        pass
+
+
+class TradierPollingFeed(QuoteFeed):
+    """
+    A feed that polls Tradier for the last price of every symbol in one batched request.
+
+    Requests are only made while the market is open. Outside market hours the feed sleeps
+    until the next open instead of polling.
+    """
+
+    def __init__(self, symbols, interval=3, host='sandbox.tradier.com'):
+        super().__init__(symbols)
+        self._interval = interval
+        self._host = host
+        self._connection = None
+
+    def get_batch_quote(self):
+        """
+        Returns: the parsed quotes of every symbol, fetched with a single blocking request
+        """
+        if self._connection is None:
+            self._connection = http.client.HTTPSConnection(
+                self._host, 443, timeout=30)
+        headers = {"Accept": "application/json",
+                   "Authorization": os.environ['TRADIER_API_KEY']}
+        try:
+            self._connection.request(
+                'GET', f'/v1/markets/quotes?symbols={",".join(self._symbols)}', None, headers)
+            response = self._connection.getresponse()
+            my_json = json.loads(response.read().decode("utf-8"))
+        except (http.client.HTTPException, OSError, ValueError) as e:
+            print("Exception during request", e)
+            self._connection.close()
+            self._connection = None
+            return []
+        quote_list = (my_json.get('quotes') or {}).get('quote') or []
+        if isinstance(quote_list, dict):
+            quote_list = [quote_list]
+        now = datetime.datetime.now(EASTERN)
+        return [{"symbol": quote['symbol'], "price": quote['last'], "time": now}
+                for quote in quote_list if quote.get('last') is not None]
+
+    async def quotes(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = datetime.datetime.now(EASTERN)
+            if not market_is_open(now):
+                print("Market is closed")
+                await asyncio.sleep((next_market_open(now) - now).total_seconds())
+                continue
+            for quote in await loop.run_in_executor(None, self.get_batch_quote):
+                yield quote
+            await asyncio.sleep(self._interval)
+
+
+class TradierStreamingFeed(QuoteFeed):
+    """
+    A feed that consumes Tradier's streaming market events for every symbol.
+
+    The blocking HTTP stream is read on a background thread that hands trade events to
+    the event loop.
+    """
+
+    def __init__(self, symbols, api_host='sandbox.tradier.com', stream_host='stream.tradier.com'):
+        super().__init__(symbols)
+        self._api_host = api_host
+        self._stream_host = stream_host
+
+    def create_session(self):
+        """
+        Returns: a new streaming session id
+        """
+        connection = http.client.HTTPSConnection(
+            self._api_host, 443, timeout=30)
+        headers = {"Accept": "application/json",
+                   "Authorization": os.environ['TRADIER_API_KEY']}
+        connection.request('POST', '/v1/markets/events/session', None, headers)
+        my_json = json.loads(connection.getresponse().read().decode("utf-8"))
+        connection.close()
+        return my_json['stream']['sessionid']
+
+    def read_stream(self, loop, queue):
+        """
+        Reads trade events from the stream and puts them on queue until the stream ends
+        """
+        try:
+            session_id = self.create_session()
+            connection = http.client.HTTPSConnection(self._stream_host, 443)
+            connection.request('GET', f'/v1/markets/events?sessionid={session_id}&filter=trade&'
+                               f'symbols={",".join(self._symbols)}', None, {"Accept": "application/json"})
+            response = connection.getresponse()
+            for line in response:
+                line = line.strip()
+                if not line:
+                    continue
+                event = json.loads(line.decode("utf-8"))
+                if event.get('type') != 'trade':
+                    continue
+                quote = {"symbol": event['symbol'], "price": float(event['price']),
+                         "time": datetime.datetime.fromtimestamp(int(event['date']) / 1000, EASTERN)}
+                loop.call_soon_threadsafe(queue.put_nowait, quote)
+        except (http.client.HTTPException, OSError, ValueError, KeyError) as e:
+            print("Exception during stream", e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    async def quotes(self):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        threading.Thread(target=self.read_stream, args=(
+            loop, queue), daemon=True).start()
+        quote = await queue.get()
+        while quote is not None:
+            yield quote
+            quote = await queue.get()
+
+
+class FakeQuoteFeed(QuoteFeed):
+    """
+    A local feed that replays a list of quotes, for tests and offline runs.
+    """
+
+    def __init__(self, quote_list, delay=0):
+        super().__init__(sorted({quote["symbol"] for quote in quote_list}))
+        self._quote_list = quote_list
+        self._delay = delay
+
+    @staticmethod
+    def random_walk(symbols, start_prices, start_time, num_quotes, step=datetime.timedelta(minutes=1),
+                    volatility=0.001, seed=0):
+        """
+        Returns: a FakeQuoteFeed of num_quotes random-walk quotes per symbol, one round of
+        symbols every step from start_time
+        """
+        rng = random.Random(seed)
+        prices = dict(zip(symbols, start_prices))
+        quote_list = []
+        for i in range(num_quotes):
+            for symbol in symbols:
+                prices[symbol] *= 1 + rng.gauss(0, volatility)
+                quote_list.append({"symbol": symbol, "price": round(prices[symbol], 2),
+                                   "time": start_time + i * step})
+        return FakeQuoteFeed(quote_list)
+
+    async def quotes(self):
+        for quote in self._quote_list:
+            yield quote
+            await asyncio.sleep(self._delay)
@@ -11,6 +11,7 @@ class Portfolio(object):
                  current_holdings=[], trading_fees=0.75):
 
         self._current_holdings = current_holdings
+        self._shares = {}
         self._buying_power = initial_cash
         self._initial_value = initial_cash
         self._fees = trading_fees
@@ -32,3 +33,18 @@ class Portfolio(object):
         Returns: the current buying power of the portfolio
         """
         return self._buying_power
+
+    def open_shares(self, stock, num_shares, price):
+        """
+        Buys num_shares of stock at price, paying the trading fees
+        """
+        self._shares[stock] = self._shares.get(stock, 0) + num_shares
+        self._buying_power -= num_shares * price + self._fees
+
+    def get_portfolio_value(self, prices):
+        """
+        Returns: the buying power plus the value of the shares held at prices (a dict of
+        stock to its last price)
+        """
+        return self._buying_power + sum(num_shares * prices[stock]
+                                        for stock, num_shares in self._shares.items())
@@ -1,51 +1,19 @@
-import psycopg2
-import os
+import datetime
+import Database
 
-username = os.environ['POSTGRE_USER']
-password = os.environ['POSTGRE_PASSWORD']
-host = os.environ['POSTGRE_HOST']
+store = Database.PositionStore(Database.PostgresBackend(database='forwardtesting'))
+store.create_schema()
 
-conn = psycopg2.connect(host=host, database='forwardtesting',
-                        user=username, password=password)
-cursor = conn.cursor()
-
-cmds = (
-    """
-    CREATE TABLE positions (
-        position_id VARCHAR(255) PRIMARY KEY,
-        position_type VARCHAR(255),
-        num_positions INTEGER,
-        avg_cost float(2)
-    )""",
-
-    """
-    CREATE TABLE portfolio (
-        position_id VARCHAR(255),
-        portfolio_cash float(2) NOT NULL, 
-        time_last_updated TIMESTAMP NOT NULL,
-        FOREIGN KEY (position_id) REFERENCES positions (position_id)
-    )""",
-
-    """
-    INSERT INTO portfolio(portfolio_value, time_last_updated) 
-    VALUES (96.81, 'Jan 1, 2020')
-    """,
-
-    """
-    INSERT INTO portfolio(portfolio_value, time_last_updated) 
-    VALUES (100.01, 'Feb 1, 2020')
-    """,
-
-    """
-    SELECT * FROM portfolio
-    """,
-)
-
-for cmd in cmds:
-    cursor.execute(cmd)
+store.record_fill('SHOP200717C01040000', 'options', 1, 96.81,
+                  datetime.datetime(2020, 1, 1))
+store.record_snapshot(96.81, 100.01, datetime.datetime(2020, 1, 1))
+store.record_snapshot(100.01, 103.44, datetime.datetime(2020, 2, 1))
+store.flush()
 
+conn = store.get_backend()._pool.getconn()
+cursor = conn.cursor()
+cursor.execute("SELECT * FROM portfolio")
 print(cursor.fetchall())
+store.get_backend()._pool.putconn(conn)
 
-conn.close()
-
-# conn.commit()
+store.get_backend().close()
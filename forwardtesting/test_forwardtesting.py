@@ -0,0 +1,92 @@
+import asyncio
+import datetime
+import os
+import tempfile
+import unittest
+import pandas as pd
+import Database
+import Forwardtesting
+import QuoteFeeds
+
+
+def make_history(session_date):
+    """
+    Returns: a data loader of flat daily closes (AAA at 100, BBB at 50) for January 2020,
+    plus a bar of session_date far below them that the warm-up must not see
+    """
+    dates = [str(date.date()) for date in pd.bdate_range("2020-01-01", "2020-01-31")]
+    history = {"AAA": 100.0, "BBB": 50.0}
+
+    def load(stock):
+        closes = [history[stock]] * len(dates) + [history[stock] / 2]
+        return pd.DataFrame({"Close": closes}, index=pd.Index(dates + [str(session_date)], name="Date"))
+    return load
+
+
+def quote(symbol, price, time):
+    return {"symbol": symbol, "price": price, "time": time}
+
+
+class TestForwardTesting(unittest.TestCase):
+    """
+    The engine replays a fake feed over two sessions and persists its fills, positions and
+    snapshots to an SQLite store
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = Database.PositionStore(
+            Database.SQLiteBackend(os.path.join(self.directory.name, "forwardtesting.db")),
+            batch_size=2, flush_interval=0.01)
+        self.store.create_schema()
+        first, second = datetime.datetime(2020, 2, 3, 10), datetime.datetime(2020, 2, 10, 10)
+        minute = datetime.timedelta(minutes=1)
+        self.times = [first, first + minute, first + 2 * minute, second, second + minute]
+        self.feed = QuoteFeeds.FakeQuoteFeed([
+            # below the lows of the warm-up: buys AAA
+            quote("AAA", 99.0, self.times[0]),
+            # within the buying delay
+            quote("AAA", 98.0, self.times[1]),
+            # above the lows
+            quote("BBB", 51.0, self.times[2]),
+            # a new session past the buying delay: buys both
+            quote("AAA", 97.0, self.times[3]),
+            quote("BBB", 49.0, self.times[4]),
+        ])
+        self.engine = Forwardtesting.ForwardTesting(
+            ["AAA", "BBB"], buying_delay=5, feed=self.feed,
+            data_loader=make_history(first.date()), store=self.store)
+        asyncio.run(self.engine.run())
+
+    def tearDown(self):
+        self.store.get_backend().close()
+        self.directory.cleanup()
+
+    def query(self, cmd):
+        return self.store.get_backend().query(cmd)
+
+    def test_fills(self):
+        self.assertEqual(self.query("SELECT position_id, fill_time, quantity, price FROM fills ORDER BY fill_time"),
+                         [("AAA", self.times[0].isoformat(), 1, 99.0),
+                          ("AAA", self.times[3].isoformat(), 1, 97.0),
+                          ("BBB", self.times[4].isoformat(), 1, 49.0)])
+
+    def test_positions(self):
+        self.assertEqual(self.query("SELECT * FROM positions ORDER BY position_id"),
+                         [("AAA", "stocks", 2, 98.0), ("BBB", "stocks", 1, 49.0)])
+
+    def test_snapshots(self):
+        # one at the end of the first session, valued at its last quotes, and one at the end
+        cash = 10000 - 99.75
+        final_cash = cash - 97.75 - 49.75
+        snapshots = self.query("SELECT * FROM portfolio ORDER BY time_last_updated")
+        self.assertEqual([time for _, _, time in snapshots],
+                         [self.times[2].isoformat(), self.times[4].isoformat()])
+        self.assertAlmostEqual(snapshots[0][0], cash)
+        self.assertAlmostEqual(snapshots[0][1], cash + 98.0)
+        self.assertAlmostEqual(snapshots[1][0], final_cash)
+        self.assertAlmostEqual(snapshots[1][1], final_cash + 2 * 97.0 + 49.0)
+
+
+if __name__ == "__main__":
+    unittest.main()